@@ -9,17 +9,42 @@ These members access the system on behalf of the facade client and hide the
 implementation details.
 """
 
+import os
+import time
+import uuid
 import logging
+import threading
+from os import path
+from fnmatch import fnmatch
 from modules.workload_parser import Parser
+from modules.catalog import Catalog
+from modules.network_topology import NetworkTopology
+from modules import json_loader
+from modules.utils import load_data, parse_iso_time, ImportTaskFailed, WorkloadException
+from modules.snapshot_handle import LazySnapshot
 from modules.image_converter import ImageConverter
 from modules.boto_adapter import BotoAdapter
+from modules.aws_clients import AwsClients
+from modules.restore_scheduler import RestoreScheduler
+from modules.restore_journal import RestoreJournal
+from modules.conversion_cache import file_checksum
+from modules.metrics import METRICS
+
+RESTORE_LIMITS = {'network': 1, 'convert': 1, 'upload': 2, 'import': 4, 'launch': 2,
+                  'vms': None}
 
 class App(object):
     """
     Exposes api to CLI and UI
     """
     def __init__(self, bucket, region,\
-                 container_json_path, trilio_base_dir, key_pair):
+                 container_json_path, trilio_base_dir, key_pair, catalog_path=None,
+                 snapshot_workers=1, latest_snapshot_by='updated_at', json_cache_mb=64,
+                 stream_resources=False, convert_options=None, stream_upload=False,
+                 stream_options=None, s3_endpoint_url=None, cache_options=None,
+                 upload_options=None, import_options=None, aws_options=None,
+                 restore_manifest_dir=None, restore_options=None, restore_journal=None,
+                 metrics_options=None):
         """
         App Class Constructor
 
@@ -35,25 +60,113 @@ class App(object):
             type args: str
             key_pair: key pair to login instance
             type args: str
+            param catalog_path: sqlite catalog of the vault, walks the vault if None
+            type args: str
+            param snapshot_workers: number of snapshot_db files loaded concurrently
+            type args: int
+            param latest_snapshot_by: 'updated_at' or 'mtime' of snapshot_db, used to pick
+                                      latest snapshot when catalog is not configured
+            type args: str
+            param json_cache_mb: memory budget of the vault db file cache, 0 disables it
+            type args: int
+            param stream_resources: stream snapshot_vms_db and resources_db files
+            type args: bool
+            param convert_options: qemu-img conversion settings, see ConversionScheduler
+            type args: dict
+            param stream_upload: upload disks part by part without intermediate raw files
+            type args: bool
+            param stream_options: part_size_mb, workers and scratch_dir of streamed uploads
+            type args: dict
+            param s3_endpoint_url: S3 compatible endpoint, amazon S3 if None
+            type args: str
+            param cache_options: conversion cache settings, see ConversionCache
+            type args: dict
+            param upload_options: part_size_mb, threads, disks and max_attempts of raw
+                                  disk uploads
+            type args: dict
+            param import_options: min_poll_seconds, max_poll_seconds, backoff and
+                                  timeout_minutes of import-snapshot polling
+            type args: dict
+            param aws_options: connection pool, retry and timeout settings of the
+                               AWS clients, see AwsClients
+            type args: dict
+            param restore_manifest_dir: directory of per restore digest manifests, none
+                                        are written if None
+            type args: str
+            param restore_options: vms in each restore stage at the same time, keys
+                                   network, convert, upload, import and launch, and
+                                   vms in the whole pipeline at once (vms)
+            type args: dict
+            param restore_journal: sqlite journal of finished restore stages, restores
+                                   resume from it; every restore starts over if None
+            type args: str
+            param metrics_options: enabled, json_report and prometheus_textfile of the
+                                   step timers and byte counters
+            type args: dict
         """
-        self.parser_obj = Parser(trilio_base_dir)
-        self.ic_obj = ImageConverter(bucket, region, container_json_path)
-        self.boto_obj = BotoAdapter(region, key_pair)
+        json_loader.LOADER.resize(int(json_cache_mb * 1024 * 1024))
+        self.metrics_options = metrics_options or {}
+        METRICS.configure(bool(self.metrics_options.get('enabled')))
+        self.catalog = None
+        if catalog_path:
+            self.catalog = Catalog(trilio_base_dir, catalog_path, snapshot_workers)
+        self.parser_obj = Parser(trilio_base_dir, self.catalog, snapshot_workers,
+                                 latest_snapshot_by, stream_resources)
+        self.aws_clients = AwsClients(region, {'s3': s3_endpoint_url}, **(aws_options or {}))
+        self.ic_obj = ImageConverter(bucket, region, container_json_path, convert_options,
+                                     stream_options, s3_endpoint_url, cache_options,
+                                     upload_options, import_options, self.aws_clients)
+        self.stream_upload = stream_upload
+        self.restore_manifest_dir = restore_manifest_dir
+        self.restore_limits = dict(RESTORE_LIMITS, **(restore_options or {}))
+        self.journal = RestoreJournal(restore_journal) if restore_journal else None
+        self.boto_obj = BotoAdapter(region, key_pair, self.aws_clients)
+        self.topologies = {}
+        self.topology_lock = threading.Lock()
         self.logger = logging.getLogger(__name__)
-    def get_workloads(self):
+    def get_workloads(self, prefix='', offset=0, limit=None):
         """
         Returns list of workloads under trilio vault directory
         if availabel otherwise returns None.
 
         - **parameters**, **types**, **return** and **return types**::
 
+            param prefix: workload id prefix filter
+            type prefix: str
+            param offset: number of workloads to skip
+            type offset: int
+            param limit: maximum number of workloads, all when None
+            type limit: int
             returns workloads:
             type: list
         """
 
-        return self.parser_obj.get_workloads()
+        return self.parser_obj.get_workloads(prefix, offset, limit)
+
+    def get_workload_data(self, workload):
+        """
+        Returns workload_db data of given workload.
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param workload: Name of the workload
+            type workload: str
+            returns workload data:
+            type: dict
+        """
+        return self.parser_obj.get_workload_data(workload)
+
+    def rebuild_catalog(self):
+        """
+        Re-indexes the whole vault into the catalog and returns
+        number of indexed snapshots.
+        """
+        if self.catalog:
+            return self.catalog.rebuild()
+        self.logger.info("catalog is not configured")
+        return None
 
-    def get_snapshots_from_workload(self, workload_name):
+    def get_snapshots_from_workload(self, workload_name, prefix='', offset=0, limit=None):
         """
         Returns list of snapshots dictonaries, Each dictionary contains snapshot name,
         snapshot path, size and snapshot_db inforation.
@@ -62,29 +175,51 @@ class App(object):
 
             param workload_name: Name of the workload
             type workload_name: str
+            param prefix: snapshot id prefix filter
+            type prefix: str
+            param offset: number of snapshots to skip
+            type offset: int
+            param limit: maximum number of snapshots, all when None
+            type limit: int
             returns snapshots:
             type: list
         """
         if isinstance(str(workload_name), str):
-            return self.parser_obj.get_snapshots_from_workload(workload_name)
+            return self.parser_obj.get_snapshots_from_workload(
+                workload_name, prefix, offset, limit)
         else:
             self.logger.info("expected dictionary but got %s", type(workload_name))
         return None
 
     def get_snapshot_from_workload(self, snap_shot_name, workload):
         """
-        Returns snapshot dictonary if availabel otherwise returns None.
+        Returns snapshot path if availabel otherwise returns None.
 
         - **parameters**, **types**, **return** and **return types**::
-            param snap_shot_name: Name of the snapshot
+            param snap_shot_name: snapshot id, id prefix or directory name
             type snap_shot_name: str
             param workload_name: Name of the workload
             type workload_name: str
-            returns snapshots:
-            type: list
+            returns snapshot path:
+            type: str
         """
         return self.parser_obj.get_snapshot_from_workload(snap_shot_name, workload)
 
+    def get_snapshot_by_name(self, snap_shot_name, workload=None):
+        """
+        Returns snapshot path if availabel otherwise returns None,
+        searches every workload when workload is not given.
+
+        - **parameters**, **types**, **return** and **return types**::
+            param snap_shot_name: snapshot id, id prefix or directory name
+            type snap_shot_name: str
+            param workload: Name of the workload
+            type workload: str
+            returns snapshot path:
+            type: str
+        """
+        return self.parser_obj.get_snapshot_by_name(snap_shot_name, workload)
+
     def get_vms_from_snapshots(self, snapshot):
         """
         Returns vm dictonaries form given snapshot if available
@@ -112,6 +247,49 @@ class App(object):
         """
         return self.parser_obj.get_latest_snapshot(workload)
 
+    def get_latest_snapshots(self, workload, count):
+        """
+        Returns the count most recent snapshots of given workload, newest first.
+
+        - **parameters**, **types**, **return** and **return types**::
+            param workload: Name of the workload
+            type workload: str
+            param count: number of snapshots to return
+            type count: int
+            returns snapshots:
+            type: list
+        """
+        return self.parser_obj.get_latest_snapshots(workload, count)
+
+    def get_network_topology(self, snapshot_path):
+        """
+        Returns the network topology of given snapshot, shared by all its vms.
+
+        - **parameters**, **types**, **return** and **return types**::
+            param snapshot_path: Path of the snapshot directory
+            type snapshot_path: str
+            returns topology:
+            type: modules.network_topology.NetworkTopology
+        """
+        with self.topology_lock:
+            if snapshot_path not in self.topologies:
+                self.topologies[snapshot_path] = NetworkTopology(snapshot_path)
+            return self.topologies[snapshot_path]
+
+    def update_network_info(self, vm_dict):
+        """
+        Updates vm dictionary with ip, router_name, cidr and subnet_name
+        resolved through the topology of its snapshot.
+        """
+        snapshot_path = path.dirname(vm_dict['path'])
+        return self.get_network_topology(snapshot_path).update_vm(vm_dict)
+
+    def get_cache_stats(self):
+        """
+        Returns hit/miss counters of the vault db file cache.
+        """
+        return json_loader.LOADER.stats()
+
     def convert_image_to_raw(self, disks):
         """
         Converts to QCOW2 image to RAW format
@@ -122,6 +300,18 @@ class App(object):
             self.logger.info("expected string but got %s", type(disks))
         return None
 
+    def get_conversion_reports(self):
+        """
+        Returns per disk timing and progress of conversions
+        """
+        return self.ic_obj.get_conversion_reports()
+
+    def get_upload_reports(self):
+        """
+        Returns per disk throughput and retries of uploads
+        """
+        return self.ic_obj.get_upload_reports()
+
     def copy_disks_to_s3(self, disks):
         """
         copy raw images to Amazon S3 to take snapshots
@@ -132,20 +322,318 @@ class App(object):
             self.logger.info("expected string but got %s", type(disks))
         return None
 
+    def upload_disks(self, disks):
+        """
+        Puts disks on S3 as raw images, streamed or converted then copied
+        depending on stream_upload, and returns the raw disk names.
+        """
+        if self.stream_upload:
+            return self.ic_obj.stream_disks_to_s3(disks)
+        raw_disks = self.convert_image_to_raw(disks)
+        self.copy_disks_to_s3(raw_disks)
+        return raw_disks
+
+    def write_restore_manifest(self, vm_dict, raw_disks):
+        """
+        Writes digests of the uploaded raw disks of a vm restore to
+        restore_manifest_dir and returns the manifest path
+        """
+        if not self.restore_manifest_dir:
+            return None
+        if not path.isdir(self.restore_manifest_dir):
+            os.makedirs(self.restore_manifest_dir)
+        created_at = time.strftime('%Y%m%d%H%M%S')
+        manifest_path = path.join(self.restore_manifest_dir, "{}_{}.json".format(
+            vm_dict.get('id'), created_at))
+        load_data(manifest_path, {
+            'vm_id': vm_dict.get('id'),
+            'vm_name': vm_dict.get('name'),
+            'created_at': created_at,
+            'bucket': self.ic_obj.bucket,
+            'disks': self.ic_obj.get_digests(raw_disks),
+        })
+        self.logger.info("restore manifest written to %s", manifest_path)
+        return manifest_path
+
     def create_snapshot(self, disk):
         """
         Creates snapshot
         """
         return self.ic_obj.create_snapshot(disk)
 
+    def create_snapshots(self, disks):
+        """
+        Creates snapshots of all disks at once, returns ids in disk order
+        """
+        return self.ic_obj.create_snapshots(disks)
+
     def register_ami(self, snapshot_id):
         """
         Register AMI in aws
         """
         return self.boto_obj.register_ami(snapshot_id)
 
-    def lanuch_instance(self, ami_id, snap_ids, vm_dict):
+    def lanuch_instance(self, ami_id, snap_ids, vm_dict, client_token=None):
+        """
+        Launch instance in AWS EC2, at most once per client_token.
+        """
+        return self.boto_obj.lanuch_instance(ami_id, snap_ids, vm_dict, client_token)
+
+    def _checkpoint(self, job, stage, data):
+        """
+        Records a finished restore stage of job in the journal
+        """
+        job.state['checkpoints'][stage] = data
+        if self.journal:
+            self.journal.record(job.vm_dict, stage, data)
+
+    def _restore_network(self, job):
+        """
+        Restore stage: resolves network of the vm and loads its checkpoints
+        """
+        job.vm_dict = self.update_network_info(job.vm_dict)
+        job.state['checkpoints'] = self.journal.checkpoints(job.vm_dict) if self.journal else {}
+        if job.state['checkpoints']:
+            self.logger.info("resuming restore of vm %s after %s", job.name,
+                             sorted(job.state['checkpoints']))
+
+    def _raw_disks_intact(self, checkpoint):
+        """
+        Returns True when the raw disks of a convert checkpoint still have
+        their recorded size and mtime, and checksum when one was recorded
+        """
+        stamps = zip(checkpoint['raw_disks'], checkpoint['sizes'],
+                     checkpoint.get('mtimes') or [], checkpoint.get('checksums') or [])
+        if len(stamps) != len(checkpoint['raw_disks']):
+            return False
+        for raw_disk, size, mtime, checksum in stamps:
+            if not path.exists(raw_disk):
+                return False
+            stat = os.stat(raw_disk)
+            if (stat.st_size, stat.st_mtime) != (size, mtime):
+                self.logger.warning("raw disk %s changed since it was converted", raw_disk)
+                return False
+            if checksum and file_checksum(raw_disk, checksum[0]) != checksum[1]:
+                self.logger.warning("raw disk %s changed since it was converted", raw_disk)
+                return False
+        return True
+
+    def _restore_convert(self, job):
+        """
+        Restore stage: converts disks of the vm to raw, streamed uploads
+        convert while uploading
+        """
+        done = job.state['checkpoints']
+        if 'upload' in done or self.stream_upload:
+            return
+        if 'convert' in done and self._raw_disks_intact(done['convert']):
+            job.state['raw_disks'] = done['convert']['raw_disks']
+            if self.ic_obj.cache is not None:
+                self.ic_obj.cache.pin(job.state['raw_disks'])
+            return
+        raw_disks = self.convert_image_to_raw(job.vm_dict.get('disks', []))
+        job.state['raw_disks'] = raw_disks
+        stats = [os.stat(raw_disk) for raw_disk in raw_disks]
+        self._checkpoint(job, 'convert', {
+            'raw_disks': raw_disks,
+            'sizes': [stat.st_size for stat in stats],
+            'mtimes': [stat.st_mtime for stat in stats],
+            'checksums': [self.ic_obj.raw_checksum(raw_disk) for raw_disk in raw_disks],
+        })
+
+    def _restore_upload(self, job):
+        """
+        Restore stage: puts raw disks of the vm on S3 and writes its manifest
+        """
+        done = job.state['checkpoints']
+        if 'upload' in done:
+            job.state['raw_disks'] = done['upload']['raw_disks']
+            job.state['manifest'] = done['upload']['manifest']
+            return
+        if self.stream_upload:
+            job.state['raw_disks'] = self.ic_obj.stream_disks_to_s3(
+                job.vm_dict.get('disks', []))
+        else:
+            self.copy_disks_to_s3(job.state['raw_disks'])
+        job.state['manifest'] = self.write_restore_manifest(job.vm_dict,
+                                                            job.state['raw_disks'])
+        self._checkpoint(job, 'upload', {
+            'raw_disks': job.state['raw_disks'],
+            'keys': [path.basename(raw_disk) for raw_disk in job.state['raw_disks']],
+            'digests': self.ic_obj.get_digests(job.state['raw_disks']),
+            'manifest': job.state['manifest'],
+        })
+
+    def _restore_import(self, job):
+        """
+        Restore stage: imports snapshots of the uploaded disks, waits for
+        import tasks of an interrupted restore instead of starting new ones
+        """
+        done = job.state['checkpoints']
+        if 'import' in done:
+            job.state['snap_ids'] = done['import']['snap_ids']
+            return
+        raw_disks = job.state['raw_disks']
+        if 'import_tasks' in done:
+            task_ids = done['import_tasks']['task_ids']
+            self.logger.info("re-attaching vm %s to import tasks %s", job.name, task_ids)
+        else:
+            task_ids = self.ic_obj.submit_imports(raw_disks)
+            self._checkpoint(job, 'import_tasks', {'task_ids': task_ids})
+        try:
+            snap_ids = self.ic_obj.wait_imports(raw_disks, task_ids)
+        except ImportTaskFailed:
+            # failed tasks never finish, the next restore submits new ones
+            if self.journal:
+                self.journal.discard(job.vm_dict, ['import_tasks'])
+            raise
+        job.state['snap_ids'] = snap_ids
+        self._checkpoint(job, 'import', {'snap_ids': snap_ids})
+
+    def _restore_launch(self, job):
+        """
+        Restore stage: registers AMI of the root disk and launches the
+        instance with the client token journaled along the AMI, so a launch
+        retried after a crash returns the instance EC2 already started. The
+        restore is complete then, its checkpoints are dropped so the next
+        restore of the vm starts over
+        """
+        done = job.state['checkpoints']
+        snap_ids = job.state['snap_ids']
+        if 'launch' in done:
+            job.state['ami_id'] = done['ami']['ami_id']
+            job.state['instance_id'] = done['launch']['instance_id']
+            self.logger.info("Instance already launched with ID ***%s***",
+                             job.state['instance_id'])
+        else:
+            if 'ami' in done:
+                job.state['ami_id'] = done['ami']['ami_id']
+            else:
+                for snap in snap_ids:
+                    if snap.endswith("!@root_disk"):
+                        job.state['ami_id'] = self.register_ami(snap.split("!@")[0])
+            if not done.get('ami', {}).get('client_token'):
+                self._checkpoint(job, 'ami', {'ami_id': job.state.get('ami_id'),
+                                              'client_token': str(uuid.uuid4())})
+            if job.state.get('ami_id'):
+                instance = self.lanuch_instance(job.state['ami_id'], snap_ids, job.vm_dict,
+                                                done['ami']['client_token'])
+                job.state['instance_id'] = instance[0].id
+                self._checkpoint(job, 'launch', {'instance_id': job.state['instance_id']})
+                self.logger.info("Instance launched sucessfully with ID ***%s***",
+                                 job.state['instance_id'])
+        if self.journal:
+            self.journal.discard(job.vm_dict)
+
+    def restore_vms(self, vm_dicts, progress_callback=None, limits=None):
+        """
+        Restores vms in EC2 as a pipeline, each stage running for as many vms
+        at once as restore_options allow, and returns a RestoreJob per vm.
+
+        - **parameters**, **types**, **return** and **return types**::
+            param vm_dicts: vms to restore, of one or more snapshots
+            type vm_dicts: list
+            param progress_callback: called with (job, stage, event), see
+                                     RestoreScheduler
+            type progress_callback: callable
+            param limits: overrides of restore_options for this restore
+            type limits: dict
+            returns jobs: jobs in vm order, failed ones carry error and stage
+            type: list
+        """
+        self.boto_obj.reset_networks()
+        limits = dict(self.restore_limits, **(limits or {}))
+        stages = [
+            ('network', self._restore_network),
+            ('convert', self._restore_convert),
+            ('upload', self._restore_upload),
+            ('import', self._restore_import),
+            ('launch', self._restore_launch),
+        ]
+        jobs = RestoreScheduler(stages, limits, progress_callback, limits.get('vms'))\
+            .run(vm_dicts)
+        self.logger.info("EC2 calls of the restore %s", self.get_aws_call_stats())
+        return jobs
+
+    def forget_restores(self, vm_dicts):
+        """
+        Drops journaled stages of vms, their next restore starts over
+        """
+        if self.journal:
+            for vm_dict in vm_dicts:
+                self.journal.discard(vm_dict)
+
+    def select_snapshot(self, workload, selector='latest'):
+        """
+        Returns snapshot of workload picked by selector, None if none matches.
+
+        - **parameters**, **types**, **return** and **return types**::
+            param workload: Name of the workload
+            type workload: str
+            param selector: 'latest', 'id:<snapshot id or id prefix>' or
+                            'before:<ISO time>' for the newest snapshot taken
+                            at or before that time
+            type selector: str
+            returns snapshot:
+            type: dict
+        """
+        kind, _, value = selector.partition(':')
+        if kind == 'latest':
+            return self.get_latest_snapshot(workload)
+        if kind == 'id':
+            snapshot_path = self.get_snapshot_by_name(value, workload)
+            return LazySnapshot(snapshot_path) if snapshot_path else None
+        if kind == 'before':
+            try:
+                limit = parse_iso_time(value)[1]
+            except (ValueError, OverflowError) as err:
+                raise WorkloadException("invalid time in snapshot selector {}: {}".format(
+                    selector, err))
+            snapshots = [snapshot for snapshot in
+                         self.get_snapshots_from_workload(workload) or []
+                         if snapshot.get('timestamp') is not None and
+                         snapshot['timestamp'] <= limit]
+            return max(snapshots, key=lambda snapshot: snapshot['timestamp']) \
+                if snapshots else None
+        raise WorkloadException("unknown snapshot selector {}".format(selector))
+
+    def select_vms(self, snapshot, patterns=None):
+        """
+        Returns vms of snapshot whose name or id matches one of the shell
+        style patterns, all vms when patterns is empty.
+        """
+        vms = self.get_vms_from_snapshots(snapshot) or []
+        if not patterns:
+            return list(vms)
+        return [vm_dict for vm_dict in vms if any(
+            fnmatch(str(vm_dict.get('name')), pattern) or
+            fnmatch(str(vm_dict.get('id')), pattern) for pattern in patterns)]
+
+    def get_metrics_report(self):
+        """
+        Returns timers, latency histograms, MB/s and counters of every
+        restore step, see modules.metrics
+        """
+        return METRICS.report()
+
+    def export_metrics(self):
+        """
+        Writes the metrics report to the configured JSON report and
+        Prometheus textfile, returns paths written
+        """
+        if not METRICS.enabled:
+            return []
+        written = []
+        if self.metrics_options.get('json_report'):
+            METRICS.write_json(self.metrics_options['json_report'])
+            written.append(self.metrics_options['json_report'])
+        if self.metrics_options.get('prometheus_textfile'):
+            METRICS.write_prometheus(self.metrics_options['prometheus_textfile'])
+            written.append(self.metrics_options['prometheus_textfile'])
+        return written
+
+    def get_aws_call_stats(self):
         """
-        Launch instance in AWS EC2.
+        Returns calls, throttles and retries of EC2 calls per API family
         """
-        return self.boto_obj.lanuch_instance(ami_id, snap_ids, vm_dict)
+        return self.aws_clients.throttle.stats()
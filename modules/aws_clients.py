@@ -0,0 +1,81 @@
+"""
+AWS clients
+
+One boto3 session per process, so credentials are resolved once, and one
+client or resource per service on top of it. Clients share the connection
+pool, retry and timeout settings and are safe to use from many threads.
+EC2 clients are rate limited and retried by one shared CallThrottle.
+"""
+import threading
+import boto3
+from botocore.config import Config
+from modules.aws_throttle import CallThrottle
+
+class AwsClients(object):
+    """
+    Factory of shared boto3 clients and resources.
+    """
+    def __init__(self, region, endpoint_urls=None, max_pool_connections=32, max_attempts=5,
+                 connect_timeout=10, read_timeout=60, session=None, ec2_throttle=None):
+        """
+        constructor of AwsClients class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param region: amazon region name
+            type region: str
+            param endpoint_urls: endpoint per service name, e.g. {'s3': url} to
+                                 point at an S3 compatible stand-in
+            type endpoint_urls: dict
+            param max_pool_connections: pooled connections per client
+            type max_pool_connections: int
+            param max_attempts: botocore retry attempts of throttled or failed calls
+            type max_attempts: int
+            param connect_timeout: seconds to establish a connection
+            type connect_timeout: float
+            param read_timeout: seconds to wait for a response
+            type read_timeout: float
+            param session: boto3 session to build clients from, e.g. a stubbed
+                           one, a new session when None
+            type session: boto3.session.Session
+            param ec2_throttle: CallThrottle settings of EC2 calls: families,
+                                max_attempts, base_delay and max_delay
+            type ec2_throttle: dict
+        """
+        self.region = region
+        self.endpoint_urls = dict(endpoint_urls or {})
+        self.config = Config(max_pool_connections=int(max_pool_connections),
+                             connect_timeout=connect_timeout, read_timeout=read_timeout,
+                             retries={'max_attempts': int(max_attempts)})
+        self.session = session or boto3.session.Session(region_name=region)
+        self.clients = {}
+        self.resources = {}
+        self.throttle = CallThrottle(**(ec2_throttle or {}))
+        self.lock = threading.Lock()
+
+    def client(self, service):
+        """
+        Returns the shared client of given service.
+        """
+        with self.lock:
+            if service not in self.clients:
+                self.clients[service] = self.session.client(
+                    service, region_name=self.region,
+                    endpoint_url=self.endpoint_urls.get(service), config=self.config)
+                if service == 'ec2':
+                    self.throttle.register(self.clients[service])
+            return self.clients[service]
+
+    def resource(self, service):
+        """
+        Returns the shared resource of given service, built on the same
+        session and settings as the clients.
+        """
+        with self.lock:
+            if service not in self.resources:
+                self.resources[service] = self.session.resource(
+                    service, region_name=self.region,
+                    endpoint_url=self.endpoint_urls.get(service), config=self.config)
+                if service == 'ec2':
+                    self.throttle.register(self.resources[service].meta.client)
+            return self.resources[service]
@@ -0,0 +1,219 @@
+"""
+EC2 call throttling
+
+Every EC2 request, made through a client or a resource, first takes a
+token from the bucket of its API family (describe, mutate or import), so a
+restore of many vms spreads its calls instead of bursting into
+RequestLimitExceeded. A throttled family halves its rate and creeps back up
+on every success. Throttled and transient failures are retried with
+exponential backoff and full jitter, and calls EC2 can deduplicate get a
+ClientToken so a retried create does not create twice.
+"""
+import time
+import uuid
+import random
+import logging
+import threading
+from modules.metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+THROTTLE_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException',
+                  'RequestThrottled', 'TooManyRequestsException')
+TRANSIENT_CODES = ('InternalError', 'InternalFailure', 'ServiceUnavailable', 'Unavailable')
+FAMILIES = {
+    'describe': {'rate': 20, 'burst': 100},
+    'mutate': {'rate': 5, 'burst': 50},
+    'import': {'rate': 1, 'burst': 20},
+}
+
+def api_family(operation_name):
+    """
+    Returns the token bucket family of an EC2 operation.
+    """
+    if operation_name.startswith('Describe'):
+        return 'describe'
+    if operation_name.startswith('Import'):
+        return 'import'
+    return 'mutate'
+
+class TokenBucket(object):
+    """
+    Token bucket refilled at rate tokens per second up to burst tokens.
+    """
+    def __init__(self, rate, burst, clock=time.time, sleep=time.sleep):
+        """
+        constructor of TokenBucket class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param rate: tokens added per second, also the highest adaptive rate
+            type rate: float
+            param burst: capacity of the bucket
+            type burst: int
+            param clock: returns current time in seconds
+            type clock: callable
+            param sleep: sleeps given seconds
+            type sleep: callable
+        """
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self.tokens = self.burst
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        """
+        Helper function: adds tokens for the time passed, called under lock.
+        """
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Takes a token, waiting for one when the bucket is empty, returns
+        seconds waited.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            self.sleep(delay)
+            waited += delay
+
+    def throttled(self):
+        """
+        Halves the rate after EC2 throttled a call, down to a tenth of the
+        configured rate.
+        """
+        with self.lock:
+            self._refill()
+            self.rate = max(self.rate / 2, self.max_rate / 10)
+
+    def succeeded(self):
+        """
+        Raises the rate by a twentieth of the configured rate, up to it.
+        """
+        with self.lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.rate + self.max_rate / 20, self.max_rate)
+
+class CallThrottle(object):
+    """
+    Rate limits and retries the calls of the EC2 clients it is registered on.
+    """
+    def __init__(self, families=None, max_attempts=8, base_delay=0.5, max_delay=20,
+                 clock=time.time, sleep=time.sleep):
+        """
+        constructor of CallThrottle class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param families: rate and burst per API family, overrides FAMILIES
+            type families: dict
+            param max_attempts: attempts of a throttled or failing call
+            type max_attempts: int
+            param base_delay: seconds of the first backoff, doubled per attempt
+            type base_delay: float
+            param max_delay: upper bound of a backoff in seconds
+            type max_delay: float
+        """
+        limits = dict((family, dict(limit)) for family, limit in FAMILIES.items())
+        for family, limit in (families or {}).items():
+            limits.setdefault(family, {}).update(limit)
+        self.buckets = dict((family, TokenBucket(limit['rate'], limit['burst'], clock, sleep))
+                            for family, limit in limits.items())
+        self.max_attempts = max(int(max_attempts), 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.counters = dict((family, {'calls': 0, 'throttles': 0, 'retries': 0,
+                                       'waited_seconds': 0.0})
+                             for family in self.buckets)
+        self.lock = threading.Lock()
+
+    def register(self, client):
+        """
+        Hooks the throttle into an EC2 client, replacing botocore's retries.
+        """
+        prefix = client.meta.service_model.endpoint_prefix
+        events = client.meta.events
+        events.unregister('needs-retry.' + prefix, unique_id='retry-config-' + prefix)
+        events.register('before-parameter-build.' + prefix, self._add_client_token)
+        events.register('request-created.' + prefix, self._before_request)
+        events.register('needs-retry.' + prefix, self._needs_retry)
+        return client
+
+    def _count(self, family, counter, value=1):
+        """
+        Helper function: adds value to a counter of family.
+        """
+        with self.lock:
+            self.counters[family][counter] += value
+        METRICS.count('ec2_' + counter, value, family=family)
+
+    def _add_client_token(self, params, model, **kwargs):
+        """
+        Adds a ClientToken to calls accepting one, botocore sends the same
+        parameters on every retry so EC2 applies the call once.
+        """
+        if 'ClientToken' in model.input_shape.members and not params.get('ClientToken'):
+            params['ClientToken'] = str(uuid.uuid4())
+
+    def _before_request(self, operation_name, **kwargs):
+        """
+        Takes a token before every attempt.
+        """
+        family = api_family(operation_name)
+        waited = self.buckets[family].acquire()
+        self._count(family, 'calls')
+        if waited:
+            self._count(family, 'waited_seconds', waited)
+
+    def _needs_retry(self, attempts, operation, response=None, caught_exception=None,
+                     **kwargs):
+        """
+        Returns seconds to wait before retrying, None when the call is done.
+        """
+        family = api_family(operation.name)
+        code = None
+        if response is not None:
+            http_response, parsed = response
+            code = parsed.get('Error', {}).get('Code')
+            if code is None and http_response.status_code < 500:
+                self.buckets[family].succeeded()
+                return None
+            if code not in THROTTLE_CODES and code not in TRANSIENT_CODES and \
+                    http_response.status_code < 500:
+                return None
+        elif caught_exception is None:
+            return None
+        if code in THROTTLE_CODES:
+            self.buckets[family].throttled()
+            self._count(family, 'throttles')
+        if attempts >= self.max_attempts:
+            logger.warning("%s failed after %d attempts: %s", operation.name, attempts,
+                           code or caught_exception)
+            return None
+        self._count(family, 'retries')
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempts))
+        logger.info("%s failed (%s), retrying in %.2f seconds", operation.name,
+                    code or caught_exception, delay)
+        return delay
+
+    def stats(self):
+        """
+        Returns calls, throttles, retries, seconds waited for tokens and
+        current rate per API family.
+        """
+        with self.lock:
+            return dict((family, dict(counters, rate=self.buckets[family].rate))
+                        for family, counters in self.counters.items())
@@ -4,20 +4,28 @@ Boto interface
 
 import datetime
 import logging
-import boto3
+import threading
+from modules.aws_clients import AwsClients
+from modules.metrics import timed
 logger = logging.getLogger(__name__)
 
+NETWORK_TAG = 'trilio:network'
+SEC_GROUP_NAME = 'trilio_sg'
+
 class BotoAdapter(object):
     """
     Responsible for AWS operations..
     """
 
-    def __init__(self, region, key_pair):
-        self.vpc = None
-        self.vm_dict = None
+    def __init__(self, region, key_pair, aws_clients=None):
         self.key_pair = key_pair
-        self.ec2 = boto3.resource('ec2', region_name=region)
+        self.aws_clients = aws_clients or AwsClients(region)
+        self.ec2 = self.aws_clients.resource('ec2')
+        self.networks = {}
+        self.network_locks = {}
+        self.lock = threading.Lock()
 
+    @timed('register_ami')
     def register_ami(self, snapshot_id):
         """
         Register the AMI with the specified snapshot ID and parameters.
@@ -45,13 +53,13 @@ class BotoAdapter(object):
         return ami_id.id
 
 
-    def lanuch_instance(self, ami_id, snap_ids, vm_dict):
+    @timed('launch')
+    def lanuch_instance(self, ami_id, snap_ids, vm_dict, client_token=None):
         """
-        launch instace with specified amiId and other attributes
+        launch instace with specified amiId and other attributes, EC2 starts
+        one instance only for calls repeating a client_token
         """
-        self.vm_dict = vm_dict
-        subnet_id = self._create_vpc()
-        sg_id = self._create_sec_group()
+        network = self.get_network(vm_dict)
         snap_id_list = []
         for snap in snap_ids:
             if not snap.endswith("!@root_disk"):
@@ -66,10 +74,11 @@ class BotoAdapter(object):
                     },
                 }
             block_device_mappings.append(bdm)
+        idempotency = {'ClientToken': client_token} if client_token else {}
 
         instance = self.ec2.create_instances(
             ImageId=ami_id,
-            InstanceType=self.vm_dict.get('flavor'),
+            InstanceType=vm_dict.get('flavor'),
             MinCount=1, MaxCount=1,
             KeyName=self.key_pair,
             NetworkInterfaces=[
@@ -79,67 +88,120 @@ class BotoAdapter(object):
                     'Description': 'testing from boto3',
                     'DeviceIndex': 0,
                     'Groups': [
-                        sg_id,
+                        network['sg_id'],
                         ],
-                    'PrivateIpAddress': self.vm_dict.get('ip'),
-                    'SubnetId': subnet_id
+                    'PrivateIpAddress': vm_dict.get('ip'),
+                    'SubnetId': network['subnet_id']
                     },
                 ],
-            BlockDeviceMappings=block_device_mappings
+            BlockDeviceMappings=block_device_mappings,
+            **idempotency
             )
         return instance
 
-    def _create_vpc(self):
+    def reset_networks(self):
+        """
+        Forgets networks provisioned so far, they are looked up again by tag
+        """
+        with self.lock:
+            self.networks = {}
+            self.network_locks = {}
+
+    def get_network(self, vm_dict):
+        """
+        Returns vpc_id, subnet_id and sg_id of the network of vm_dict. Vms
+        with the same cidr, router and subnet share one network, which is
+        reused when the account already has it and created otherwise.
+        """
+        key = (vm_dict.get('cidr'), vm_dict.get('router_name'), vm_dict.get('subnet_name'))
+        with self.lock:
+            lock = self.network_locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self.networks:
+                self.networks[key] = self._provision_network(key)
+            return self.networks[key]
+
+    @timed('network_provision')
+    def _provision_network(self, key):
+        """
+        Helper function: finds or creates vpc, internet gateway, route table,
+        subnet and security group of network key
+        """
+        cidr, router_name, _ = key
+        tag = "|".join(str(part) for part in key)
+        vpcs = list(self.ec2.vpcs.filter(Filters=[
+            {'Name': 'tag:' + NETWORK_TAG, 'Values': [tag]},
+            {'Name': 'cidr', 'Values': [cidr]}]))
+        if vpcs:
+            vpc = vpcs[0]
+            logger.info("reusing VPC %s for network %s", vpc.id, tag)
+        else:
+            vpc = self._create_vpc(cidr, tag)
+        internet_gateways = list(vpc.internet_gateways.all())
+        subnets = list(vpc.subnets.filter(Filters=[{'Name': 'cidr-block', 'Values': [cidr]}]))
+        if subnets:
+            subnet_id = subnets[0].id
+        else:
+            internet_gateway = internet_gateways[0] if internet_gateways \
+                else self._create_and_attach_ig(vpc)
+            route_table = self._create_route_table(vpc, internet_gateway, router_name)
+            subnet_id = self._create_subnet(vpc, route_table, cidr)
+        sec_groups = list(vpc.security_groups.filter(
+            Filters=[{'Name': 'group-name', 'Values': [SEC_GROUP_NAME]}]))
+        sg_id = sec_groups[0].id if sec_groups else self._create_sec_group(vpc)
+        return {'vpc_id': vpc.id, 'subnet_id': subnet_id, 'sg_id': sg_id}
+
+    def _create_vpc(self, cidr, tag):
         """
         Create VPC
         """
-        vpc_cidr = self.vm_dict.get('cidr')
-        self.vpc = self.ec2.create_vpc(CidrBlock=vpc_cidr)
+        vpc = self.ec2.create_vpc(CidrBlock=cidr)
         #we can assign a name to vpc, or any resource, by using tag
-        self.vpc.create_tags(Tags=[{"Key": "Name", "Value": "Trilio_new"}])
-        self.vpc.wait_until_available()
-        internet_gateway = self._create_and_attach_ig()
-        route_table = self._create_route_table(internet_gateway)
-        subnet_id = self._create_subnet(route_table)
-        logger.info("VPC created with id : %s", self.vpc.id)
-        return subnet_id
-
-    def _create_and_attach_ig(self):
+        vpc.create_tags(Tags=[{"Key": "Name", "Value": "Trilio_new"},
+                              {"Key": NETWORK_TAG, "Value": tag}])
+        vpc.wait_until_available()
+        logger.info("VPC created with id : %s", vpc.id)
+        return vpc
+
+    def _create_and_attach_ig(self, vpc):
         '''
         # create then attach internet gateway
         '''
-        internet_gateway = self.ec2.create_internet_gateway('trilio_igw')
-        self.vpc.attach_internet_gateway(InternetGatewayId=internet_gateway.id)
+        internet_gateway = self.ec2.create_internet_gateway()
+        internet_gateway.create_tags(Tags=[{"Key": "Name", "Value": "trilio_igw"}])
+        vpc.attach_internet_gateway(InternetGatewayId=internet_gateway.id)
         logger.info("Internet gateway attached to VPC..")
         return  internet_gateway
 
-    def _create_route_table(self, internet_gateway, dest_cidr_bloack='0.0.0.0/0'):
+    def _create_route_table(self, vpc, internet_gateway, router_name,
+                            dest_cidr_bloack='0.0.0.0/0'):
         '''
         create a route table and a public route
         '''
-        route_table = self.vpc.create_route_table(self.vm_dict.get('router_name'))
+        route_table = vpc.create_route_table()
+        if router_name:
+            route_table.create_tags(Tags=[{"Key": "Name", "Value": router_name}])
         route_table.create_route(
             DestinationCidrBlock=dest_cidr_bloack,
             GatewayId=internet_gateway.id
         )
         return route_table
 
-    def _create_subnet(self, route_table):
+    def _create_subnet(self, vpc, route_table, cidr):
         '''
         create subnet
         '''
-        subnet_cidr = self.vm_dict.get('cidr')
-        subnet = self.ec2.create_subnet(CidrBlock=subnet_cidr, VpcId=self.vpc.id)
+        subnet = self.ec2.create_subnet(CidrBlock=cidr, VpcId=vpc.id)
         #associate the route table with the subnet
         route_table.associate_with_subnet(SubnetId=subnet.id)
         return subnet.id
 
-    def _create_sec_group(self):
+    def _create_sec_group(self, vpc):
         '''
         Create sec group
         '''
         sec_group = self.ec2.create_security_group(
-            GroupName='trilio_sg', Description='Trilio sec group', VpcId=self.vpc.id)
+            GroupName=SEC_GROUP_NAME, Description='Trilio sec group', VpcId=vpc.id)
         sec_group.authorize_ingress(
             CidrIp='0.0.0.0/0',
             IpProtocol='TCP',
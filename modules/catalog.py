@@ -0,0 +1,291 @@
+"""
+Vault catalog
+
+Persistent SQLite index of the trilio vault tree. Workloads, snapshots and
+the vm records resolved from each snapshot are stored together with the
+mtime and size of the files they were parsed from, so a refresh only
+re-parses the entries that changed on the vault mount.
+"""
+import os
+from os import path
+import json
+import logging
+import sqlite3
+import threading
+from modules.utils import get_data, load_snapshot, parallel_map, WorkloadException
+from modules.enumerator import iter_entries
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 2
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS workloads (
+        name TEXT PRIMARY KEY,
+        path TEXT,
+        db_mtime REAL,
+        db_size INTEGER,
+        data TEXT)""",
+    """CREATE TABLE IF NOT EXISTS snapshots (
+        workload TEXT,
+        name TEXT,
+        path TEXT,
+        id TEXT,
+        display_name TEXT,
+        time TEXT,
+        timestamp REAL,
+        db_mtime REAL,
+        db_size INTEGER,
+        data TEXT,
+        PRIMARY KEY (workload, name))""",
+    "CREATE INDEX IF NOT EXISTS snapshots_id ON snapshots (id)",
+    "CREATE INDEX IF NOT EXISTS snapshots_timestamp ON snapshots (workload, timestamp)",
+    """CREATE TABLE IF NOT EXISTS vm_sources (
+        snapshot_path TEXT PRIMARY KEY,
+        stamp TEXT)""",
+    """CREATE TABLE IF NOT EXISTS vms (
+        snapshot_path TEXT,
+        position INTEGER,
+        id TEXT,
+        name TEXT,
+        data TEXT,
+        PRIMARY KEY (snapshot_path, position))""",
+    """CREATE TABLE IF NOT EXISTS disks (
+        snapshot_path TEXT,
+        vm_id TEXT,
+        disk_path TEXT)""",
+    "CREATE INDEX IF NOT EXISTS disks_snapshot ON disks (snapshot_path)",
+]
+
+def file_stamp(filepath):
+    """
+    Returns (mtime, size) of given file or (None, None) if it is missing.
+    """
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None, None
+    return stat.st_mtime, stat.st_size
+
+class Catalog(object):
+    """
+    SQLite catalog of workloads, snapshots and vms.
+    """
+    def __init__(self, trilio_base_dir, catalog_path, workers=1):
+        """
+        constructor of Catalog class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param trilio_base_dir: Trilio vault base directory
+            type trilio_base_dir: str
+            param catalog_path: Path of the sqlite database file
+            type catalog_path: str
+            param workers: number of changed snapshot_db files loaded concurrently
+            type workers: int
+        """
+        self.base_dir = trilio_base_dir
+        self.catalog_path = catalog_path
+        self.workers = workers
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(catalog_path, check_same_thread=False)
+        with self.lock, self.conn:
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                # the catalog only caches the vault, older layouts are rebuilt
+                for table in ('workloads', 'snapshots', 'vm_sources', 'vms', 'disks'):
+                    self.conn.execute("DROP TABLE IF EXISTS {}".format(table))
+                self.conn.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        with self.lock:
+            self.conn.close()
+
+    def refresh_workloads(self):
+        """
+        Syncs workloads table with the vault directory, re-parses only the
+        workload_db files whose mtime or size changed. Returns number of
+        re-parsed workloads.
+        """
+        try:
+            names = [name for name, _ in iter_entries(self.base_dir, "workload_", sort=False)]
+        except OSError as err:
+            raise WorkloadException(err)
+        with self.lock:
+            known = dict(((row[0], (row[1], row[2])) for row in self.conn.execute(
+                "SELECT name, db_mtime, db_size FROM workloads")))
+            parsed = 0
+            with self.conn:
+                for name in names:
+                    workload_path = path.join(self.base_dir, name)
+                    workload_db_path = path.join(workload_path, 'workload_db')
+                    stamp = file_stamp(workload_db_path)
+                    if known.get(name) == stamp:
+                        continue
+                    data = get_data(workload_db_path) if stamp[0] is not None else {}
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO workloads VALUES (?, ?, ?, ?, ?)",
+                        (name, workload_path, stamp[0], stamp[1], json.dumps(data)))
+                    parsed += 1
+                for name in set(known) - set(names):
+                    self._forget_workload(name)
+        if parsed:
+            logger.info("catalog re-parsed %s workload(s)", parsed)
+        return parsed
+
+    def refresh_snapshots(self, workload):
+        """
+        Syncs snapshots of given workload with the vault directory, re-parses
+        only the snapshot_db files whose mtime or size changed. Returns number
+        of re-parsed snapshots.
+        """
+        workload_path = path.join(self.base_dir, workload)
+        try:
+            names = [name for name, _ in iter_entries(workload_path, "snapshot_", sort=False)]
+        except OSError as err:
+            raise WorkloadException(err)
+        with self.lock:
+            known = dict(((row[0], (row[1], row[2])) for row in self.conn.execute(
+                "SELECT name, db_mtime, db_size FROM snapshots WHERE workload = ?",
+                (workload,))))
+            changed = []
+            for name in sorted(names):
+                stamp = file_stamp(path.join(workload_path, name, 'snapshot_db'))
+                if stamp[0] is not None and known.get(name) != stamp:
+                    changed.append((name, stamp))
+            records = parallel_map(load_snapshot,
+                                   [path.join(workload_path, name) for name, _ in changed],
+                                   self.workers)
+            parsed = len(records)
+            with self.conn:
+                for (name, stamp), record in zip(changed, records):
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (workload, name, record.get('path'), record.get('id'),
+                         record.get('display_name'), record.get('time'),
+                         record.get('timestamp'), stamp[0], stamp[1], json.dumps(record)))
+                for name in set(known) - set(names):
+                    self._forget_snapshot(workload, name)
+        if parsed:
+            logger.info("catalog re-parsed %s snapshot(s) of %s", parsed, workload)
+        return parsed
+
+    def rebuild(self):
+        """
+        Drops every cached entry and indexes the whole vault again.
+        Returns number of indexed snapshots.
+        """
+        with self.lock:
+            with self.conn:
+                for table in ('workloads', 'snapshots', 'vm_sources', 'vms', 'disks'):
+                    self.conn.execute("DELETE FROM {}".format(table))
+            self.refresh_workloads()
+            return sum(self.refresh_snapshots(workload)
+                       for workload in self.get_workloads())
+
+    def get_workloads(self, prefix='', offset=0, limit=None):
+        """
+        Returns page of indexed workload names whose id starts with prefix.
+        """
+        with self.lock:
+            return [row[0] for row in self.conn.execute(
+                "SELECT name FROM workloads WHERE substr(name, 1, ?) = ? "
+                "ORDER BY name LIMIT ? OFFSET ?",
+                (len("workload_" + prefix), "workload_" + prefix,
+                 -1 if limit is None else limit, offset))]
+
+    def get_workload(self, workload):
+        """
+        Returns workload_db data of given workload or None.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data FROM workloads WHERE name = ?", (workload,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_snapshots(self, workload, prefix='', offset=0, limit=None):
+        """
+        Returns page of snapshot dictionaries of given workload ordered by
+        name, whose id starts with prefix.
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT data FROM snapshots WHERE workload = ? AND substr(name, 1, ?) = ? "
+                "ORDER BY name LIMIT ? OFFSET ?",
+                (workload, len("snapshot_" + prefix), "snapshot_" + prefix,
+                 -1 if limit is None else limit, offset)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get_latest_snapshots(self, workload, count=1):
+        """
+        Returns the count most recently updated snapshots of given workload,
+        newest first.
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT data FROM snapshots WHERE workload = ? "
+                "ORDER BY timestamp DESC LIMIT ?", (workload, count)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get_vms(self, snapshot_path, stamp):
+        """
+        Returns cached vm dictionaries of given snapshot if they were built
+        from the same snapshot_vms_db/resources_db stamp, otherwise None.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT stamp FROM vm_sources WHERE snapshot_path = ?",
+                (snapshot_path,)).fetchone()
+            if not row or row[0] != json.dumps(stamp):
+                return None
+            rows = self.conn.execute(
+                "SELECT data FROM vms WHERE snapshot_path = ? ORDER BY position",
+                (snapshot_path,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def store_vms(self, snapshot_path, stamp, vms):
+        """
+        Stores vm dictionaries and their disk paths for given snapshot.
+        """
+        with self.lock, self.conn:
+            self._forget_vms(snapshot_path)
+            self.conn.execute("INSERT INTO vm_sources VALUES (?, ?)",
+                              (snapshot_path, json.dumps(stamp)))
+            for position, vm_dict in enumerate(vms):
+                self.conn.execute(
+                    "INSERT INTO vms VALUES (?, ?, ?, ?, ?)",
+                    (snapshot_path, position, vm_dict.get('id'),
+                     vm_dict.get('name'), json.dumps(vm_dict)))
+                for disk in vm_dict.get('disks', []):
+                    self.conn.execute("INSERT INTO disks VALUES (?, ?, ?)",
+                                      (snapshot_path, vm_dict.get('id'), disk))
+
+    def _forget_workload(self, workload):
+        """
+        Helper function: removes workload and everything indexed under it.
+        """
+        self.conn.execute("DELETE FROM workloads WHERE name = ?", (workload,))
+        for row in self.conn.execute(
+                "SELECT name FROM snapshots WHERE workload = ?", (workload,)).fetchall():
+            self._forget_snapshot(workload, row[0])
+
+    def _forget_snapshot(self, workload, snapshot):
+        """
+        Helper function: removes snapshot and its vms.
+        """
+        self.conn.execute("DELETE FROM snapshots WHERE workload = ? AND name = ?",
+                          (workload, snapshot))
+        self._forget_vms(path.join(self.base_dir, workload, snapshot))
+
+    def _forget_vms(self, snapshot_path):
+        """
+        Helper function: removes vms and disks of given snapshot.
+        """
+        for table in ('vm_sources', 'vms', 'disks'):
+            self.conn.execute(
+                "DELETE FROM {} WHERE snapshot_path = ?".format(table), (snapshot_path,))
@@ -0,0 +1,224 @@
+"""
+Conversion cache
+
+Remembers which raw files were converted from which qcow2 disks. A raw
+file is reused only when its source still has the recorded size, mtime
+and, optionally, sampled hash, and the raw file still has the recorded
+size and mtime. Entries live in a JSON manifest next to their output size
+and checksum, and least recently used raw files are evicted once the cache
+grows past its size budget.
+"""
+import os
+import time
+import hashlib
+import logging
+import threading
+from modules.utils import get_data, load_data, ImageConverterException
+from modules.sparse import SparseFile
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+def _stamp(mtime):
+    """
+    Helper function: mtime as string, exact through any JSON decoder.
+    """
+    return '{:.6f}'.format(mtime)
+
+def file_checksum(raw_disk, algorithm='md5'):
+    """
+    Returns checksum of raw_disk, holes are hashed without being read.
+    """
+    digest = hashlib.new(algorithm)
+    with SparseFile(raw_disk) as raw_file:
+        while True:
+            chunk = raw_file.read(4 * MB)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ConversionCache(object):
+    """
+    Manifest of converted raw files keyed by source identity.
+    """
+    def __init__(self, manifest_path, max_mb=None, sample_hash=False, samples=16,
+                 sample_size=64 * 1024, checksum='md5', verify=False):
+        """
+        constructor of ConversionCache class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param manifest_path: JSON manifest of cached raw files
+            type manifest_path: str
+            param max_mb: size budget of cached raw files, unbounded if None
+            type max_mb: int
+            param sample_hash: adds a hash of sampled source blocks to the identity
+            type sample_hash: bool
+            param samples: number of blocks sampled across the source
+            type samples: int
+            param sample_size: bytes per sampled block
+            type sample_size: int
+            param checksum: hashlib algorithm of raw file checksums, None skips them
+            type checksum: str
+            param verify: recomputes the checksum before a raw file is reused
+            type verify: bool
+        """
+        self.manifest_path = manifest_path
+        self.max_bytes = None if max_mb is None else int(max_mb * MB)
+        self.sample_hash = sample_hash
+        self.samples = max(int(samples), 1)
+        self.sample_size = int(sample_size)
+        if checksum:
+            try:
+                hashlib.new(checksum)
+            except ValueError:
+                raise ImageConverterException("unknown checksum {}".format(checksum))
+        self.checksum = checksum
+        self.verify = verify and bool(checksum)
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.pinned = {}
+        if os.path.exists(manifest_path):
+            try:
+                self.entries = dict((raw_disk, dict(entry)) for raw_disk, entry
+                                    in get_data(manifest_path).items())
+            except ValueError:
+                logger.warning("conversion cache manifest %s is corrupt, starting empty",
+                               manifest_path)
+
+    def source_identity(self, disk):
+        """
+        Returns identity of a source disk: size, mtime and optional sampled hash.
+        """
+        stat = os.stat(disk)
+        identity = {'size': stat.st_size, 'mtime': _stamp(stat.st_mtime)}
+        if self.sample_hash:
+            digest = hashlib.sha1()
+            step = max(stat.st_size // self.samples, self.sample_size)
+            with open(disk, 'rb') as disk_file:
+                for offset in range(0, stat.st_size, step):
+                    disk_file.seek(offset)
+                    digest.update(disk_file.read(self.sample_size))
+            identity['sample'] = digest.hexdigest()
+        return identity
+
+    def file_checksum(self, raw_disk):
+        """
+        Returns checksum of raw_disk, holes are hashed without being read.
+        """
+        return file_checksum(raw_disk, self.checksum)
+
+    def recorded_checksum(self, raw_disk):
+        """
+        Returns (algorithm, checksum) recorded for raw_disk, None when the
+        cache has none.
+        """
+        with self.lock:
+            entry = self.entries.get(raw_disk) or {}
+        if not entry.get('checksum'):
+            return None
+        return entry['checksum_type'], entry['checksum']
+
+    def lookup(self, disk, raw_disk):
+        """
+        Returns True when raw_disk is a complete conversion of disk as it is now.
+        """
+        with self.lock:
+            entry = self.entries.get(raw_disk)
+        if not entry or entry.get('source_path') != disk:
+            return False
+        try:
+            raw_stat = os.stat(raw_disk)
+            if entry['source'] != self.source_identity(disk):
+                logger.info("source %s changed since %s was converted", disk, raw_disk)
+                return False
+        except OSError:
+            return False
+        if (raw_stat.st_size, _stamp(raw_stat.st_mtime)) != \
+                (entry['raw_size'], entry['raw_mtime']):
+            logger.info("raw file %s changed since it was converted", raw_disk)
+            return False
+        if self.verify and entry.get('checksum') != self.file_checksum(raw_disk):
+            logger.warning("checksum of raw file %s does not match", raw_disk)
+            return False
+        with self.lock:
+            entry['used_at'] = time.time()
+            self._save()
+        return True
+
+    def store(self, disk, raw_disk):
+        """
+        Records raw_disk, fully written and renamed into place, as conversion of disk.
+        """
+        raw_stat = os.stat(raw_disk)
+        entry = {
+            'source_path': disk,
+            'source': self.source_identity(disk),
+            'raw_size': raw_stat.st_size,
+            'raw_mtime': _stamp(raw_stat.st_mtime),
+            'checksum_type': self.checksum,
+            'checksum': self.file_checksum(raw_disk) if self.checksum else None,
+            'used_at': time.time(),
+        }
+        with self.lock:
+            self.entries[raw_disk] = entry
+            self._save()
+        return entry
+
+    def pin(self, raw_disks):
+        """
+        Protects raw_disks from eviction until they are released, e.g. while
+        they wait for their upload.
+        """
+        with self.lock:
+            for raw_disk in raw_disks:
+                self.pinned[raw_disk] = self.pinned.get(raw_disk, 0) + 1
+
+    def release(self, raw_disks):
+        """
+        Drops one pin of every raw disk in raw_disks.
+        """
+        with self.lock:
+            for raw_disk in raw_disks:
+                count = self.pinned.get(raw_disk, 0) - 1
+                if count > 0:
+                    self.pinned[raw_disk] = count
+                else:
+                    self.pinned.pop(raw_disk, None)
+
+    def evict(self, keep=()):
+        """
+        Removes least recently used raw files until the cache fits max_mb,
+        raw files in keep or pinned are never removed.
+        """
+        if self.max_bytes is None:
+            return []
+        evicted = []
+        with self.lock:
+            total = sum(entry['raw_size'] for entry in self.entries.values())
+            for raw_disk, entry in sorted(self.entries.items(),
+                                          key=lambda item: item[1]['used_at']):
+                if total <= self.max_bytes:
+                    break
+                if raw_disk in keep or raw_disk in self.pinned:
+                    continue
+                if os.path.exists(raw_disk):
+                    os.remove(raw_disk)
+                del self.entries[raw_disk]
+                total -= entry['raw_size']
+                evicted.append(raw_disk)
+            if evicted:
+                logger.info("evicted raw files %s", evicted)
+                self._save()
+        return evicted
+
+    def _save(self):
+        """
+        Helper function: writes the manifest to a temp file and renames it
+        into place.
+        """
+        partial = self.manifest_path + '.partial'
+        load_data(partial, self.entries)
+        os.rename(partial, self.manifest_path)
@@ -0,0 +1,339 @@
+"""
+Conversion scheduler
+
+Runs qemu-img for several disks at once. Conversions are bounded by
+cpu_workers (concurrent qemu-img convert processes) and every process that
+reads the vault, info probes included, by io_workers. Progress and timing
+are reported per disk, together with the allocated and virtual size of
+every disk taken from its allocation map. With engine 'native' (or 'auto'
+when qemu-img is not installed) disks are read in process by modules.qcow2
+instead.
+"""
+import os
+import re
+import json
+import time
+import logging
+import subprocess
+import threading
+from distutils.spawn import find_executable
+from modules.utils import parallel_map, ImageConverterException
+from modules.sparse import AllocationMap
+from modules import qcow2
+from modules.metrics import METRICS, timed
+
+logger = logging.getLogger(__name__)
+
+PROGRESS = re.compile(r'\((\d+(?:\.\d+)?)/100%\)')
+
+class ConversionScheduler(object):
+    """
+    Converts qcow2 images to raw with bounded parallelism.
+    """
+    def __init__(self, cpu_workers=2, io_workers=4, coroutines=8, src_cache=None,
+                 dest_cache=None, out_of_order=True, qemu_img='qemu-img',
+                 progress_callback=None, sparse_size='4k', engine='qemu-img'):
+        """
+        constructor of ConversionScheduler class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param cpu_workers: maximum concurrent qemu-img convert processes
+            type cpu_workers: int
+            param io_workers: maximum concurrent qemu-img processes reading the vault
+            type io_workers: int
+            param coroutines: qemu-img convert -m parallel coroutines per disk
+            type coroutines: int
+            param src_cache: qemu-img convert -T source cache mode, e.g. 'none'
+            type src_cache: str
+            param dest_cache: qemu-img convert -t destination cache mode, e.g. 'unsafe'
+            type dest_cache: str
+            param out_of_order: passes -W to let qemu-img write out of order
+            type out_of_order: bool
+            param qemu_img: qemu-img executable, looked up on PATH
+            type qemu_img: str
+            param progress_callback: called with (disk, percent) while converting
+            type progress_callback: callable
+            param sparse_size: qemu-img convert -S zero run size left as a hole
+                               in raw output, None for qemu-img's default
+            type sparse_size: str
+            param engine: 'qemu-img', 'native' for the in process qcow2 reader
+                          or 'auto' to use qemu-img when it is installed
+            type engine: str
+        """
+        self.cpu_workers = max(int(cpu_workers), 1)
+        self.io_slots = threading.Semaphore(max(int(io_workers), 1))
+        self.io_workers = max(int(io_workers), 1)
+        self.coroutines = coroutines
+        self.src_cache = src_cache
+        self.dest_cache = dest_cache
+        self.out_of_order = out_of_order
+        self.qemu_img = qemu_img
+        self.progress_callback = progress_callback
+        self.sparse_size = sparse_size
+        if engine not in ('qemu-img', 'native', 'auto'):
+            raise ImageConverterException("unknown conversion engine {}".format(engine))
+        self.native = engine == 'native' or (engine == 'auto' and not find_executable(qemu_img))
+        self.reports = {}
+        self.lock = threading.Lock()
+
+    def convert_command(self, disk, raw_disk_name):
+        """
+        Returns qemu-img convert command line for given disk.
+        """
+        cmd = [self.qemu_img, "convert", "-p", "-O", "raw"]
+        if self.coroutines and int(self.coroutines) > 1:
+            cmd += ["-m", str(self.coroutines)]
+            if self.out_of_order:
+                cmd.append("-W")
+        if self.src_cache:
+            cmd += ["-T", self.src_cache]
+        if self.dest_cache:
+            cmd += ["-t", self.dest_cache]
+        if self.sparse_size:
+            cmd += ["-S", str(self.sparse_size)]
+        return cmd + [disk, raw_disk_name]
+
+    def window_command(self, disk, disk_format, offset, size, output):
+        """
+        Returns qemu-img convert command line converting only the guest
+        visible byte range [offset, offset + size) of given disk, using the
+        raw driver's offset/size options on top of the disk's format driver.
+        """
+        image_opts = "driver=raw,offset={},size={},file.driver={},"\
+            "file.file.driver=file,file.file.filename={}".format(
+                offset, size, disk_format, disk.replace(',', ',,'))
+        cmd = [self.qemu_img, "convert", "-O", "raw", "--image-opts", image_opts]
+        if self.coroutines and int(self.coroutines) > 1:
+            cmd += ["-m", str(self.coroutines)]
+        if self.src_cache:
+            cmd += ["-T", self.src_cache]
+        if self.sparse_size:
+            cmd += ["-S", str(self.sparse_size)]
+        return cmd + [output]
+
+    def convert_window(self, disk, disk_format, offset, size, output):
+        """
+        Converts guest visible byte range of given disk into output raw file.
+        """
+        if self.native:
+            with self.io_slots, qcow2.open_image(disk, disk_format) as image:
+                qcow2.write_raw(image, output, offset, size)
+            return
+        cmd = self.window_command(disk, disk_format, offset, size, output)
+        with self.io_slots:
+            qemu_convert = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            _, err = qemu_convert.communicate()
+        if qemu_convert.returncode:
+            raise ImageConverterException("qemu-img convert failed for {} at {}: {}".format(
+                disk, offset, err))
+
+    def info(self, disk):
+        """
+        Returns qemu-img info of given disk as dictionary.
+        """
+        if self.native:
+            with self.io_slots:
+                start = time.time()
+                with qcow2.open_image(disk) as image:
+                    info = image.info()
+            self._report(disk, info_seconds=time.time() - start,
+                         virtual_size=info['virtual-size'])
+            return info
+        with self.io_slots:
+            start = time.time()
+            qemu_info = subprocess.Popen([self.qemu_img, "info", "--output=json", disk], \
+                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = qemu_info.communicate()
+        logger.info("output %s", out)
+        if qemu_info.returncode:
+            raise ImageConverterException(
+                "qemu-img info failed for {}: {}".format(disk, err))
+        try:
+            info = json.loads(out)
+        except ValueError:
+            info = {}
+        self._report(disk, info_seconds=time.time() - start,
+                     virtual_size=info.get('virtual-size'))
+        return info
+
+    def map(self, disk, virtual_size=None):
+        """
+        Returns AllocationMap of given disk built from qemu-img map, None when
+        the map can not be read.
+        """
+        if self.native:
+            with self.io_slots:
+                start = time.time()
+                with qcow2.open_image(disk) as image:
+                    allocation = AllocationMap(image.map(), image.size)
+            self._report(disk, map_seconds=time.time() - start,
+                         allocated_size=allocation.allocated_bytes)
+            return allocation
+        with self.io_slots:
+            start = time.time()
+            qemu_map = subprocess.Popen([self.qemu_img, "map", "--output=json", disk], \
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = qemu_map.communicate()
+        if qemu_map.returncode:
+            logger.warning("qemu-img map failed for %s: %s", disk, err)
+            return None
+        try:
+            extents = json.loads(out)
+        except ValueError:
+            logger.warning("qemu-img map of %s is not json", disk)
+            return None
+        if virtual_size is None:
+            virtual_size = max([extent['start'] + extent['length'] for extent in extents] or [0])
+        allocation = AllocationMap(extents, virtual_size)
+        self._report(disk, map_seconds=time.time() - start,
+                     allocated_size=allocation.allocated_bytes)
+        return allocation
+
+    @timed('probe')
+    def probe(self, disk):
+        """
+        Returns qemu-img info of given disk and records its allocation map.
+        """
+        info = self.info(disk)
+        self.map(disk, info.get('virtual-size'))
+        return info
+
+    def convert(self, disk, raw_disk_name):
+        """
+        Converts given disk to raw_disk_name, reporting progress as it goes.
+        """
+        if self.native:
+            self._convert_native(disk, raw_disk_name)
+            return
+        cmd = self.convert_command(disk, raw_disk_name)
+        with self.io_slots:
+            start = time.time()
+            logger.info("converting %s", " ".join(cmd))
+            qemu_convert = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stderr = []
+            reader = threading.Thread(target=lambda: stderr.append(qemu_convert.stderr.read()))
+            reader.daemon = True
+            reader.start()
+            self._follow_progress(disk, qemu_convert.stdout)
+            qemu_convert.wait()
+            reader.join()
+        seconds = time.time() - start
+        if qemu_convert.returncode:
+            if os.path.exists(raw_disk_name):
+                os.remove(raw_disk_name)
+            raise ImageConverterException("qemu-img convert failed for {}: {}".format(
+                disk, b"".join(stderr)))
+        self._report(disk, convert_seconds=seconds, raw_disk=raw_disk_name)
+        logger.info("Image %s converted in %.2f seconds", disk, seconds)
+
+    def _convert_native(self, disk, raw_disk_name):
+        """
+        Helper function: converts given disk with the in process qcow2 reader.
+        """
+        reported = [-10.0]
+
+        def progress(percent):
+            """
+            Reports progress like _follow_progress.
+            """
+            self._report(disk, percent=percent)
+            if self.progress_callback:
+                self.progress_callback(disk, percent)
+            if percent - reported[0] >= 10.0:
+                reported[0] = percent
+                logger.info("converting %s %.0f%%", disk, percent)
+
+        with self.io_slots:
+            start = time.time()
+            logger.info("converting %s natively", disk)
+            try:
+                with qcow2.open_image(disk) as image:
+                    qcow2.write_raw(image, raw_disk_name, progress=progress)
+            except (IOError, OSError, ImageConverterException) as err:
+                if os.path.exists(raw_disk_name):
+                    os.remove(raw_disk_name)
+                raise ImageConverterException("native convert failed for {}: {}".format(
+                    disk, err))
+        seconds = time.time() - start
+        self._report(disk, convert_seconds=seconds, raw_disk=raw_disk_name)
+        logger.info("Image %s converted in %.2f seconds", disk, seconds)
+
+    def _reuse(self, disk, raw_disk_name, cache):
+        """
+        Helper function: True when cache vouches for the raw file of disk.
+        """
+        if cache is not None and cache.lookup(disk, raw_disk_name):
+            logger.info("raw file is up to date, Hence skipping the convertion..")
+            self._report(disk, skipped=True, raw_disk=raw_disk_name)
+            return True
+        return False
+
+    def run(self, disk_files, raw_name=lambda disk: disk + '.raw', cache=None):
+        """
+        Probes and converts given disks, returns raw disk names in input order.
+        Each raw file is written under a temporary name and renamed into
+        place once complete. Disks whose raw file cache.lookup() accepts are
+        not converted again, without a cache every disk is converted. The
+        raw files stay pinned in the cache until the caller releases them.
+        """
+        raw_disks = [raw_name(disk) for disk in disk_files]
+        if cache is not None:
+            cache.pin(raw_disks)
+
+        def convert(disk):
+            """
+            Converts disk to a temporary file and moves it into place.
+            """
+            raw_disk_name = raw_name(disk)
+            partial = raw_disk_name + '.partial'
+            with METRICS.timer('convert', engine='native' if self.native else 'qemu-img') \
+                    as timer:
+                self.convert(disk, partial)
+                timer.bytes = os.path.getsize(partial)
+            os.rename(partial, raw_disk_name)
+            self._report(disk, skipped=False, raw_disk=raw_disk_name)
+            if cache is not None:
+                cache.store(disk, raw_disk_name)
+
+        try:
+            parallel_map(self.probe, disk_files, self.io_workers)
+            pending = [disk for disk in disk_files
+                       if not self._reuse(disk, raw_name(disk), cache)]
+            parallel_map(convert, pending, self.cpu_workers)
+        except Exception:
+            if cache is not None:
+                cache.release(raw_disks)
+            raise
+        if cache is not None:
+            cache.evict(keep=raw_disks)
+        return raw_disks
+
+    def _follow_progress(self, disk, stream):
+        """
+        Helper function: parses qemu-img -p output and reports every 10%.
+        """
+        reported = -10.0
+        buf = b""
+        while True:
+            chunk = os.read(stream.fileno(), 4096)
+            if not chunk:
+                break
+            buf = (buf + chunk)[-256:]
+            matches = PROGRESS.findall(buf.decode('ascii', 'ignore'))
+            if not matches:
+                continue
+            percent = float(matches[-1])
+            self._report(disk, percent=percent)
+            if self.progress_callback:
+                self.progress_callback(disk, percent)
+            if percent - reported >= 10.0:
+                reported = percent
+                logger.info("converting %s %.0f%%", disk, percent)
+
+    def _report(self, disk, **values):
+        """
+        Helper function: updates per disk report.
+        """
+        with self.lock:
+            self.reports.setdefault(disk, {}).update(values)
@@ -0,0 +1,134 @@
+"""
+Upload digests
+
+Hashes upload parts while they are read for sending, so integrity costs CPU
+in the upload threads (hashlib releases the GIL on large buffers) instead
+of another read of the disk. Every part gets an MD5, checked against the
+ETag S3 returns, and a SHA-256. Whole objects get the S3 style multipart
+ETag and a SHA-256 over the part SHA-256s.
+"""
+import re
+import hashlib
+import binascii
+from modules.utils import ImageConverterException
+
+PLAIN_ETAG = re.compile(r'^[0-9a-f]{32}$')
+MULTIPART_ETAG = re.compile(r'^[0-9a-f]{32}-\d+$')
+
+class DigestReader(object):
+    """
+    File object wrapper hashing every byte the first time it is read.
+    Bytes read again after a seek back, e.g. by a retried request, are not
+    hashed twice.
+    """
+    def __init__(self, fileobj):
+        """
+        constructor of DigestReader class
+        """
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.hashed = 0
+
+    def read(self, size=-1):
+        """
+        Reads from the wrapped file, hashing bytes not hashed before.
+        """
+        position = self.fileobj.tell()
+        data = self.fileobj.read(size)
+        end = position + len(data)
+        if position <= self.hashed < end:
+            fresh = data[self.hashed - position:]
+            self.md5.update(fresh)
+            self.sha256.update(fresh)
+            self.hashed = end
+        return data
+
+    def seek(self, offset, whence=0):
+        """
+        Seeks the wrapped file.
+        """
+        return self.fileobj.seek(offset, whence)
+
+    def tell(self):
+        """
+        Returns position in the wrapped file.
+        """
+        return self.fileobj.tell()
+
+    def hexdigests(self):
+        """
+        Returns size, md5 and sha256 of the whole file, hashing whatever
+        was not read yet.
+        """
+        self.fileobj.seek(self.hashed)
+        while self.read(1024 * 1024):
+            pass
+        return {'size': self.hashed, 'md5': self.md5.hexdigest(),
+                'sha256': self.sha256.hexdigest()}
+
+ZERO_DIGESTS = {}
+
+def zero_digests(size):
+    """
+    Returns digests of size zero bytes, computed once per size.
+    """
+    if size not in ZERO_DIGESTS:
+        zeros = b'\0' * size
+        ZERO_DIGESTS[size] = {'size': size, 'md5': hashlib.md5(zeros).hexdigest(),
+                              'sha256': hashlib.sha256(zeros).hexdigest()}
+    return dict(ZERO_DIGESTS[size])
+
+def etag_matches(etag, md5):
+    """
+    True unless etag is a plain MD5 different from md5. ETags of encrypted
+    objects are not MD5s and can not be checked.
+    """
+    etag = etag.strip('"')
+    return not PLAIN_ETAG.match(etag) or etag == md5
+
+def object_digests(parts, part_size, multipart=True):
+    """
+    Returns whole object digests from the digests of its parts in order.
+    """
+    if multipart:
+        etag = hashlib.md5(b''.join(binascii.unhexlify(part['md5']) for part in parts))\
+            .hexdigest() + '-{}'.format(len(parts))
+    else:
+        etag = parts[0]['md5']
+    return {
+        'size': sum(part['size'] for part in parts),
+        'part_size': part_size,
+        'etag': etag,
+        'sha256_tree': hashlib.sha256(b''.join(binascii.unhexlify(part['sha256'])
+                                               for part in parts)).hexdigest(),
+        'parts': parts,
+    }
+
+def object_etag_matches(etag, digests):
+    """
+    True unless etag is a multipart or plain ETag different from the one
+    computed from the parts.
+    """
+    etag = etag.strip('"')
+    if MULTIPART_ETAG.match(etag) or PLAIN_ETAG.match(etag):
+        return etag == digests['etag']
+    return True
+
+def check_part(etag, digest, name):
+    """
+    Raises ImageConverterException when the ETag S3 returned for a part
+    shows other bytes were stored than were sent.
+    """
+    if not etag_matches(etag, digest['md5']):
+        raise ImageConverterException("ETag {} of part {} of {} does not match md5 {}"\
+            .format(etag, digest['number'], name, digest['md5']))
+
+def check_object(etag, digests, name):
+    """
+    Raises ImageConverterException when the ETag of a completed upload does
+    not match its parts.
+    """
+    if not object_etag_matches(etag, digests):
+        raise ImageConverterException("ETag {} of {} does not match uploaded parts {}"\
+            .format(etag, name, digests['etag']))
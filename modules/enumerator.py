@@ -0,0 +1,59 @@
+"""
+Vault enumerator
+
+Lists the first level of workload and snapshot directories with scandir,
+which reports directory entries without a stat per entry on most
+filesystems, and pages through them without building full record lists.
+"""
+import os
+import itertools
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def _iter_dirs(directory):
+    """
+    Helper function: yields (name, path) of sub directories.
+    """
+    if scandir is None:
+        for name in os.listdir(directory):
+            entry_path = os.path.join(directory, name)
+            if os.path.isdir(entry_path):
+                yield name, entry_path
+        return
+    for entry in scandir(directory):
+        if entry.is_dir():
+            yield entry.name, entry.path
+
+def iter_entries(directory, prefix, sort=True, reverse=False, offset=0, limit=None):
+    """
+    Yields (name, path) of sub directories whose name starts with prefix.
+
+    - **parameters**, **types**, **return** and **return types**::
+
+        param directory: directory to list
+        type directory: str
+        param prefix: name prefix filter, e.g. "snapshot_" or "workload_ab"
+        type prefix: str
+        param sort: yields in name order, otherwise in directory order which
+                    stops reading the directory once the page is filled
+        type sort: bool
+        param reverse: reverse name order
+        type reverse: bool
+        param offset: number of matching entries to skip
+        type offset: int
+        param limit: maximum number of entries, all when None
+        type limit: int
+        returns entries:
+        type: generator
+    """
+    entries = ((name, entry_path) for name, entry_path in _iter_dirs(directory)
+               if name.startswith(prefix))
+    if sort:
+        entries = iter(sorted(entries, reverse=reverse))
+    stop = None if limit is None else offset + limit
+    return itertools.islice(entries, offset, stop)
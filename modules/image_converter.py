@@ -2,105 +2,202 @@
 Image converter module
 """
 import os
-import subprocess
-import json
 import logging
-from modules.utils import load_data
+from modules.aws_clients import AwsClients
+from modules.conversion_scheduler import ConversionScheduler
+from modules.conversion_cache import ConversionCache
+from modules.s3_stream import StreamingUploader, MB
+from modules.s3_upload import MultipartUploader
+from modules.import_tracker import ImportTracker
+from modules.metrics import timed
 
 logger = logging.getLogger(__name__)
+
 class ImageConverter(object):
     """
     Converts qcow2 image to raw format.
     """
-    def __init__(self, bucket, region, container_json_path):
+    def __init__(self, bucket, region, container_json_path, convert_options=None,
+                 stream_options=None, s3_endpoint_url=None, cache_options=None,
+                 upload_options=None, import_options=None, aws_clients=None):
         """
         Initilaization Image converter.
+
+        convert_options are passed to ConversionScheduler, e.g. cpu_workers,
+        io_workers, coroutines, src_cache and dest_cache. stream_options
+        configure stream_disks_to_s3: part_size_mb, workers and scratch_dir.
+        s3_endpoint_url points uploads at an S3 compatible service.
+        cache_options configure the ConversionCache which decides whether a
+        raw file can be reused, e.g. manifest_path and max_mb. Without a
+        manifest_path every disk is converted. upload_options configure
+        copy_disks_to_s3: part_size_mb, threads (parts per disk), disks
+        (disks at once) and max_attempts per part. import_options configure
+        the ImportTracker polling of create_snapshots: min_poll_seconds,
+        max_poll_seconds, backoff and timeout_minutes. aws_clients is the
+        shared AwsClients factory, one for region and s3_endpoint_url is
+        created when None.
         """
         self.bucket = bucket
         self.region = region
         self.container_json_path = container_json_path
+        self.scheduler = ConversionScheduler(**(convert_options or {}))
+        self.stream_options = stream_options or {}
+        self.s3_endpoint_url = s3_endpoint_url
+        self.stream_reports = {}
+        self.upload_options = upload_options or {}
+        self.upload_reports = {}
+        self.digests = {}
+        self.import_options = import_options or {}
+        self.aws_clients = aws_clients or AwsClients(region, {'s3': s3_endpoint_url})
+        self.cache = None
+        if cache_options and cache_options.get('manifest_path'):
+            self.cache = ConversionCache(**cache_options)
 
-    def create_snapshot(self, disk):
+    def _root_marker(self, disk):
         """
-        creates snapshot
+        Helper function: returns '!@root_disk' for the root disk, else ''.
         """
-        disk_split = disk.split('/')
-        disk_name = disk_split[-1]
-        root_disk = None
         #Assuming sda as root partition
-        if disk_split[-2].endswith('sda'):
-            root_disk = '!@root_disk'
-        url = "https://s3-{}.amazonaws.com/{}/{}".format(self.region, self.bucket, disk_name)
-        container_json = {
-            'Url':url,
-            'Description':"Example image originally in QCOW2 format",
-            'Format':'raw'
-            }
-        load_data(self.container_json_path, container_json)
-        description = "trilio_" + disk_name[:-4]
-        logger.info("snap shot intilization started...")
-        cmd = "aws ec2 import-snapshot --description {} \
-        --disk-container file://{}".format(description, self.container_json_path)
-        imp_snap = os.popen(cmd)
-        get_snap_id = imp_snap.read()
-        snap_id = json.loads(get_snap_id)
-        task_id = snap_id.get("ImportTaskId")
-        logger.info("Imported Task Id is: %s", task_id)
-        count = 0
-        while True:
-            des_snap = os.popen((\
-                "aws ec2 describe-import-snapshot-tasks --import-task-id {0}").format(task_id))
-            progress = des_snap.read()
-            task = json.loads(progress)
-            task_info = task['ImportSnapshotTasks']
-            import time
-            time.sleep(30)
-            prog = task_info[0].get('SnapshotTaskDetail', {}).get('Status')
-            if prog == "completed":
-                snapshot_id = task_info[0]['SnapshotTaskDetail']['SnapshotId']
-                logger.info("Snapshot created successfully with Id %s", snapshot_id)
-                break
-            else:
-                count = count + 1
-                logger.info("Snapshot creation is inprogress %s", count*'.')
-        if root_disk:
-            snapshot_id = snapshot_id + root_disk
-        return snapshot_id
+        return '!@root_disk' if disk.split('/')[-2].endswith('sda') else ''
 
-    def copy_disks_to_s3(self, disks):
+    def _tracker(self):
         """
-        copy converted raw disk to S3.
+        Helper function: returns an ImportTracker configured by import_options.
         """
+        return ImportTracker(
+            self.aws_clients.client('ec2'),
+            min_interval=self.import_options.get('min_poll_seconds', 5),
+            max_interval=self.import_options.get('max_poll_seconds', 60),
+            backoff=self.import_options.get('backoff', 1.5),
+            timeout=self.import_options.get('timeout_minutes') and
+            self.import_options['timeout_minutes'] * 60)
+
+    @timed('import_submit')
+    def submit_imports(self, disks):
+        """
+        starts import-snapshot tasks of raw disks already on S3, returns
+        task ids in disk order.
+        """
+        tracker = self._tracker()
+        logger.info("snap shot intilization started...")
+        task_ids = []
         for disk in disks:
-            logger.info("object copy intialized...")
-            cmd = "aws s3 cp {} s3://{} --acl public-read".format(disk, self.bucket)
-            os.system(cmd)
-            logger.info("object %s copy Done..", disk)
+            disk_name = disk.split('/')[-1]
+            url = "https://s3-{}.amazonaws.com/{}/{}".format(self.region, self.bucket, disk_name)
+            container = {
+                'Url':url,
+                'Description':"Example image originally in QCOW2 format",
+                'Format':'raw'
+                }
+            task_ids.append(tracker.submit("trilio_" + disk_name[:-4], container))
+        return task_ids
+
+    @timed('import')
+    def wait_imports(self, disks, task_ids):
+        """
+        waits for import tasks of disks, started by this or an earlier run.
+        Returns snapshot ids in disk order, the root disk's id is suffixed
+        with '!@root_disk'.
+        """
+        snapshots = self._tracker().wait(task_ids)
+        return [snapshots[task_id] + self._root_marker(disk)
+                for disk, task_id in zip(disks, task_ids)]
 
+    def create_snapshots(self, disks):
+        """
+        creates snapshots of raw disks already on S3, all imports run at
+        once and are polled together. Returns snapshot ids in disk order,
+        the root disk's id is suffixed with '!@root_disk'.
+        """
+        return self.wait_imports(disks, self.submit_imports(disks))
 
-    def convert_image_to_raw(self, disk_files):
+    def create_snapshot(self, disk):
         """
-        Converts qcow2 image to raw.
+        creates snapshot
+        """
+        return self.create_snapshots([disk])[0]
+
+    def get_s3_client(self):
         """
+        Returns the S3 client shared by all uploads.
+        """
+        return self.aws_clients.client('s3')
+
+    def copy_disks_to_s3(self, disks):
+        """
+        copy converted raw disks to S3, several at once with multipart
+        uploads, and returns per disk reports.
+        """
+        uploader = MultipartUploader(
+            self.get_s3_client(), self.bucket,
+            part_size=int(self.upload_options.get('part_size_mb', 64) * MB),
+            threads=self.upload_options.get('threads', 8),
+            disks=self.upload_options.get('disks', 2),
+            max_attempts=self.upload_options.get('max_attempts', 5))
+        logger.info("object copy intialized...")
+        try:
+            reports = uploader.upload_files(disks)
+        finally:
+            if self.cache is not None:
+                self.cache.release(disks)
+        self.upload_reports.update(uploader.reports)
+        for disk, report in zip(disks, reports):
+            self.digests[disk] = report['digests']
+        return reports
+
+    def stream_disks_to_s3(self, disk_files):
+        """
+        Converts and uploads disks to S3 part by part without writing full
+        raw files, returns the raw disk names the objects are stored under.
+        """
+        uploader = StreamingUploader(
+            self.scheduler, self.get_s3_client(), self.bucket,
+            part_size=int(self.stream_options.get('part_size_mb', 64) * MB),
+            workers=self.stream_options.get('workers', 4),
+            scratch_dir=self.stream_options.get('scratch_dir'))
         raw_disks = []
         for disk in disk_files:
-            qemu_info = subprocess.Popen(["qemu-img", "info", disk], \
-                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            out1, err1 = qemu_info.communicate()
-            logger.info("output %s", out1)
-            logger.info("Error..!! %s", err1)
             raw_disk_name = disk + '.raw'
-            if os.path.exists(raw_disk_name):
-                logger.info("raw file already exists, Hence skipping the convertion..")
-            else:
-                qemu_convert = subprocess.Popen(["qemu-img", "convert", \
-                                                 disk, raw_disk_name], \
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE\
-                    )
-                out2, err2 = qemu_convert.communicate()
-                logger.info("output %s", out2)
-                logger.info("Error..!! %s", err2)
-                logger.info("Image converted.....")
+            logger.info("object stream intialized...")
+            self.stream_reports[disk] = uploader.upload_disk(
+                disk, os.path.basename(raw_disk_name))
+            self.digests[raw_disk_name] = self.stream_reports[disk]['digests']
             raw_disks.append(raw_disk_name)
-
         return raw_disks
+
+    def convert_image_to_raw(self, disk_files):
+        """
+        Converts qcow2 image to raw.
+        """
+        return self.scheduler.run(disk_files, cache=self.cache)
+
+    def raw_checksum(self, raw_disk):
+        """
+        Returns (algorithm, checksum) the conversion cache recorded for a
+        converted raw disk, None when it has none. Never reads the disk.
+        """
+        if self.cache is None:
+            return None
+        return self.cache.recorded_checksum(raw_disk)
+
+    def get_conversion_reports(self):
+        """
+        Returns per disk timing and progress of conversions.
+        """
+        return self.scheduler.reports
+
+    def get_upload_reports(self):
+        """
+        Returns per disk throughput and retries of copies and streamed uploads.
+        """
+        reports = dict(self.upload_reports)
+        reports.update(self.stream_reports)
+        return reports
+
+    def get_digests(self, raw_disks):
+        """
+        Returns whole object and per part digests of uploaded raw disks,
+        keyed by their S3 object key.
+        """
+        return dict((os.path.basename(raw_disk), self.digests[raw_disk])
+                    for raw_disk in raw_disks if raw_disk in self.digests)
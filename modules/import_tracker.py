@@ -0,0 +1,120 @@
+"""
+Import tracker
+
+Submits EC2 import-snapshot tasks for all disks at once and polls them
+together, one describe call covering every pending task. The poll interval
+starts short, grows while no task makes progress and drops back whenever
+one does, so a restore waits about as long as its slowest import.
+"""
+import time
+import logging
+from modules.utils import ImageConverterException, ImportTaskFailed
+from modules.metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+FAILED_STATES = ('deleting', 'deleted', 'error')
+DESCRIBE_BATCH = 100
+
+class ImportTracker(object):
+    """
+    Tracks import-snapshot tasks until they complete or fail.
+    """
+    def __init__(self, ec2_client, min_interval=5, max_interval=60, backoff=1.5,
+                 timeout=None, sleep=time.sleep):
+        """
+        constructor of ImportTracker class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param ec2_client: object with boto3 EC2 client's import_snapshot and
+                              describe_import_snapshot_tasks methods
+            type ec2_client: botocore.client.EC2
+            param min_interval: seconds between polls while tasks make progress
+            type min_interval: float
+            param max_interval: upper bound of the poll interval
+            type max_interval: float
+            param backoff: factor the interval grows by after a poll without progress
+            type backoff: float
+            param timeout: seconds to wait for all tasks, unbounded if None
+            type timeout: float
+            param sleep: called with the seconds to wait between polls
+            type sleep: callable
+        """
+        self.ec2_client = ec2_client
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff = max(backoff, 1.0)
+        self.timeout = timeout
+        self.sleep = sleep
+        self.polls = 0
+
+    def submit(self, description, disk_container):
+        """
+        Starts an import-snapshot task and returns its id.
+        """
+        response = self.ec2_client.import_snapshot(Description=description,
+                                                   DiskContainer=disk_container)
+        task_id = response.get('ImportTaskId')
+        if not task_id:
+            raise ImageConverterException("import of {} was not started: {}".format(
+                description, response))
+        logger.info("Imported Task Id is: %s", task_id)
+        return task_id
+
+    def describe(self, task_ids):
+        """
+        Returns SnapshotTaskDetail of given tasks keyed by task id.
+        """
+        details = {}
+        for start in range(0, len(task_ids), DESCRIBE_BATCH):
+            response = self.ec2_client.describe_import_snapshot_tasks(
+                ImportTaskIds=task_ids[start:start + DESCRIBE_BATCH])
+            self.polls += 1
+            for task in response.get('ImportSnapshotTasks', []):
+                details[task['ImportTaskId']] = task.get('SnapshotTaskDetail', {})
+        return details
+
+    def wait(self, task_ids):
+        """
+        Polls given tasks until all completed and returns their snapshot ids
+        keyed by task id. Raises ImportTaskFailed as soon as a task fails or
+        disappears, ImageConverterException when the timeout passes.
+        """
+        pending = list(task_ids)
+        snapshots = {}
+        progress = {}
+        interval = self.min_interval
+        start = time.time()
+        while pending:
+            details = self.describe(pending)
+            moved = False
+            for task_id in list(pending):
+                detail = details.get(task_id)
+                if detail is None:
+                    raise ImportTaskFailed(
+                        "import task {} is no longer listed".format(task_id))
+                status = detail.get('Status')
+                if status == 'completed':
+                    snapshots[task_id] = detail['SnapshotId']
+                    pending.remove(task_id)
+                    METRICS.observe('import_task', time.time() - start)
+                    moved = True
+                    logger.info("Snapshot created successfully with Id %s", detail['SnapshotId'])
+                elif status in FAILED_STATES:
+                    raise ImportTaskFailed("import task {} {}: {}".format(
+                        task_id, status, detail.get('StatusMessage', '')))
+                elif progress.get(task_id) != (status, detail.get('Progress')):
+                    progress[task_id] = (status, detail.get('Progress'))
+                    moved = True
+            if not pending:
+                break
+            if self.timeout is not None and time.time() - start > self.timeout:
+                raise ImageConverterException("import tasks {} timed out after {} seconds"\
+                    .format(pending, self.timeout))
+            interval = self.min_interval if moved else \
+                min(interval * self.backoff, self.max_interval)
+            logger.info("Snapshot creation is inprogress %s, next poll in %.0f seconds",
+                        dict((task_id, progress.get(task_id)) for task_id in pending), interval)
+            self.sleep(interval)
+        return snapshots
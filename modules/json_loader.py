@@ -0,0 +1,138 @@
+"""
+JSON loader
+
+LRU cache of decoded vault db files keyed on (path, mtime, size) with a
+memory budget counted in bytes of the source files. Uses an accelerated
+decoder when one is installed and falls back to stdlib json otherwise.
+Cached objects are shared between callers and must not be modified.
+"""
+import os
+import json
+import threading
+from collections import OrderedDict
+from modules.metrics import METRICS
+
+def _select_decoder():
+    """
+    Returns (name, loads) of the fastest available JSON decoder.
+    """
+    try:
+        import orjson
+        return 'orjson', orjson.loads
+    except ImportError:
+        pass
+    try:
+        import ujson
+        return 'ujson', ujson.loads
+    except ImportError:
+        pass
+    try:
+        import simplejson
+        return 'simplejson', simplejson.loads
+    except ImportError:
+        pass
+    return 'json', json.loads
+
+DECODER_NAME, DECODE = _select_decoder()
+
+class JsonLoader(object):
+    """
+    Size bounded LRU cache of decoded JSON files.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """
+        constructor of JsonLoader class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param max_bytes: total size of cached source files, 0 disables caching
+            type max_bytes: int
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def load(self, filepath):
+        """
+        Returns decoded content of given JSON file, from cache when the
+        file's mtime and size did not change.
+        """
+        stat = os.stat(filepath)
+        key = (stat.st_mtime, stat.st_size)
+        with self.lock:
+            entry = self.entries.get(filepath)
+            if entry is not None and entry[0] == key:
+                self.entries.pop(filepath)
+                self.entries[filepath] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        with METRICS.timer('vault_read') as timer:
+            with open(filepath, 'rb') as filepointer:
+                raw = filepointer.read()
+            timer.bytes = len(raw)
+        data = DECODE(raw)
+        if len(raw) <= self.max_bytes:
+            with self.lock:
+                self._drop(filepath)
+                self.entries[filepath] = (key, data, len(raw))
+                self.cached_bytes += len(raw)
+                self._evict()
+        return data
+
+    def resize(self, max_bytes):
+        """
+        Sets memory budget and evicts least recently used files above it.
+        """
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def invalidate(self, filepath=None):
+        """
+        Drops given file or every file from the cache.
+        """
+        with self.lock:
+            if filepath is None:
+                self.entries.clear()
+                self.cached_bytes = 0
+            else:
+                self._drop(filepath)
+
+    def stats(self):
+        """
+        Returns cache counters.
+        """
+        with self.lock:
+            return {
+                'decoder': DECODER_NAME,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'cached_bytes': self.cached_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def _evict(self):
+        """
+        Helper function: drops least recently used entries above the budget,
+        caller holds the lock.
+        """
+        while self.cached_bytes > self.max_bytes and self.entries:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _drop(self, filepath):
+        """
+        Helper function: removes entry, caller holds the lock.
+        """
+        entry = self.entries.pop(filepath, None)
+        if entry is not None:
+            self.cached_bytes -= entry[2]
+
+LOADER = JsonLoader()
@@ -0,0 +1,76 @@
+"""
+JSON array streaming
+
+Yields the elements of a top level JSON array one at a time, so files like
+resources_db can be walked without holding the whole decoded list.
+"""
+import io
+import json
+
+DECODER = json.JSONDecoder()
+WHITESPACE = u' \t\n\r'
+
+def iter_json_array(filepath, chunk_size=64 * 1024):
+    """
+    Yields elements of the JSON array stored in given file.
+
+    - **parameters**, **types**, **return** and **return types**::
+
+        param filepath: Path of the JSON file
+        type filepath: str
+        param chunk_size: number of characters read at a time
+        type chunk_size: int
+        returns elements:
+        type: generator
+    """
+    with io.open(filepath, 'r', encoding='utf-8') as filepointer:
+        buf = u''
+        pos = 0
+        eof = False
+        started = False
+
+        def fill(buf, pos):
+            """
+            Drops consumed characters and appends next chunk.
+            """
+            chunk = filepointer.read(chunk_size)
+            return buf[pos:] + chunk, 0, not chunk
+
+        while True:
+            while pos < len(buf) and buf[pos] in WHITESPACE:
+                pos += 1
+            if pos >= len(buf):
+                if eof:
+                    raise ValueError("unexpected end of JSON array in {}".format(filepath))
+                buf, pos, eof = fill(buf, pos)
+                continue
+            char = buf[pos]
+            if not started:
+                if char != u'[':
+                    raise ValueError("expected JSON array in {}".format(filepath))
+                started = True
+                pos += 1
+                continue
+            if char == u']':
+                return
+            if char == u',':
+                pos += 1
+                continue
+            try:
+                element, end = DECODER.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                buf, pos, eof = fill(buf, pos)
+                continue
+            after = end
+            while after < len(buf) and buf[after] in WHITESPACE:
+                after += 1
+            if after >= len(buf) or buf[after] not in u',]':
+                # element may be a scalar cut at the chunk boundary, decode again
+                if eof:
+                    raise ValueError("malformed JSON array in {}".format(filepath))
+                buf, pos, eof = fill(buf, pos)
+                continue
+            pos = end
+            yield element
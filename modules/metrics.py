@@ -0,0 +1,255 @@
+"""
+Restore metrics
+
+Process wide timers and counters of every restore step: vault reads,
+parsing, conversion, uploads, snapshot imports, AMI registration, network
+provisioning and launches. Each timer keeps a latency histogram and the
+bytes moved, so throughput can be compared between steps. The report is
+exported as JSON or as a Prometheus textfile. Disabled metrics hand out a
+shared no-op timer and return at once, so instrumented code costs next to
+nothing.
+"""
+import os
+import json
+import time
+import bisect
+import threading
+from functools import wraps
+
+MB = 1024 * 1024
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600)
+PREFIX = 'trilio_'
+
+class Timer(object):
+    """
+    Times a with block, bytes may be set inside the block.
+    """
+    def __init__(self, metrics, name, labels):
+        """
+        constructor of Timer class
+        """
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.bytes = None
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        labels = dict(self.labels, status='failed' if exc_type else 'ok')
+        self.metrics.observe(self.name, time.time() - self.start, self.bytes, **labels)
+
+class NoopTimer(object):
+    """
+    Timer of disabled metrics.
+    """
+    bytes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NOOP_TIMER = NoopTimer()
+
+class Metrics(object):
+    """
+    Thread safe histograms and counters keyed by name and labels.
+    """
+    def __init__(self, enabled=False, buckets=BUCKETS):
+        """
+        constructor of Metrics class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param enabled: record anything at all
+            type enabled: bool
+            param buckets: upper bounds in seconds of the histogram buckets
+            type buckets: tuple
+        """
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.timers = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def configure(self, enabled):
+        """
+        Enables or disables recording, recorded values are kept.
+        """
+        self.enabled = enabled
+
+    def reset(self):
+        """
+        Drops everything recorded.
+        """
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+
+    def timer(self, name, **labels):
+        """
+        Returns a context manager timing a step of given name.
+        """
+        if not self.enabled:
+            return NOOP_TIMER
+        return Timer(self, name, labels)
+
+    def observe(self, name, seconds, nbytes=None, **labels):
+        """
+        Records one step of given name that took seconds and moved nbytes.
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                timer = self.timers[key] = {'count': 0, 'sum': 0.0, 'min': None, 'max': None,
+                                            'bytes': 0, 'buckets': [0] * (len(self.buckets) + 1)}
+            timer['count'] += 1
+            timer['sum'] += seconds
+            timer['min'] = seconds if timer['min'] is None else min(timer['min'], seconds)
+            timer['max'] = seconds if timer['max'] is None else max(timer['max'], seconds)
+            timer['buckets'][bisect.bisect_left(self.buckets, seconds)] += 1
+            if nbytes:
+                timer['bytes'] += nbytes
+
+    def count(self, name, value=1, **labels):
+        """
+        Adds value to the counter of given name.
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def _quantile(self, timer, fraction):
+        """
+        Helper function: upper bound of the bucket holding given fraction
+        of the observations, max when it is beyond the last bucket.
+        """
+        wanted = fraction * timer['count']
+        seen = 0
+        for bound, observed in zip(self.buckets, timer['buckets']):
+            seen += observed
+            if seen >= wanted:
+                return bound
+        return timer['max']
+
+    def report(self):
+        """
+        Returns timers with count, seconds, bucket counts, p50/p95 and MB/s,
+        and counters.
+        """
+        with self.lock:
+            timers = [(name, dict(labels), dict(timer, buckets=list(timer['buckets'])))
+                      for (name, labels), timer in sorted(self.timers.items())]
+            counters = [(name, dict(labels), value)
+                        for (name, labels), value in sorted(self.counters.items())]
+        report = {'enabled': self.enabled, 'timers': [], 'counters': []}
+        for name, labels, timer in timers:
+            report['timers'].append({
+                'name': name,
+                'labels': labels,
+                'count': timer['count'],
+                'seconds': timer['sum'],
+                'min': timer['min'],
+                'max': timer['max'],
+                'p50': self._quantile(timer, 0.5),
+                'p95': self._quantile(timer, 0.95),
+                'bytes': timer['bytes'],
+                'mb_per_s': timer['bytes'] / float(MB) / timer['sum']
+                            if timer['bytes'] and timer['sum'] else None,
+                'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'],
+                                    timer['buckets'])),
+            })
+        for name, labels, value in counters:
+            report['counters'].append({'name': name, 'labels': labels, 'value': value})
+        return report
+
+    def write_json(self, filepath):
+        """
+        Writes the report as JSON to filepath.
+        """
+        _replace(filepath, json.dumps(self.report(), indent=2, sort_keys=True))
+
+    def write_prometheus(self, filepath):
+        """
+        Writes the report in Prometheus text format to filepath, e.g. for
+        the node exporter textfile collector.
+        """
+        report = self.report()
+        lines = []
+        typed = set()
+        for timer in report['timers']:
+            metric = PREFIX + timer['name'] + '_seconds'
+            if metric not in typed:
+                typed.add(metric)
+                lines.append('# TYPE {} histogram'.format(metric))
+            cumulative = 0
+            for bound in [str(bound) for bound in self.buckets] + ['+Inf']:
+                cumulative += timer['buckets'][bound]
+                lines.append('{}_bucket{} {}'.format(
+                    metric, _labels(dict(timer['labels'], le=bound)), cumulative))
+            lines.append('{}_sum{} {}'.format(metric, _labels(timer['labels']), timer['seconds']))
+            lines.append('{}_count{} {}'.format(metric, _labels(timer['labels']), timer['count']))
+        for timer in report['timers']:
+            if timer['bytes']:
+                metric = PREFIX + timer['name'] + '_bytes_total'
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append('# TYPE {} counter'.format(metric))
+                lines.append('{}{} {}'.format(metric, _labels(timer['labels']), timer['bytes']))
+        for counter in report['counters']:
+            metric = PREFIX + counter['name'] + '_total'
+            if metric not in typed:
+                typed.add(metric)
+                lines.append('# TYPE {} counter'.format(metric))
+            lines.append('{}{} {}'.format(metric, _labels(counter['labels']), counter['value']))
+        _replace(filepath, '\n'.join(lines) + '\n')
+
+def _labels(labels):
+    """
+    Helper function: formats labels the Prometheus way.
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\')
+                                            .replace('"', '\\"').replace('\n', '\\n'))
+                          for key, value in sorted(labels.items())) + '}'
+
+def _replace(filepath, content):
+    """
+    Helper function: writes content to a temp file renamed over filepath,
+    so readers never see a partial file.
+    """
+    partial = filepath + '.partial'
+    with open(partial, 'w') as output:
+        output.write(content)
+    os.rename(partial, filepath)
+
+def timed(name, **labels):
+    """
+    Decorator timing every call of the decorated function with METRICS.
+    """
+    def decorator(func):
+        """
+        Wraps func.
+        """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            """
+            Calls func under a timer.
+            """
+            with METRICS.timer(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+METRICS = Metrics()
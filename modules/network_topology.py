@@ -0,0 +1,95 @@
+"""
+Network topology
+
+Snapshot scoped view of the network, subnet and security group dbs. Each db
+file is read once and each subnet pickle decoded once, however many vms of
+the snapshot refer to it.
+"""
+import pickle
+import threading
+from modules.utils import get_data
+
+class NetworkTopology(object):
+    """
+    Resolves vm network settings of one snapshot.
+    """
+    def __init__(self, snapshot_path):
+        """
+        constructor of NetworkTopology class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param snapshot_path: Path of the snapshot directory
+            type snapshot_path: str
+        """
+        self.snapshot_path = snapshot_path
+        self.lock = threading.Lock()
+        self.networks = {}
+        self.subnets = {}
+        self.security_groups = {}
+        self.decodes = 0
+
+    def get_network(self, nic_db_path):
+        """
+        Returns (ip, router_name) from given network_db.
+        """
+        with self.lock:
+            if nic_db_path not in self.networks:
+                info = {}
+                for network in get_data(nic_db_path):
+                    for meta in network.get('metadata') or []:
+                        if meta.get('key') == 'ip_address':
+                            info['ip'] = meta.get('value')
+                        elif meta.get('key') == 'router_name':
+                            info['router_name'] = meta.get('value')
+                self.networks[nic_db_path] = (info.get('ip'), info.get('router_name'))
+            return self.networks[nic_db_path]
+
+    def get_subnet(self, subnet_path):
+        """
+        Returns (cidr, subnet_name) from the pickled subnet in given network_db.
+        """
+        with self.lock:
+            if subnet_path not in self.subnets:
+                subnet = (None, None)
+                for network in get_data(subnet_path):
+                    blob = network.get('pickle')
+                    if not isinstance(blob, bytes):
+                        blob = blob.encode('latin-1')
+                    pickl = pickle.loads(blob)
+                    self.decodes += 1
+                    subnet = (pickl.get('cidr'), pickl.get('name'))
+                self.subnets[subnet_path] = subnet
+            return self.subnets[subnet_path]
+
+    def get_security_group(self, sg_db_path):
+        """
+        Returns security_group_db data.
+        """
+        with self.lock:
+            if sg_db_path not in self.security_groups:
+                self.security_groups[sg_db_path] = get_data(sg_db_path)
+            return self.security_groups[sg_db_path]
+
+    def resolve(self, vm_dict):
+        """
+        Returns ip, router_name, cidr and subnet_name of given vm.
+        """
+        info = {}
+        if vm_dict.get('nic_db_path'):
+            ip_address, router_name = self.get_network(vm_dict['nic_db_path'])
+            if ip_address is not None:
+                info['ip'] = ip_address
+            if router_name is not None:
+                info['router_name'] = router_name
+        if vm_dict.get('subnet_path'):
+            cidr, subnet_name = self.get_subnet(vm_dict['subnet_path'])
+            info.update({'cidr':cidr, 'subnet_name':subnet_name})
+        return info
+
+    def update_vm(self, vm_dict):
+        """
+        Updates vm dictionary with its network settings and returns it.
+        """
+        vm_dict.update(self.resolve(vm_dict))
+        return vm_dict
@@ -0,0 +1,467 @@
+"""
+qcow2 reader
+
+Reads qcow2 images in process: the header and its extensions, L1/L2
+tables, zero and compressed clusters and chains of backing files. Images
+are exposed as read only file objects and as iterators of memoryview
+chunks, so disks can be probed and converted where qemu-img is missing.
+"""
+import os
+import zlib
+import struct
+import logging
+import threading
+import collections
+from modules.utils import ImageConverterException
+
+logger = logging.getLogger(__name__)
+
+QCOW2_MAGIC = b'QFI\xfb'
+HEADER_V2 = struct.Struct('>4sIQIIQIIQQIIQ')
+HEADER_V3 = struct.Struct('>QQQII')
+EXTENSION = struct.Struct('>II')
+
+EXT_END = 0
+EXT_BACKING_FORMAT = 0xE2792ACA
+
+INCOMPAT_CORRUPT = 1 << 1
+INCOMPAT_COMPRESSION = 1 << 3
+INCOMPAT_SUPPORTED = (1 << 0) | INCOMPAT_CORRUPT | INCOMPAT_COMPRESSION
+
+OFFSET_MASK = 0x00fffffffffffe00
+OFLAG_COMPRESSED = 1 << 62
+OFLAG_ZERO = 1
+
+CHUNK_SIZE = 1024 * 1024
+MAX_BACKING_DEPTH = 16
+
+class RawImage(object):
+    """
+    Raw image, also used as backing file of qcow2 images.
+    """
+    format = 'raw'
+
+    def __init__(self, path):
+        """
+        constructor of RawImage class
+        """
+        self.path = path
+        self.handle = open(path, 'rb')
+        self.size = os.fstat(self.handle.fileno()).st_size
+        self.lock = threading.Lock()
+        self.position = 0
+
+    def read_at(self, offset, size):
+        """
+        Returns bytearray of size bytes at offset, zeros past end of image.
+        """
+        buf = bytearray(size)
+        length = max(min(size, self.size - offset), 0)
+        if length:
+            with self.lock:
+                self.handle.seek(offset)
+                data = self.handle.read(length)
+            buf[:len(data)] = data
+        return buf
+
+    def extents(self, start, end, depth=0):
+        """
+        Yields (start, length, data, zero, depth) of guest range [start, end).
+        """
+        data_end = max(min(end, self.size), start)
+        if data_end > start:
+            yield start, data_end - start, True, False, depth
+        if end > data_end:
+            yield data_end, end - data_end, False, True, depth
+
+    def info(self):
+        """
+        Returns qemu-img info like dictionary.
+        """
+        return {'filename': self.path, 'format': self.format,
+                'virtual-size': self.size, 'actual-size': _actual_size(self.path)}
+
+    def map(self):
+        """
+        Returns qemu-img map --output=json like list of extents.
+        """
+        merged = []
+        for start, length, data, zero, depth in self.extents(0, self.size):
+            previous = merged[-1] if merged else None
+            if previous and (previous['data'], previous['zero'], previous['depth']) == \
+                    (data, zero, depth):
+                previous['length'] += length
+            else:
+                merged.append({'start': start, 'length': length, 'depth': depth,
+                               'zero': zero, 'data': data})
+        return merged
+
+    def iter_chunks(self, offset=0, size=None, chunk_size=CHUNK_SIZE):
+        """
+        Yields memoryview chunks of guest range [offset, offset + size).
+        """
+        end = self.size if size is None else offset + size
+        while offset < end:
+            length = min(chunk_size, end - offset)
+            yield memoryview(self.read_at(offset, length))
+            offset += length
+
+    def read(self, size=-1):
+        """
+        Reads from the current position like a file object.
+        """
+        if size is None or size < 0:
+            size = self.size - self.position
+        size = max(min(size, self.size - self.position), 0)
+        data = bytes(self.read_at(self.position, size))
+        self.position += size
+        return data
+
+    def seek(self, offset, whence=0):
+        """
+        Moves the read position like a file object.
+        """
+        if whence == 0:
+            self.position = offset
+        elif whence == 1:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def tell(self):
+        """
+        Returns the read position.
+        """
+        return self.position
+
+    def close(self):
+        """
+        Closes the image file.
+        """
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class Qcow2Image(RawImage):
+    """
+    qcow2 (version 2 and 3) image.
+    """
+    format = 'qcow2'
+
+    def __init__(self, path, l2_cache_tables=64, depth=0):
+        """
+        constructor of Qcow2Image class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param path: qcow2 image path
+            type path: str
+            param l2_cache_tables: number of L2 tables kept in memory
+            type l2_cache_tables: int
+            param depth: position in the backing chain, used to stop loops
+            type depth: int
+        """
+        self.path = path
+        self.handle = open(path, 'rb')
+        self.lock = threading.Lock()
+        self.position = 0
+        self.l2_cache = collections.OrderedDict()
+        self.l2_cache_tables = max(int(l2_cache_tables), 1)
+        self.compressed_cache = (None, None)
+        self.backing = None
+        try:
+            self._read_header()
+            self._read_extensions()
+            self._read_l1_table()
+            self._open_backing(depth)
+        except Exception:
+            self.close()
+            raise
+
+    def _read_header(self):
+        """
+        Helper function: parses the fixed header.
+        """
+        header = self.handle.read(HEADER_V2.size + HEADER_V3.size)
+        if len(header) < HEADER_V2.size or header[:4] != QCOW2_MAGIC:
+            raise ImageConverterException("{} is not a qcow2 image".format(self.path))
+        (_, self.version, self.backing_file_offset, self.backing_file_size,
+         self.cluster_bits, self.size, crypt_method, self.l1_size,
+         self.l1_table_offset, _, _, _, _) = HEADER_V2.unpack(header[:HEADER_V2.size])
+        if self.version not in (2, 3):
+            raise ImageConverterException("qcow2 version {} of {} is not supported".format(
+                self.version, self.path))
+        if crypt_method:
+            raise ImageConverterException("encrypted image {} is not supported".format(
+                self.path))
+        self.header_length = HEADER_V2.size
+        self.incompatible_features = 0
+        self.compression_type = 0
+        if self.version == 3:
+            (self.incompatible_features, _, _, _, self.header_length) = \
+                HEADER_V3.unpack(header[HEADER_V2.size:])
+            unsupported = self.incompatible_features & ~INCOMPAT_SUPPORTED
+            if unsupported:
+                raise ImageConverterException(
+                    "{} uses unsupported qcow2 features {:#x}".format(self.path, unsupported))
+            if self.incompatible_features & INCOMPAT_CORRUPT:
+                logger.warning("%s is marked corrupt", self.path)
+            if self.incompatible_features & INCOMPAT_COMPRESSION and \
+                    self.header_length > HEADER_V2.size + HEADER_V3.size:
+                self.handle.seek(HEADER_V2.size + HEADER_V3.size)
+                self.compression_type = bytearray(self.handle.read(1))[0]
+        if self.compression_type:
+            raise ImageConverterException("{} uses unsupported compression type {}".format(
+                self.path, self.compression_type))
+        self.cluster_size = 1 << self.cluster_bits
+        self.l2_bits = self.cluster_bits - 3
+        self.l2_entries = 1 << self.l2_bits
+        self.compressed_bits = 62 - (self.cluster_bits - 8)
+
+    def _read_extensions(self):
+        """
+        Helper function: parses header extensions, only the backing file
+        format is used.
+        """
+        self.backing_format = None
+        offset = self.header_length
+        while offset + EXTENSION.size <= self.cluster_size:
+            ext_type, ext_length = EXTENSION.unpack(self._pread(offset, EXTENSION.size))
+            if ext_type == EXT_END:
+                break
+            if ext_type == EXT_BACKING_FORMAT:
+                self.backing_format = self._pread(
+                    offset + EXTENSION.size, ext_length).decode('ascii')
+            offset += EXTENSION.size + (ext_length + 7) // 8 * 8
+
+    def _read_l1_table(self):
+        """
+        Helper function: loads the L1 table.
+        """
+        raw_l1 = self._pread(self.l1_table_offset, self.l1_size * 8)
+        if len(raw_l1) != self.l1_size * 8:
+            raise ImageConverterException("L1 table of {} is truncated".format(self.path))
+        self.l1_table = struct.unpack('>{}Q'.format(self.l1_size), raw_l1)
+
+    def _open_backing(self, depth):
+        """
+        Helper function: opens the backing file, relative paths are taken
+        from the image's directory.
+        """
+        self.backing_file = None
+        if not self.backing_file_offset:
+            return
+        self.backing_file = self._pread(self.backing_file_offset,
+                                        self.backing_file_size).decode('utf-8')
+        if depth >= MAX_BACKING_DEPTH:
+            raise ImageConverterException("backing chain of {} is too deep".format(self.path))
+        backing_path = os.path.join(os.path.dirname(self.path), self.backing_file)
+        self.backing = open_image(backing_path, self.backing_format, depth + 1)
+
+    def _pread(self, offset, size):
+        """
+        Helper function: reads size bytes of the image file at offset.
+        """
+        with self.lock:
+            self.handle.seek(offset)
+            return self.handle.read(size)
+
+    def _l2_table(self, l2_offset):
+        """
+        Helper function: returns L2 table at l2_offset through the LRU cache.
+        """
+        with self.lock:
+            table = self.l2_cache.pop(l2_offset, None)
+            if table is None:
+                self.handle.seek(l2_offset)
+                raw_l2 = self.handle.read(self.cluster_size)
+                if len(raw_l2) != self.cluster_size:
+                    raise ImageConverterException("L2 table of {} at {} is truncated".format(
+                        self.path, l2_offset))
+                table = struct.unpack('>{}Q'.format(self.l2_entries), raw_l2)
+                if len(self.l2_cache) >= self.l2_cache_tables:
+                    self.l2_cache.popitem(last=False)
+            self.l2_cache[l2_offset] = table
+            return table
+
+    def _l2_entry(self, cluster):
+        """
+        Helper function: returns L2 entry of guest cluster, 0 when unallocated.
+        """
+        l1_index = cluster >> self.l2_bits
+        if l1_index >= self.l1_size:
+            return 0
+        l2_offset = self.l1_table[l1_index] & OFFSET_MASK
+        if not l2_offset:
+            return 0
+        return self._l2_table(l2_offset)[cluster & (self.l2_entries - 1)]
+
+    def _decompress(self, entry):
+        """
+        Helper function: returns the decompressed cluster of a compressed
+        L2 entry, the last one is kept for sequential reads.
+        """
+        cached_entry, cluster = self.compressed_cache
+        if cached_entry == entry:
+            return cluster
+        host_offset = entry & ((1 << self.compressed_bits) - 1)
+        sectors = ((entry >> self.compressed_bits) & ((1 << (self.cluster_bits - 8)) - 1)) + 1
+        compressed = self._pread(host_offset, sectors * 512 - (host_offset & 511))
+        cluster = zlib.decompressobj(-12).decompress(compressed, self.cluster_size)
+        if len(cluster) != self.cluster_size:
+            raise ImageConverterException("compressed cluster of {} at {} is corrupt".format(
+                self.path, host_offset))
+        self.compressed_cache = (entry, cluster)
+        return cluster
+
+    def read_at(self, offset, size):
+        """
+        Returns bytearray of size guest bytes at offset. Runs of clusters
+        which are contiguous in the image file are read with a single read.
+        """
+        buf = bytearray(size)
+        end = min(offset + size, self.size)
+        position = offset
+        run_start = run_host = run_length = 0
+        while position < end:
+            in_cluster = position & (self.cluster_size - 1)
+            length = min(self.cluster_size - in_cluster, end - position)
+            entry = self._l2_entry(position >> self.cluster_bits)
+            host = entry & OFFSET_MASK
+            if not entry & OFLAG_COMPRESSED and host and not entry & OFLAG_ZERO:
+                if run_length and run_host + run_length == host + in_cluster and \
+                        run_start + run_length == position:
+                    run_length += length
+                else:
+                    self._copy_run(buf, offset, run_start, run_host, run_length)
+                    run_start, run_host, run_length = position, host + in_cluster, length
+            elif entry & OFLAG_COMPRESSED:
+                cluster = self._decompress(entry)
+                buf[position - offset:position - offset + length] = \
+                    cluster[in_cluster:in_cluster + length]
+            elif not entry & OFLAG_ZERO and self.backing is not None:
+                buf[position - offset:position - offset + length] = \
+                    self.backing.read_at(position, length)
+            position += length
+        self._copy_run(buf, offset, run_start, run_host, run_length)
+        return buf
+
+    def _copy_run(self, buf, offset, run_start, run_host, run_length):
+        """
+        Helper function: reads a run of allocated clusters into buf.
+        """
+        if not run_length:
+            return
+        data = self._pread(run_host, run_length)
+        if len(data) != run_length:
+            raise ImageConverterException("cluster of {} at {} is truncated".format(
+                self.path, run_host))
+        buf[run_start - offset:run_start - offset + run_length] = data
+
+    def extents(self, start, end, depth=0):
+        """
+        Yields (start, length, data, zero, depth) of guest range [start, end),
+        unallocated clusters are resolved through the backing file. Whole
+        unallocated L2 tables are skipped without touching the file.
+        """
+        image_end = max(min(end, self.size), start)
+        position = start
+        l2_span = self.cluster_size * self.l2_entries
+        while position < image_end:
+            l1_index = position >> (self.cluster_bits + self.l2_bits)
+            if l1_index >= self.l1_size or not self.l1_table[l1_index] & OFFSET_MASK:
+                length = min((l1_index + 1) * l2_span, image_end) - position
+                entry = 0
+            else:
+                in_cluster = position & (self.cluster_size - 1)
+                length = min(self.cluster_size - in_cluster, image_end - position)
+                entry = self._l2_entry(position >> self.cluster_bits)
+            if entry & OFLAG_ZERO and not entry & OFLAG_COMPRESSED:
+                yield position, length, False, True, depth
+            elif entry & (OFLAG_COMPRESSED | OFFSET_MASK):
+                yield position, length, True, False, depth
+            elif self.backing is not None:
+                for extent in self.backing.extents(position, position + length, depth + 1):
+                    yield extent
+            else:
+                yield position, length, False, True, depth
+            position += length
+        if end > image_end:
+            yield image_end, end - image_end, False, True, depth
+
+    def info(self):
+        """
+        Returns qemu-img info like dictionary.
+        """
+        info = super(Qcow2Image, self).info()
+        info.update({'cluster-size': self.cluster_size, 'virtual-size': self.size,
+                     'format-specific': {'type': 'qcow2',
+                                         'data': {'compat': '0.10' if self.version == 2
+                                                            else '1.1'}}})
+        if self.backing is not None:
+            info['backing-filename'] = self.backing_file
+            info['full-backing-filename'] = self.backing.path
+            info['backing-filename-format'] = self.backing.format
+        return info
+
+    def close(self):
+        """
+        Closes the image file and its backing chain.
+        """
+        if self.backing is not None:
+            self.backing.close()
+        self.handle.close()
+
+def _actual_size(path):
+    """
+    Helper function: returns bytes allocated on disk for path.
+    """
+    stat = os.stat(path)
+    return getattr(stat, 'st_blocks', stat.st_size // 512) * 512
+
+def open_image(path, disk_format=None, depth=0):
+    """
+    Opens path as qcow2 or raw image, probing the format when not given.
+
+    - **parameters**, **types**, **return** and **return types**::
+
+        param path: image path
+        type path: str
+        param disk_format: 'qcow2' or 'raw', probed from the magic when None
+        type disk_format: str
+        returns image: readable image
+        type: RawImage or Qcow2Image
+    """
+    if disk_format is None:
+        with open(path, 'rb') as image_file:
+            disk_format = 'qcow2' if image_file.read(4) == QCOW2_MAGIC else 'raw'
+    if disk_format == 'qcow2':
+        return Qcow2Image(path, depth=depth)
+    if disk_format == 'raw':
+        return RawImage(path)
+    raise ImageConverterException("image format {} of {} is not supported".format(
+        disk_format, path))
+
+def write_raw(image, output, offset=0, size=None, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Writes guest range [offset, offset + size) of image to output as raw.
+    All zero chunks are left as holes. progress is called with the percent
+    done after every chunk.
+    """
+    size = image.size - offset if size is None else size
+    zeros = bytes(bytearray(chunk_size))
+    done = 0
+    with open(output, 'wb') as raw_file:
+        for chunk in image.iter_chunks(offset, size, chunk_size):
+            if chunk.tobytes() != zeros[:len(chunk)]:
+                raw_file.seek(done)
+                raw_file.write(chunk)
+            done += len(chunk)
+            if progress:
+                progress(100.0 * done / size)
+        raw_file.truncate(size)
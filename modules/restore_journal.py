@@ -0,0 +1,98 @@
+"""
+Restore journal
+
+Durable SQLite record of the restore stages every vm finished: converted
+raw disks, uploaded objects with their digests, submitted import tasks,
+snapshots, AMI with the client token of its launch, and the instance. Every checkpoint is committed as soon as its stage is
+done, so a restore killed at any point resumes from the last finished
+stage, re-attaches to import tasks already running in EC2 and launches
+with the journaled client token, which EC2 answers with the instance it
+already started. Checkpoints of a vm are dropped once its instance is
+launched and journaled.
+"""
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS checkpoints (
+        vm_key TEXT,
+        stage TEXT,
+        vm_id TEXT,
+        data TEXT,
+        updated_at REAL,
+        PRIMARY KEY (vm_key, stage))""",
+]
+
+def vm_key(vm_dict):
+    """
+    Returns the journal key of a vm: its directory in the snapshot, which
+    tells apart restores of the same vm from different snapshots.
+    """
+    return vm_dict.get('path') or vm_dict.get('id')
+
+class RestoreJournal(object):
+    """
+    SQLite journal of finished restore stages.
+    """
+    def __init__(self, journal_path):
+        """
+        constructor of RestoreJournal class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param journal_path: Path of the sqlite database file
+            type journal_path: str
+        """
+        self.journal_path = journal_path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(journal_path, check_same_thread=False)
+        with self.lock, self.conn:
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        with self.lock:
+            self.conn.close()
+
+    def checkpoints(self, vm_dict):
+        """
+        Returns data of every stage vm_dict finished, keyed by stage.
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT stage, data FROM checkpoints WHERE vm_key = ?",
+                (vm_key(vm_dict),)).fetchall()
+        return dict((stage, json.loads(data)) for stage, data in rows)
+
+    def record(self, vm_dict, stage, data):
+        """
+        Commits data of a finished stage of vm_dict.
+        """
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?)",
+                (vm_key(vm_dict), stage, vm_dict.get('id'), json.dumps(data), time.time()))
+        logger.debug("journaled %s of vm %s", stage, vm_dict.get('id'))
+
+    def discard(self, vm_dict, stages=None):
+        """
+        Forgets given stages of vm_dict, every stage when None, so they run
+        again on the next restore.
+        """
+        with self.lock, self.conn:
+            if stages is None:
+                self.conn.execute("DELETE FROM checkpoints WHERE vm_key = ?",
+                                  (vm_key(vm_dict),))
+            else:
+                for stage in stages:
+                    self.conn.execute(
+                        "DELETE FROM checkpoints WHERE vm_key = ? AND stage = ?",
+                        (vm_key(vm_dict), stage))
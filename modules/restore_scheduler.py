@@ -0,0 +1,160 @@
+"""
+Restore scheduler
+
+Restores many vms as a pipeline. Every stage (e.g. convert, upload,
+import, launch) has its own queue and its own pool of workers sized by the
+stage's concurrency limit, so while one vm imports its snapshots the next
+one is already uploading and a third one converting. A vm that fails a
+stage skips the remaining stages and the other vms carry on.
+"""
+import time
+import logging
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from modules.metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+class RestoreJob(object):
+    """
+    State of one vm going through the pipeline.
+    """
+    def __init__(self, vm_dict):
+        """
+        constructor of RestoreJob class
+        """
+        self.vm_dict = vm_dict
+        self.state = {}
+        self.timings = {}
+        self.stage = None
+        self.error = None
+
+    @property
+    def name(self):
+        """
+        Name of the vm, its id when unnamed.
+        """
+        return self.vm_dict.get('name') or self.vm_dict.get('id')
+
+    @property
+    def failed(self):
+        """
+        True when a stage raised.
+        """
+        return self.error is not None
+
+class RestoreScheduler(object):
+    """
+    Runs jobs through stages with a concurrency limit per stage.
+    """
+    def __init__(self, stages, limits=None, progress_callback=None, max_active=None):
+        """
+        constructor of RestoreScheduler class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param stages: ordered (name, func) pairs, func is called with a
+                          RestoreJob and records its results in job.state
+            type stages: list
+            param limits: workers per stage name, 1 for stages not listed
+            type limits: dict
+            param progress_callback: called with (job, stage name, event) where
+                                     event is 'started', 'done' or 'failed'
+            type progress_callback: callable
+            param max_active: jobs in the pipeline at once, all when None
+            type max_active: int
+        """
+        self.stages = list(stages)
+        self.limits = limits or {}
+        self.progress_callback = progress_callback
+        self.max_active = max_active
+
+    def _notify(self, job, stage, event):
+        """
+        Helper function: reports stage events, a failing callback is logged
+        and never stops the pipeline.
+        """
+        if self.progress_callback:
+            try:
+                self.progress_callback(job, stage, event)
+            except Exception:
+                logger.exception("progress callback failed on %s of vm %s in %s",
+                                 event, job.name, stage)
+
+    def run(self, vm_dicts):
+        """
+        Restores given vms and returns their RestoreJobs in input order
+        once every job finished or failed.
+        """
+        jobs = [RestoreJob(vm_dict) for vm_dict in vm_dicts]
+        if not jobs:
+            return jobs
+        queues = [queue.Queue() for _ in self.stages]
+        remaining = [len(jobs)]
+        finished = threading.Condition()
+        active = threading.Semaphore(self.max_active or len(jobs))
+
+        def finish(job):
+            """
+            Marks job as out of the pipeline.
+            """
+            active.release()
+            with finished:
+                remaining[0] -= 1
+                finished.notify_all()
+
+        def worker(index):
+            """
+            Runs stage index for jobs taken from its queue.
+            """
+            name, func = self.stages[index]
+            while True:
+                job = queues[index].get()
+                if job is None:
+                    return
+                job.stage = name
+                self._notify(job, name, 'started')
+                start = time.time()
+                try:
+                    func(job)
+                except Exception as err:
+                    job.error = err
+                    logger.exception("restore of vm %s failed in %s", job.name, name)
+                finally:
+                    # the job always moves on, run() waits for every job to finish
+                    job.timings[name] = time.time() - start
+                    METRICS.observe('restore_stage', job.timings[name], stage=name,
+                                    status='failed' if job.failed else 'ok')
+                    if job.failed:
+                        self._notify(job, name, 'failed')
+                        finish(job)
+                    else:
+                        logger.info("vm %s finished %s in %.2f seconds", job.name, name,
+                                    job.timings[name])
+                        self._notify(job, name, 'done')
+                        if index + 1 < len(self.stages):
+                            queues[index + 1].put(job)
+                        else:
+                            finish(job)
+
+        threads = []
+        for index, (name, _) in enumerate(self.stages):
+            for _ in range(max(int(self.limits.get(name, 1)), 1)):
+                thread = threading.Thread(target=worker, args=(index,))
+                thread.daemon = True
+                thread.start()
+                threads.append((index, thread))
+        for job in jobs:
+            active.acquire()
+            queues[0].put(job)
+        with finished:
+            while remaining[0]:
+                finished.wait(1)
+        for index, _ in threads:
+            queues[index].put(None)
+        for _, thread in threads:
+            thread.join()
+        return jobs
@@ -0,0 +1,152 @@
+"""
+Streaming S3 upload
+
+Uploads a qcow2 disk to S3 as raw without writing a full size raw file.
+The guest visible disk is cut into part sized windows, each window is
+converted by qemu-img into a small scratch file and sent as one part of a
+multipart upload. Up to workers windows are in flight, so conversion of one
+part overlaps the upload of another and scratch space stays bounded at
+workers x part_size. Windows the disk's allocation map shows as holes are
+not converted at all, their parts are sent as zeros from memory. Parts
+are hashed as they are sent, see modules.digests.
+"""
+import os
+import time
+import shutil
+import logging
+import tempfile
+from modules.utils import parallel_map, ImageConverterException
+from modules.sparse import SparseFile
+from modules.metrics import METRICS
+from modules.digests import (\
+    DigestReader, zero_digests, object_digests, check_part, check_object)
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+MAX_PARTS = 10000
+
+class StreamingUploader(object):
+    """
+    Converts and uploads disks part by part through multipart uploads.
+    """
+    def __init__(self, scheduler, s3_client, bucket, part_size=64 * MB, workers=4,
+                 scratch_dir=None, acl='public-read'):
+        """
+        constructor of StreamingUploader class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param scheduler: converter used to probe disks and convert windows
+            type scheduler: modules.conversion_scheduler.ConversionScheduler
+            param s3_client: boto3 S3 client
+            type s3_client: botocore.client.S3
+            param bucket: s3 bucket name
+            type bucket: str
+            param part_size: multipart part size in bytes, at least 5 MB
+            type part_size: int
+            param workers: parts converted and uploaded at the same time
+            type workers: int
+            param scratch_dir: directory for in flight parts, system temp if None
+            type scratch_dir: str
+            param acl: canned ACL of uploaded objects
+            type acl: str
+        """
+        self.scheduler = scheduler
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.part_size = max(int(part_size), 5 * MB)
+        self.workers = max(int(workers), 1)
+        self.scratch_dir = scratch_dir
+        self.acl = acl
+
+    def upload_disk(self, disk, key):
+        """
+        Streams given qcow2 disk to s3://bucket/key as raw and returns a
+        report with bytes, allocated bytes, parts, zero parts, seconds, MB/s
+        and digests.
+        """
+        info = self.scheduler.info(disk)
+        virtual_size = int(info['virtual-size'])
+        allocation = self.scheduler.map(disk, virtual_size)
+        disk_format = info.get('format', 'qcow2')
+        part_size = max(self.part_size, -(-virtual_size // MAX_PARTS))
+        windows = [(number, offset, min(part_size, virtual_size - offset))
+                   for number, offset in enumerate(range(0, virtual_size, part_size), 1)]
+        start = time.time()
+        if not windows:
+            self.s3_client.put_object(Bucket=self.bucket, Key=key, ACL=self.acl, Body=b'')
+            return {'bytes': 0, 'allocated_bytes': 0, 'parts': 0, 'zero_parts': 0,
+                    'seconds': time.time() - start, 'mb_per_s': None,
+                    'digests': object_digests([dict(zero_digests(0), number=1)], part_size,
+                                              multipart=False)}
+        scratch = tempfile.mkdtemp(prefix='trilio_parts_', dir=self.scratch_dir)
+        upload = self.s3_client.create_multipart_upload(
+            Bucket=self.bucket, Key=key, ACL=self.acl)
+        upload_id = upload['UploadId']
+        zero_parts = []
+
+        def send(window):
+            """
+            Converts one window and uploads it as a part, returns (part, digest).
+            """
+            number, offset, size = window
+            if allocation is not None and allocation.is_zero(offset, size):
+                zero_parts.append(number)
+                with METRICS.timer('upload_part', mode='stream', zero=True) as timer:
+                    part = self.s3_client.upload_part(
+                        Bucket=self.bucket, Key=key, UploadId=upload_id,
+                        PartNumber=number, Body=b'\0' * size)
+                    timer.bytes = size
+                digest = dict(zero_digests(size), number=number)
+                check_part(part['ETag'], digest, disk)
+                return {'PartNumber': number, 'ETag': part['ETag']}, digest
+            part_path = os.path.join(scratch, 'part_{}'.format(number))
+            try:
+                with METRICS.timer('convert_window', engine='native' if self.scheduler.native
+                                   else 'qemu-img') as timer:
+                    self.scheduler.convert_window(disk, disk_format, offset, size, part_path)
+                    timer.bytes = size
+                if os.path.getsize(part_path) != size:
+                    raise ImageConverterException("part {} of {} has {} bytes, expected {}"\
+                        .format(number, disk, os.path.getsize(part_path), size))
+                with SparseFile(part_path) as part_file, \
+                        METRICS.timer('upload_part', mode='stream', zero=False) as timer:
+                    body = DigestReader(part_file)
+                    part = self.s3_client.upload_part(
+                        Bucket=self.bucket, Key=key, UploadId=upload_id,
+                        PartNumber=number, Body=body)
+                    digest = dict(body.hexdigests(), number=number)
+                    timer.bytes = size
+            finally:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+            check_part(part['ETag'], digest, disk)
+            return {'PartNumber': number, 'ETag': part['ETag']}, digest
+
+        try:
+            sent = parallel_map(send, windows, self.workers)
+            completed = self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': [part for part, _ in sent]})
+        except Exception:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        digests = object_digests([digest for _, digest in sent], part_size)
+        check_object(completed.get('ETag', ''), digests, disk)
+        seconds = time.time() - start
+        report = {
+            'bytes': virtual_size,
+            'allocated_bytes': None if allocation is None else allocation.allocated_bytes,
+            'parts': len(windows),
+            'zero_parts': len(zero_parts),
+            'seconds': seconds,
+            'mb_per_s': virtual_size / float(MB) / seconds if seconds else None,
+            'digests': digests,
+        }
+        METRICS.observe('upload', seconds, virtual_size, mode='stream')
+        logger.info("object %s streamed to s3 %s", disk, report)
+        return report
@@ -0,0 +1,173 @@
+"""
+S3 upload engine
+
+Uploads raw disks with multipart uploads from a thread pool sharing one
+boto3 client, so every part reuses pooled connections instead of paying an
+aws cli start per disk. Several disks go up at once, every part is retried
+on its own and per disk throughput and retries are reported. Parts are
+hashed as they are sent, see modules.digests.
+"""
+import os
+import time
+import logging
+import threading
+from modules.utils import parallel_map, ImageConverterException
+from modules.sparse import SparseFile
+from modules.metrics import METRICS
+from modules.digests import DigestReader, object_digests, check_part, check_object
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+MAX_PARTS = 10000
+
+class MultipartUploader(object):
+    """
+    Uploads files to S3 with parallel multipart uploads.
+    """
+    def __init__(self, s3_client, bucket, part_size=64 * MB, threads=8, disks=2,
+                 max_attempts=5, backoff=0.5, acl='public-read'):
+        """
+        constructor of MultipartUploader class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param s3_client: boto3 S3 client shared by all threads
+            type s3_client: botocore.client.S3
+            param bucket: s3 bucket name
+            type bucket: str
+            param part_size: multipart part size in bytes, at least 5 MB
+            type part_size: int
+            param threads: parts uploaded at the same time per disk
+            type threads: int
+            param disks: disks uploaded at the same time
+            type disks: int
+            param max_attempts: attempts per part before the upload is aborted
+            type max_attempts: int
+            param backoff: seconds before the first retry, doubled on every retry
+            type backoff: float
+            param acl: canned ACL of uploaded objects
+            type acl: str
+        """
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.part_size = max(int(part_size), 5 * MB)
+        self.threads = max(int(threads), 1)
+        self.disks = max(int(disks), 1)
+        self.max_attempts = max(int(max_attempts), 1)
+        self.backoff = backoff
+        self.acl = acl
+        self.reports = {}
+        self.lock = threading.Lock()
+
+    def _attempt(self, path, description, func):
+        """
+        Helper function: calls func until it succeeds or max_attempts is
+        reached, returns (result, retries).
+        """
+        for attempt in range(self.max_attempts):
+            try:
+                return func(), attempt
+            except Exception as err:
+                if attempt + 1 == self.max_attempts:
+                    raise ImageConverterException("{} of {} failed after {} attempts: {}"\
+                        .format(description, path, self.max_attempts, err))
+                delay = self.backoff * 2 ** attempt
+                logger.warning("%s of %s failed (%s), retrying in %.1f seconds",
+                               description, path, err, delay)
+                time.sleep(delay)
+
+    def upload_file(self, path, key=None):
+        """
+        Uploads path to s3://bucket/key, key defaults to the file name.
+        Returns a report with bytes, parts, retries, seconds, MB/s and digests.
+        """
+        key = key or os.path.basename(path)
+        size = os.path.getsize(path)
+        part_size = max(self.part_size, -(-size // MAX_PARTS))
+        start = time.time()
+        if size <= part_size:
+            def put():
+                """
+                Uploads the whole file with a single request.
+                """
+                with SparseFile(path) as raw_file, \
+                        METRICS.timer('upload_part', mode='multipart') as timer:
+                    body = DigestReader(raw_file)
+                    response = self.s3_client.put_object(Bucket=self.bucket, Key=key,
+                                                         ACL=self.acl, Body=body)
+                    timer.bytes = size
+                    digest = dict(body.hexdigests(), number=1)
+                check_part(response['ETag'], digest, path)
+                return digest
+            digest, retries = self._attempt(path, "put", put)
+            digests = object_digests([digest], part_size, multipart=False)
+            parts = 1
+        else:
+            retries, digests = self._upload_parts(path, key, size, part_size)
+            parts = -(-size // part_size)
+        seconds = time.time() - start
+        report = {
+            'bytes': size,
+            'parts': parts,
+            'retries': retries,
+            'seconds': seconds,
+            'mb_per_s': size / float(MB) / seconds if seconds else None,
+            'digests': digests,
+        }
+        METRICS.observe('upload', seconds, size, mode='multipart')
+        with self.lock:
+            self.reports[path] = report
+        logger.info("object %s copy Done.. %s", path, report)
+        return report
+
+    def _upload_parts(self, path, key, size, part_size):
+        """
+        Helper function: multipart upload of path, returns number of retries
+        and digests.
+        """
+        upload = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=key,
+                                                        ACL=self.acl)
+        upload_id = upload['UploadId']
+
+        def send(number):
+            """
+            Uploads one part, returns (part, digest, retries).
+            """
+            offset = (number - 1) * part_size
+
+            def put_part():
+                """
+                Reads and uploads the part.
+                """
+                with SparseFile(path, offset, min(part_size, size - offset)) as part_file, \
+                        METRICS.timer('upload_part', mode='multipart') as timer:
+                    body = DigestReader(part_file)
+                    part = self.s3_client.upload_part(
+                        Bucket=self.bucket, Key=key, UploadId=upload_id,
+                        PartNumber=number, Body=body)
+                    timer.bytes = part_file.end - part_file.start
+                    digest = dict(body.hexdigests(), number=number)
+                check_part(part['ETag'], digest, path)
+                return {'PartNumber': number, 'ETag': part['ETag']}, digest
+            (part, digest), retries = self._attempt(path, "part {}".format(number), put_part)
+            return part, digest, retries
+
+        try:
+            sent = parallel_map(send, range(1, -(-size // part_size) + 1), self.threads)
+            completed = self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': [part for part, _, _ in sent]})
+        except Exception:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=key,
+                                                  UploadId=upload_id)
+            raise
+        digests = object_digests([digest for _, digest, _ in sent], part_size)
+        check_object(completed.get('ETag', ''), digests, path)
+        return sum(retries for _, _, retries in sent), digests
+
+    def upload_files(self, paths):
+        """
+        Uploads paths, several at once, and returns their reports in order.
+        """
+        return parallel_map(self.upload_file, paths, self.disks)
@@ -0,0 +1,128 @@
+"""
+Lazy snapshot handles
+
+A handle knows the snapshot directory up front and reads and decorates its
+snapshot_db only when a field other than path/name is accessed, so code that
+selects one snapshot out of thousands does not pay for the rest.
+"""
+from os import path
+import heapq
+import threading
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+from modules.utils import get_data, get_timestamp, build_snapshot_record, load_snapshot
+
+class LazySnapshot(MutableMapping):
+    """
+    Snapshot dictionary loaded on first access.
+    """
+    def __init__(self, snapshot_path, data=None):
+        """
+        constructor of LazySnapshot class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param snapshot_path: Path of the snapshot directory
+            type snapshot_path: str
+            param data: already read snapshot_db data, decorated on first access
+            type data: dict
+        """
+        self.path = snapshot_path
+        self.name = path.basename(snapshot_path)
+        self._raw = data
+        self._data = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        """
+        True once snapshot_db has been read and decorated.
+        """
+        return self._data is not None
+
+    def load(self):
+        """
+        Reads and decorates snapshot_db once and returns the record.
+        """
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    if self._raw is not None:
+                        self._data = build_snapshot_record(self.path, self._raw)
+                    else:
+                        self._data = load_snapshot(self.path)
+                    self._raw = None
+        return self._data
+
+    def __getitem__(self, key):
+        if key == 'path' and self._data is None:
+            return self.path
+        return self.load()[key]
+
+    def __setitem__(self, key, value):
+        self.load()[key] = value
+
+    def __delitem__(self, key):
+        del self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+    def __repr__(self):
+        return "<LazySnapshot {} loaded={}>".format(self.path, self.loaded)
+
+def _mtime_key(snapshot_path):
+    """
+    Helper function: sort key from snapshot_db mtime, only stats the file.
+    """
+    return path.getmtime(path.join(snapshot_path, 'snapshot_db')), None
+
+def _updated_at_key(snapshot_path):
+    """
+    Helper function: sort key from undecorated updated_at of snapshot_db.
+    """
+    data = get_data(path.join(snapshot_path, 'snapshot_db'))
+    return get_timestamp(data.get('updated_at')), data
+
+SIGNALS = {
+    'mtime': _mtime_key,
+    'updated_at': _updated_at_key,
+}
+
+# snapshots kept by mtime, besides count, before updated_at orders them
+SHORTLIST_EXTRA = 16
+
+def _nlargest(count, snapshot_paths, key_func):
+    """
+    Helper function: count largest (key, snapshot_path) pairs by key_func.
+    """
+    keyed = ((key_func(snapshot_path), snapshot_path) for snapshot_path in snapshot_paths)
+    return heapq.nlargest(count, keyed, key=lambda item: item[0][0])
+
+def select_latest(snapshot_paths, count=1, signal='updated_at'):
+    """
+    Returns handles of the count most recent snapshots, newest first.
+
+    - **parameters**, **types**, **return** and **return types**::
+
+        param snapshot_paths: Paths of the snapshot directories
+        type snapshot_paths: list
+        param count: number of snapshots to return
+        type count: int
+        param signal: 'mtime' stats snapshot_db only, 'updated_at' stats every
+                      snapshot_db, then reads the most recently modified
+                      count + SHORTLIST_EXTRA ones and orders those by updated_at
+        type signal: str
+        returns snapshots:
+        type: list
+    """
+    if signal == 'updated_at':
+        snapshot_paths = [snapshot_path for _, snapshot_path in
+                          _nlargest(count + SHORTLIST_EXTRA, snapshot_paths, _mtime_key)]
+    latest = _nlargest(count, snapshot_paths, SIGNALS[signal])
+    return [LazySnapshot(snapshot_path, data) for (_, data), snapshot_path in latest]
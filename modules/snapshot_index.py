@@ -0,0 +1,154 @@
+"""
+Snapshot lookup index
+
+Maps snapshot names and ids to (workload, snapshot path) using directory
+names only, so a lookup never reads snapshot_db files. Every lookup
+stats the directories of the workloads it searches, one stat each, and a
+workload is re-listed only when its directory mtime changed.
+"""
+import os
+from os import path
+import bisect
+import threading
+from modules.utils import WorkloadException
+
+PREFIX = "snapshot_"
+
+class SnapshotIndex(object):
+    """
+    Session wide snapshot id to (workload, snapshot path) index.
+    """
+    def __init__(self, trilio_base_dir):
+        """
+        constructor of SnapshotIndex class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param trilio_base_dir: Trilio vault base directory
+            type trilio_base_dir: str
+        """
+        self.base_dir = trilio_base_dir
+        self.lock = threading.Lock()
+        self.workloads = {}
+        self.snapshots = {}
+        self.sorted_ids = None
+        self.base_mtime = None
+
+    def lookup(self, snap_shot_name, workload=None):
+        """
+        Returns (workload, snapshot path) of the snapshot whose id or
+        directory name is snap_shot_name, or whose id starts with it.
+        Returns None when nothing matches and raises WorkloadException
+        when a prefix matches several snapshots.
+
+        - **parameters**, **types**, **return** and **return types**::
+            param snap_shot_name: snapshot id, id prefix or directory name
+            type snap_shot_name: str
+            param workload: restricts the lookup to given workload
+            type workload: str
+            returns workload and snapshot path:
+            type: tuple
+        """
+        snap_id = snap_shot_name[len(PREFIX):] \
+            if snap_shot_name.startswith(PREFIX) else snap_shot_name
+        with self.lock:
+            # a snapshot added since the last listing can make a prefix ambiguous
+            self._sync(workload)
+            found = self._find(snap_id, workload)
+            if found is None or not path.isdir(found[1]):
+                self._refresh()
+                found = self._find(snap_id, workload)
+        return found
+
+    def invalidate(self, workload=None):
+        """
+        Forgets given workload or the whole index.
+        """
+        with self.lock:
+            for name in ([workload] if workload else list(self.workloads)):
+                self._drop_workload(name)
+
+    def _find(self, snap_id, workload):
+        """
+        Helper function: exact id match first, then unique id prefix.
+        """
+        entry = self.snapshots.get(snap_id)
+        if entry is not None and workload in (None, entry[0]):
+            return entry
+        if self.sorted_ids is None:
+            self.sorted_ids = sorted(self.snapshots)
+        matches = []
+        position = bisect.bisect_left(self.sorted_ids, snap_id)
+        while position < len(self.sorted_ids) and \
+              self.sorted_ids[position].startswith(snap_id):
+            entry = self.snapshots[self.sorted_ids[position]]
+            if workload in (None, entry[0]):
+                matches.append(entry)
+            position += 1
+        if len(matches) > 1:
+            raise WorkloadException(
+                "snapshot prefix {} matches {} snapshots".format(snap_id, len(matches)))
+        return matches[0] if matches else None
+
+    def _sync(self, workload):
+        """
+        Helper function: re-lists given workload, or every workload and the
+        vault itself when None, if its directory changed since it was listed.
+        """
+        if workload is None:
+            try:
+                base_mtime = os.stat(self.base_dir).st_mtime
+            except OSError:
+                return
+            if base_mtime != self.base_mtime:
+                self._refresh()
+                return
+        for name in ([workload] if workload is not None else list(self.workloads)):
+            if name in self.workloads:
+                self._check_workload(name)
+
+    def _refresh(self):
+        """
+        Helper function: re-lists workloads whose directory changed.
+        """
+        self.base_mtime = os.stat(self.base_dir).st_mtime
+        names = set(name for name in os.listdir(self.base_dir)
+                    if name.startswith("workload_"))
+        for name in set(self.workloads) - names:
+            self._drop_workload(name)
+        for name in names:
+            self._check_workload(name)
+
+    def _check_workload(self, name):
+        """
+        Helper function: re-lists workload name when its directory mtime
+        changed, drops it when the directory is gone.
+        """
+        workload_path = path.join(self.base_dir, name)
+        try:
+            mtime = os.stat(workload_path).st_mtime
+        except OSError:
+            self._drop_workload(name)
+            return
+        known = self.workloads.get(name)
+        if known is not None and known[0] == mtime:
+            return
+        self._drop_workload(name)
+        snap_ids = [directory[len(PREFIX):] for directory in os.listdir(workload_path)
+                    if directory.startswith(PREFIX)]
+        for snap_id in snap_ids:
+            self.snapshots[snap_id] = (name, path.join(workload_path, PREFIX + snap_id))
+        self.workloads[name] = (mtime, snap_ids)
+        self.sorted_ids = None
+
+    def _drop_workload(self, name):
+        """
+        Helper function: removes snapshots of given workload.
+        """
+        known = self.workloads.pop(name, None)
+        if known is None:
+            return
+        for snap_id in known[1]:
+            if self.snapshots.get(snap_id, (None,))[0] == name:
+                del self.snapshots[snap_id]
+        self.sorted_ids = None
@@ -0,0 +1,142 @@
+"""
+Sparse image helpers
+
+Allocation maps from qemu-img map and a reader which serves the holes of a
+sparse raw file as zeros from memory instead of reading them from disk.
+"""
+import os
+import errno
+import bisect
+
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+class AllocationMap(object):
+    """
+    Guest visible extents of an image as reported by qemu-img map.
+    """
+    def __init__(self, extents, virtual_size):
+        """
+        constructor of AllocationMap class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param extents: qemu-img map --output=json entries
+            type extents: list
+            param virtual_size: guest visible size of the image
+            type virtual_size: int
+        """
+        self.virtual_size = virtual_size
+        self.data = [(extent['start'], extent['start'] + extent['length'])
+                     for extent in sorted(extents, key=lambda extent: extent['start'])
+                     if extent.get('data') and not extent.get('zero')]
+        self.starts = [start for start, _ in self.data]
+
+    @property
+    def allocated_bytes(self):
+        """
+        Number of guest bytes backed by data.
+        """
+        return sum(end - start for start, end in self.data)
+
+    def is_zero(self, offset, size):
+        """
+        True when [offset, offset + size) holds no data.
+        """
+        position = bisect.bisect_right(self.starts, offset + size - 1) - 1
+        while position >= 0:
+            start, end = self.data[position]
+            if end <= offset:
+                return True
+            if start < offset + size:
+                return False
+            position -= 1
+        return True
+
+class SparseFile(object):
+    """
+    Read only file object which skips holes with SEEK_DATA/SEEK_HOLE.
+    """
+    def __init__(self, filepath, offset=0, size=None):
+        """
+        constructor of SparseFile class, reads size bytes from offset
+        """
+        self.descriptor = os.open(filepath, os.O_RDONLY)
+        self.start = offset
+        self.end = os.fstat(self.descriptor).st_size if size is None else offset + size
+        self.position = offset
+        self.read_bytes = 0
+        self.zero_bytes = 0
+        self.sparse = True
+
+    def _next_data(self, position):
+        """
+        Helper function: returns (data start, data end) at or after position.
+        """
+        if not self.sparse:
+            return position, self.end
+        try:
+            data_start = os.lseek(self.descriptor, position, SEEK_DATA)
+            data_end = os.lseek(self.descriptor, data_start, SEEK_HOLE)
+        except OSError as err:
+            if err.errno == errno.ENXIO:  # no data after position
+                return self.end, self.end
+            self.sparse = False
+            return position, self.end
+        return min(data_start, self.end), min(data_end, self.end)
+
+    def read(self, size=-1):
+        """
+        Returns up to size bytes, holes are filled with zeros.
+        """
+        if size is None or size < 0:
+            size = self.end - self.position
+        size = min(size, self.end - self.position)
+        chunks = []
+        while size > 0:
+            data_start, data_end = self._next_data(self.position)
+            if data_start > self.position:
+                zeros = min(data_start - self.position, size)
+                chunks.append(b'\0' * zeros)
+                self.zero_bytes += zeros
+            else:
+                length = min(data_end - self.position, size)
+                os.lseek(self.descriptor, self.position, os.SEEK_SET)
+                chunk = os.read(self.descriptor, length)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                self.read_bytes += len(chunk)
+            self.position += len(chunks[-1])
+            size -= len(chunks[-1])
+        return b''.join(chunks)
+
+    def seek(self, offset, whence=0):
+        """
+        Moves the read position, offsets are relative to the reader's start.
+        """
+        if whence == 0:
+            self.position = self.start + offset
+        elif whence == 1:
+            self.position += offset
+        else:
+            self.position = self.end + offset
+        return self.tell()
+
+    def tell(self):
+        """
+        Returns read position relative to the reader's start.
+        """
+        return self.position - self.start
+
+    def close(self):
+        """
+        Closes the file descriptor.
+        """
+        os.close(self.descriptor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -2,8 +2,13 @@
 Utility functions
 """
 import json
+import re
+import calendar
+from os import path
 from logging.config import dictConfig
+from multiprocessing.pool import ThreadPool
 import dateutil.parser
+from modules import json_loader
 
 class WorkloadException(Exception):
     def __init__(self,*args,**kwargs):
@@ -17,14 +22,17 @@ class BotoException(Exception):
     def __init__(self,*args,**kwargs):
         Exception.__init__(self,*args,**kwargs)
 
+class ImportTaskFailed(ImageConverterException):
+    def __init__(self,*args,**kwargs):
+        ImageConverterException.__init__(self,*args,**kwargs)
+
 def get_data(filepath):
     """
-    Read data from JSON and returns dictionary
+    Read data from JSON and returns dictionary, served from the shared
+    json_loader cache while the file is unchanged. Returned data is shared
+    between callers and must not be modified.
     """
-    with open(filepath, 'r') as filepointer:
-        str_data = filepointer.read()
-        data = json.loads(str_data)
-    return data
+    return json_loader.LOADER.load(filepath)
 
 def load_data(filepath, data):
     """
@@ -32,13 +40,107 @@ def load_data(filepath, data):
     """
     with open(filepath, 'w') as filepointer:
         json.dump(data, filepointer, indent=4)
+    json_loader.LOADER.invalidate(filepath)
     return True
 
+def parallel_map(func, items, workers=1):
+    """
+    Applies func to every item with a bounded thread pool and returns
+    results in the order of items. Runs in the calling thread when
+    workers is 1 or there is at most one item.
+    """
+    items = list(items)
+    workers = min(int(workers or 1), len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def load_snapshot(snapshot_path):
+    """
+    Reads snapshot_db of given snapshot directory and returns decorated record
+    """
+    return build_snapshot_record(snapshot_path, get_data(path.join(snapshot_path, 'snapshot_db')))
+
+ISO_TIME = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?'
+    r'(Z|[+-]\d{2}:?\d{2})?$')
+TIME_CACHE = {}
+TIME_CACHE_SIZE = 100000
+
+def _parse_iso_time(iso_time):
+    """
+    Helper function: returns ('%Y-%m-%d %H:%M:%S' wall time, epoch seconds)
+    """
+    match = ISO_TIME.match(iso_time)
+    if not match:
+        parsed = dateutil.parser.parse(iso_time)
+        timetuple = parsed.utctimetuple() if parsed.tzinfo else parsed.timetuple()
+        return (parsed.strftime('%Y-%m-%d %H:%M:%S'),
+                calendar.timegm(timetuple) + parsed.microsecond / 1e6)
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    timestamp = calendar.timegm((int(year), int(month), int(day),
+                                 int(hour), int(minute), int(second)))
+    if fraction:
+        timestamp += int(fraction[:6].ljust(6, '0')) / 1e6
+    if zone and zone != 'Z':
+        offset = (int(zone[1:3]) * 60 + int(zone[-2:])) * 60
+        timestamp += -offset if zone[0] == '+' else offset
+    wall_time = '{}-{}-{} {}:{}:{}'.format(year, month, day, hour, minute, second)
+    return wall_time, timestamp
+
+def parse_iso_time(iso_time):
+    """
+    Returns ('%Y-%m-%d %H:%M:%S' wall time, epoch seconds) of an ISO-8601
+    time written by the vault, memoized per distinct value
+    """
+    parsed = TIME_CACHE.get(iso_time)
+    if parsed is None:
+        parsed = _parse_iso_time(iso_time)
+        if len(TIME_CACHE) >= TIME_CACHE_SIZE:
+            TIME_CACHE.clear()
+        TIME_CACHE[iso_time] = parsed
+    return parsed
+
+def parse_iso_times(iso_times):
+    """
+    Returns list of (wall time, epoch seconds) for a batch of ISO-8601 times
+    """
+    return [parse_iso_time(iso_time) for iso_time in iso_times]
+
 def get_time(iso_time):
     """
     converts ISO time format to UTC
     """
-    return dateutil.parser.parse(iso_time).strftime('%Y-%m-%d %H:%M:%S.%f')[:19]
+    return parse_iso_time(iso_time)[0]
+
+def get_timestamp(iso_time):
+    """
+    converts ISO time format to epoch seconds, comparable without string parsing
+    """
+    return parse_iso_time(iso_time)[1]
+
+def build_snapshot_record(snapshot_path, snapshot_data):
+    """
+    Returns copy of snapshot_db data decorated with path, time and sizes in MB
+    """
+    snapshot_data = dict(snapshot_data)
+    snap_time, timestamp = parse_iso_time(snapshot_data.get("updated_at"))
+    snapshot_data.update(
+        {
+            'path':snapshot_path,
+            'time':snap_time,
+            'timestamp':timestamp,
+            'size_in_mb': bytes_to_mb(snapshot_data.get("size")),
+            'restore_size_in_mb':
+            bytes_to_mb(snapshot_data.get("restore_size")),
+        }
+    )
+    return snapshot_data
 
 def bytes_to_mb(val_in_bytes):
     """
@@ -1,131 +1,170 @@
 """
 Workload parser
 """
-from os import path, walk
-import datetime
+from os import path
 import logging
 logger = logging.getLogger(__name__)
-from modules.utils import get_data, get_time, bytes_to_mb, WorkloadException
+from modules.utils import get_data, load_snapshot, parallel_map, WorkloadException
+from modules.catalog import file_stamp
+from modules.snapshot_handle import select_latest
+from modules.json_stream import iter_json_array
+from modules.snapshot_index import SnapshotIndex
+from modules.enumerator import iter_entries
+from modules.metrics import timed
 
 class Parser(object):
     """
     Workload parser
     """
-    def __init__(self, trilio_base_dir):
+    def __init__(self, trilio_base_dir, catalog=None, workers=1, latest_by='updated_at',
+                 stream=False):
         """
         constructor of Parser class
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param trilio_base_dir: Trilio vault base directory
+            type trilio_base_dir: str
+            param catalog: optional vault catalog used instead of walking the vault
+            type catalog: modules.catalog.Catalog
+            param workers: number of snapshot_db files loaded concurrently
+            type workers: int
+            param latest_by: signal used to pick latest snapshots without the catalog,
+                             'updated_at' of the most recently modified snapshot_db
+                             files or only the 'mtime' of snapshot_db
+            type latest_by: str
+            param stream: stream snapshot_vms_db and resources_db instead of loading
+                          them whole, peak memory is then bounded by the number of vms
+            type stream: bool
         """
         self.base_dir = trilio_base_dir
+        self.catalog = catalog
+        self.workers = workers
+        self.latest_by = latest_by
+        self.stream = stream
+        self.snapshot_index = SnapshotIndex(trilio_base_dir)
         self.res_data = None
         self.vms = None
-    def get_workloads(self):
+    @timed('parser', step='workloads')
+    def get_workloads(self, prefix='', offset=0, limit=None):
         """
         Returns list of workloads under trilio vault directory
         if availabel otherwise returns None.
 
         - **parameters**, **types**, **return** and **return types**::
 
+            param prefix: workload id prefix filter
+            type prefix: str
+            param offset: number of workloads to skip, in name order
+            type offset: int
+            param limit: maximum number of workloads, all when None
+            type limit: int
             returns workloads:
             type: list
         """
-        try:  
-            for root, dirs, files in walk(self.base_dir):
-                if dirs:
-                    workloads = [directory for directory in dirs if directory.startswith("workload_")]
-                    return workloads
-                else:
-                    return None
+        try:
+            if self.catalog:
+                if not offset:
+                    self.catalog.refresh_workloads()
+                return self.catalog.get_workloads(prefix, offset, limit) or None
+            workloads = [name for name, _ in iter_entries(
+                self.base_dir, "workload_" + prefix, offset=offset, limit=limit)]
+            return workloads or None
         except Exception as e:
             raise WorkloadException(e)
 
-    def get_snapshots_from_workload(self, workload_name):
+    def get_workload_data(self, workload):
+        """
+        Returns workload_db data of given workload.
+
+        - **parameters**, **types**, **return** and **return types**::
+
+            param workload: Name of the workload
+            type workload: str
+            returns workload data:
+            type: dict
+        """
+        try:
+            if self.catalog:
+                data = self.catalog.get_workload(workload)
+                if data is not None:
+                    return data
+            return get_data(path.join(self.base_dir, workload, 'workload_db'))
+        except Exception as e:
+            raise WorkloadException(e)
+
+    @timed('parser', step='snapshots')
+    def get_snapshots_from_workload(self, workload_name, prefix='', offset=0, limit=None):
         """
         Returns list of snapshots dictonaries, Each dictionary contains snapshot name,
-        snapshot path, size and snapshot_db inforation.
+        snapshot path, size and snapshot_db inforation. Only the snapshot_db
+        files of the requested page are read.
 
         - **parameters**, **types**, **return** and **return types**::
 
             param workload_name: Name of the workload
             type workload_name: str
+            param prefix: snapshot id prefix filter
+            type prefix: str
+            param offset: number of snapshots to skip, in name order
+            type offset: int
+            param limit: maximum number of snapshots, all when None
+            type limit: int
             returns snapshots:
             type: list
         """
         try:
             path_to_walk = path.join(self.base_dir, workload_name)
-            snapshots = []
-            if path.isdir(path_to_walk) and path.exists(path_to_walk):
-                for root, dirs, files in walk(path_to_walk):
-                    if dirs:
-                        for directory in dirs:
-                            if directory.startswith("snapshot_"):
-                                path_to_snapshot = path.join(path_to_walk, directory)
-                                path_to_snapshot_db = path.join(path_to_snapshot, "snapshot_db")
-                                snapshot_data = get_data(path_to_snapshot_db)
-                                snap_time = get_time(snapshot_data.get("updated_at"))
-                                snapshot_data.update(
-                                    {
-                                        'path':path_to_snapshot,
-                                        'time':snap_time,
-                                        'size_in_mb': bytes_to_mb(snapshot_data.get("size")),
-                                        'restore_size_in_mb':
-                                        bytes_to_mb(snapshot_data.get("restore_size")),
-                                    }
-                                )
-                                snapshots.append(snapshot_data)
-                        return snapshots
-                    else:
-                        logger.info("No snapshots found in %s", workload_name)
-                        return None
-            else:
+            if not path.isdir(path_to_walk):
                 logger.info("Not a directory or path not exist.")
+                return None
+            if self.catalog:
+                if not offset:
+                    self.catalog.refresh_snapshots(workload_name)
+                return self.catalog.get_snapshots(workload_name, prefix, offset, limit)
+            snapshot_paths = [snapshot_path for _, snapshot_path in iter_entries(
+                path_to_walk, "snapshot_" + prefix, offset=offset, limit=limit)]
+            if not snapshot_paths:
+                logger.info("No snapshots found in %s", workload_name)
+            return parallel_map(load_snapshot, snapshot_paths, self.workers)
         except Exception as e:
             raise WorkloadException(e)
+
     def get_snapshot_from_workload(self, snap_shot_name, workload):
         """
-        Returns snapshot dictonary if availabel otherwise returns None.
+        Returns snapshot path if availabel otherwise returns None.
 
         - **parameters**, **types**, **return** and **return types**::
-            param snap_shot_name: Name of the snapshot
+            param snap_shot_name: snapshot id, id prefix or directory name
             type snap_shot_name: str
             param workload: Name of the workload
             type workload: str
-            returns snapshots:
-            type: list
+            returns snapshot path:
+            type: str
         """
-        try:
-            snap_shots = self.get_snapshots_from_workload(workload)
-            if snap_shot_name in snap_shots:
-                #snap_shot_name = "snapshot_" + snap_shot_name
-                snapshot = path.join(self.base_dir, path.join(workload, snap_shot_name))
-                return snapshot
-            else:
-                logger.info("no snap exists with following name %s", snap_shot_name)
-            return None
-        except Exception as e:
-            raise WorkloadException(e)
+        return self.get_snapshot_by_name(snap_shot_name, workload)
 
+    @timed('parser', step='snapshot_by_name')
     def get_snapshot_by_name(self, snap_shot_name, workload=None):
         """
-        Returns snapshot dictonary if availabel otherwise returns None.
+        Returns snapshot path if availabel otherwise returns None. Looked up
+        in the session snapshot index, across all workloads when workload is
+        not given.
 
         - **parameters**, **types**, **return** and **return types**::
-            param snap_shot_name: Name of the snapshot
+            param snap_shot_name: snapshot id, id prefix or directory name
             type snap_shot_name: str
-            param workload_name: Name of the workload
-            type workload_name: str
-            returns snapshots:
-            type: list
+            param workload: Name of the workload
+            type workload: str
+            returns snapshot path:
+            type: str
         """
         try:
-            if workload:
-                return self.get_snapshot_from_workload(snap_shot_name, workload)
-            else:
-                workloads = self.get_workloads()
-                for workloa in workloads:
-                    snapshot = self.get_snapshot_from_workload(snap_shot_name, workloa)
-                    if snapshot:
-                        break
-            return snapshot
+            found = self.snapshot_index.lookup(snap_shot_name, workload)
+            if found:
+                return found[1]
+            logger.info("no snap exists with following name %s", snap_shot_name)
+            return None
         except Exception as e:
             raise WorkloadException(e)
 
@@ -141,15 +180,31 @@ class Parser(object):
             returns snapshot:
             type: dict
         """
+        snapshots = self.get_latest_snapshots(workload, 1)
+        return snapshots[0] if snapshots else None
+
+    @timed('parser', step='latest_snapshots')
+    def get_latest_snapshots(self, workload, count):
+        """
+        Returns the count most recent snapshots of given workload, newest first.
+        Snapshots picked without the catalog are lazy handles which read their
+        snapshot_db on first field access.
+
+        - **parameters**, **types**, **return** and **return types**::
+            param workload: Name of the workload
+            type workload: str
+            param count: number of snapshots to return
+            type count: int
+            returns snapshots:
+            type: list
+        """
         try:
-            snap_shots = self.get_snapshots_from_workload(workload)
-            latest = datetime.datetime.strptime('1800-01-01 00:00:00', '%Y-%m-%d %H:%M:%S')
-            for snap in snap_shots:
-                curr = datetime.datetime.strptime(snap['time'], '%Y-%m-%d %H:%M:%S')
-                if curr > latest:
-                    latest = curr
-                    latest_snap_shot = snap
-            return latest_snap_shot
+            if self.catalog:
+                self.catalog.refresh_snapshots(workload)
+                return self.catalog.get_latest_snapshots(workload, count)
+            snapshot_paths = (snapshot_path for _, snapshot_path in iter_entries(
+                path.join(self.base_dir, workload), "snapshot_", sort=False))
+            return select_latest(snapshot_paths, count, self.latest_by)
         except Exception as e:
             raise WorkloadException(e)
 
@@ -165,58 +220,64 @@ class Parser(object):
             disks.append(disk_path)
         return disks
 
-    def _update_vm_data(self, snap_path):
+    @staticmethod
+    def _update_flavor(vm_dict, res):
+        """
+        Helper function: updates flavor, ram, cpus and swap from flavor resource.
+        """
+        vm_dict.update({'flavor': res.get('resource_name')})
+        for meta in res.get('metadata') or []:
+            if meta.get('key', '') == 'ram':
+                vm_dict.update({'ram_in_mb': int(meta.get('value', 0))})
+            elif meta.get('key', '') == 'vcpus':
+                vm_dict.update({'cpus': int(meta.get('value', 0))})
+            elif meta.get('key', '') == 'swap':
+                vm_dict.update({'swap': meta.get('value', 0)})
+
+    def _update_vm_data(self, snap_path, resources=None):
         """
         update vm_data
+
+        Resources are folded into the vm dictionaries in a single pass as they
+        are read, so resources may be a stream and only per-vm state is kept.
         """
+        if resources is None:
+            resources = self.res_data
+        path_to_network = path.join(snap_path, 'network')
+        path_to_security_group = path.join(snap_path, 'security_group')
+        vms_by_id = {}
+        for vm_dict in self.vms:
+            vms_by_id.setdefault(vm_dict['id'], []).append(vm_dict)
+        subnets = {}
+        private_subnet = (-1, None)
+        for position, res in enumerate(resources):
+            resource_type = res.get('resource_type')
+            if resource_type == 'subnet' and res.get('resource_name') == "private-subnet":
+                private_subnet = (position, res['id'])
+            for vm_dict in vms_by_id.get(res.get('vm_id'), []):
+                if resource_type == 'nic':
+                    vm_dict.update({'nic_db_path':path.join(
+                        path_to_network, 'vm_res_id_' + res['id'], 'network_db')})
+                elif resource_type == 'security_group':
+                    vm_dict.update({'sg_db_path':path.join(
+                        path_to_security_group, 'vm_res_id_' + res['id'], 'security_group_db')})
+                elif resource_type == 'disk':
+                    vm_dict['disk_db_path'].append(path.join(
+                        snap_path, 'vm_id_' + vm_dict['id'], 'vm_res_id_' + res['id'], 'disk_db'))
+                elif resource_type == 'flavor':
+                    self._update_flavor(vm_dict, res)
+                elif resource_type == 'subnet':
+                    subnets[vm_dict['id']] = (position, res['id'])
         for vm_dict in self.vms:
-            for res in self.res_data:
-                if res['vm_id'] == vm_dict['id']:
-                    if res['resource_type'] == 'nic':
-                        path_to_network = path.join(snap_path, 'network')
-                        path_to_network_vm_res_id = path.join(
-                            path_to_network, 'vm_res_id_' + res['id'])
-                        vm_dict.update({
-                            'nic_db_path':path.join(path_to_network_vm_res_id, 'network_db')})
-                    elif res['resource_type'] == 'security_group':
-                        path_to_security_group = path.join(snap_path, 'security_group')
-                        sg_path = path.join(
-                            path_to_security_group, 'vm_res_id_' + res['id'])
-                        vm_dict.update({'sg_db_path':path.join(
-                            sg_path, 'security_group_db')})
-                    elif res['resource_type'] == 'disk':
-                        path_to_vm = path.join(snap_path, 'vm_id_' + vm_dict['id'])
-                        path_to_vm_res_id = path.join(path_to_vm, 'vm_res_id_' + res['id'])
-                        paths = vm_dict.get('disk_db_path', [])
-                        paths.append(path.join(path_to_vm_res_id, 'disk_db'))
-                    elif res['resource_type'] == 'flavor':
-                        vm_dict.update({'flavor': res.get('resource_name')})
-                        metadata = res.get('metadata')
-                        for meta in metadata:
-
-                            if meta.get('key', '') == 'ram':
-                                vm_dict.update({'ram_in_mb': int(meta.get('value', 0))})
-                            elif meta.get('key', '') == 'vcpus':
-                                vm_dict.update({'cpus': int(meta.get('value', 0))})
-                            elif meta.get('key', '') == 'swap':
-                                vm_dict.update({'swap': meta.get('value', 0)})
-                    elif res['resource_type'] == 'subnet':
-
-                        path_to_network = path.join(snap_path, 'network')
-                        path_to_network_vm_res_id = path.join(
-                            path_to_network, 'vm_res_id_' + res['id'])
-                        vm_dict.update({'subnet_path':path.join(\
-                            path_to_network_vm_res_id, 'network_db')})
-
-                if res['resource_type'] == 'subnet':
-                    if res['resource_name'] == "private-subnet":
-                        path_to_network = path.join(snap_path, 'network')
-                        path_to_network_vm_res_id = path.join(
-                            path_to_network, 'vm_res_id_' + res['id'])
-                        vm_dict.update({'subnet_path':path.join(\
-                            path_to_network_vm_res_id, 'network_db')})
+            # the last subnet in resources_db order wins, own or shared private-subnet
+            subnet_id = max(subnets.get(vm_dict['id'], (-1, None)), private_subnet,
+                            key=lambda item: item[0])[1]
+            if subnet_id:
+                vm_dict.update({'subnet_path':path.join(
+                    path_to_network, 'vm_res_id_' + subnet_id, 'network_db')})
             vm_dict.update({'disks': self._get_disk_path(vm_dict.get('disk_db_path', []))})
 
+    @timed('parser', step='vms')
     def get_vms_from_snapshots(self, snapshot):
         """
         Returns vm dictonaries form given snapshot if available otherwise returns None.
@@ -230,10 +291,18 @@ class Parser(object):
         try:
             snap_path = snapshot.get('path')
             snapshot_vms_db_path = path.join(snap_path, "snapshot_vms_db")
-            if snapshot_vms_db_path:
-                vms_data = get_data(snapshot_vms_db_path)
             resource_db_path = path.join(snap_path, "resources_db")
-            self.res_data = get_data(resource_db_path)
+            if self.catalog:
+                stamp = [file_stamp(snapshot_vms_db_path), file_stamp(resource_db_path)]
+                self.vms = self.catalog.get_vms(snap_path, stamp)
+                if self.vms is not None:
+                    return self.vms
+            if self.stream:
+                vms_data = iter_json_array(snapshot_vms_db_path)
+                self.res_data = None
+            else:
+                vms_data = get_data(snapshot_vms_db_path)
+                self.res_data = get_data(resource_db_path)
             self.vms = []
             for vm_dict in vms_data:
                 vms_dict = {
@@ -245,7 +314,12 @@ class Parser(object):
                     'disk_db_path':[]
                 }
                 self.vms.append(vms_dict)
-            self._update_vm_data(snap_path)
+            if self.stream:
+                self._update_vm_data(snap_path, iter_json_array(resource_db_path))
+            else:
+                self._update_vm_data(snap_path)
+            if self.catalog:
+                self.catalog.store_vms(snap_path, stamp, self.vms)
             return self.vms
         except Exception as e:
             raise WorkloadException(e)
\ No newline at end of file
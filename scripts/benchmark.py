@@ -0,0 +1,311 @@
+"""
+Benchmarks
+
+Measures the parser and converter paths against a trilio vault. When no
+vault is given a synthetic one is generated in a temp directory.
+"""
+import sys
+import os
+import argparse
+import json
+import pickle
+import shutil
+import subprocess
+import tempfile
+import time
+import uuid
+
+CWD = os.getcwd()
+CWD = CWD.split('/')
+BASE_DIR = ('/'.join(CWD[:-1]))
+sys.path.append(BASE_DIR)
+from modules.workload_parser import Parser
+from modules.catalog import Catalog
+from modules.utils import load_data
+from modules import json_loader
+from modules.conversion_scheduler import ConversionScheduler
+from modules.s3_stream import StreamingUploader, MB
+from modules.s3_upload import MultipartUploader
+from modules.aws_clients import AwsClients
+from modules import qcow2
+
+def _timeit(func, *args):
+    """
+    Returns (seconds, result) of single call.
+    """
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+def make_snapshot(workload_path, vms=2, resources_per_vm=4):
+    """
+    Creates one synthetic snapshot directory and returns its path.
+    """
+    snap_id = str(uuid.uuid4())
+    snap_path = os.path.join(workload_path, 'snapshot_' + snap_id)
+    os.makedirs(snap_path)
+    load_data(os.path.join(snap_path, 'snapshot_db'), {
+        'id':snap_id,
+        'display_name':'snap-' + snap_id[:8],
+        'updated_at':time.strftime('%Y-%m-%dT%H:%M:%S.000000',
+                                   time.gmtime(time.time() - len(os.listdir(workload_path)))),
+        'size':1024 * 1024 * 1024,
+        'restore_size':2 * 1024 * 1024 * 1024,
+    })
+    vms_data = []
+    resources = []
+    subnet_id = str(uuid.uuid4())
+    subnet_path = os.path.join(snap_path, 'network', 'vm_res_id_' + subnet_id)
+    os.makedirs(subnet_path)
+    load_data(os.path.join(subnet_path, 'network_db'), [
+        {'pickle':pickle.dumps({'cidr':'10.0.0.0/24', 'name':'private-subnet'}, 0)
+                 .decode('latin-1')}])
+    for vm_no in range(vms):
+        vm_id = str(uuid.uuid4())
+        vms_data.append({'vm_id':vm_id, 'vm_name':'vm-{}'.format(vm_no)})
+        disk_id = str(uuid.uuid4())
+        disk_path = os.path.join(snap_path, 'vm_id_' + vm_id, 'vm_res_id_' + disk_id)
+        os.makedirs(disk_path)
+        load_data(os.path.join(disk_path, 'disk_db'), [
+            {'vault_url':disk_path[len(os.path.dirname(workload_path)):] + '/sda'}])
+        resources.append({'id':disk_id, 'vm_id':vm_id, 'resource_type':'disk',
+                          'resource_name':'vda'})
+        resources.append({'id':subnet_id, 'vm_id':vm_id, 'resource_type':'subnet',
+                          'resource_name':'private-subnet'})
+        resources.append({'id':str(uuid.uuid4()), 'vm_id':vm_id, 'resource_type':'flavor',
+                          'resource_name':'t2.micro',
+                          'metadata':[{'key':'ram', 'value':'1024'},
+                                      {'key':'vcpus', 'value':'1'}]})
+        for nic_no in range(resources_per_vm - 3):
+            nic_id = str(uuid.uuid4())
+            resources.append({'id':nic_id, 'vm_id':vm_id,
+                              'resource_type':'nic', 'resource_name':'eth0'})
+            if nic_no == resources_per_vm - 4:
+                nic_path = os.path.join(snap_path, 'network', 'vm_res_id_' + nic_id)
+                os.makedirs(nic_path)
+                load_data(os.path.join(nic_path, 'network_db'), [{'metadata':[
+                    {'key':'ip_address', 'value':'10.0.0.{}'.format(vm_no % 250 + 4)},
+                    {'key':'router_name', 'value':'router'}]}])
+    load_data(os.path.join(snap_path, 'snapshot_vms_db'), vms_data)
+    load_data(os.path.join(snap_path, 'resources_db'), resources)
+    return snap_path
+
+def make_vault(base_dir, workloads, snapshots):
+    """
+    Creates a synthetic vault with given number of workloads and snapshots.
+    """
+    for _ in range(workloads):
+        workload_id = str(uuid.uuid4())
+        workload_path = os.path.join(base_dir, 'workload_' + workload_id)
+        os.makedirs(workload_path)
+        load_data(os.path.join(workload_path, 'workload_db'), {
+            'id':workload_id, 'display_name':'wl-' + workload_id[:8],
+            'host':'localhost', 'created_at':'2017-12-20T10:20:37.000000'})
+        for _ in range(snapshots):
+            make_snapshot(workload_path)
+
+def _read_native(disk, output):
+    """
+    Converts disk with the qcow2 reader, returns seconds.
+    """
+    start = time.time()
+    with qcow2.open_image(disk) as image:
+        qcow2.write_raw(image, output)
+    return time.time() - start
+
+def _read_qemu_img(disk, output):
+    """
+    Converts disk with qemu-img, returns seconds.
+    """
+    start = time.time()
+    subprocess.check_call(['qemu-img', 'convert', '-O', 'raw', disk, output])
+    return time.time() - start
+
+def _same_file(first, second):
+    """
+    Compares two files byte for byte.
+    """
+    with open(first, 'rb') as first_file, open(second, 'rb') as second_file:
+        while True:
+            first_chunk = first_file.read(MB)
+            if first_chunk != second_file.read(MB):
+                return False
+            if not first_chunk:
+                return True
+
+def bench_catalog(args, base_dir):
+    """
+    Compares cold vault walk with catalog lookups.
+    """
+    catalog_path = os.path.join(tempfile.mkdtemp(), 'catalog.db')
+    walker = Parser(base_dir)
+    indexed = Parser(base_dir, Catalog(base_dir, catalog_path))
+    report = {}
+    for label, parser in (('cold_walk', walker), ('catalog_first', indexed),
+                          ('catalog_warm', indexed)):
+        listing, workloads = _timeit(parser.get_workloads)
+        snapshots = latest = 0.0
+        for workload in workloads or []:
+            spent, _ = _timeit(parser.get_snapshots_from_workload, workload)
+            snapshots += spent
+            spent, _ = _timeit(parser.get_latest_snapshot, workload)
+            latest += spent
+        report[label] = {'get_workloads':listing, 'get_snapshots_from_workload':snapshots,
+                         'get_latest_snapshot':latest}
+    shutil.rmtree(os.path.dirname(catalog_path))
+    return report
+
+def bench_snapshots(args, base_dir):
+    """
+    Compares sequential and concurrent snapshot_db loading.
+    """
+    report = {}
+    for workers in sorted(set([1, args.workers])):
+        parser = Parser(base_dir, workers=workers)
+        spent = 0.0
+        for workload in parser.get_workloads() or []:
+            elapsed, _ = _timeit(parser.get_snapshots_from_workload, workload)
+            spent += elapsed
+        report['workers_{}'.format(workers)] = spent
+    return report
+
+def bench_latest(args, base_dir):
+    """
+    Compares latest snapshot selection by updated_at and by snapshot_db mtime.
+    """
+    report = {}
+    for signal in ('updated_at', 'mtime'):
+        parser = Parser(base_dir, latest_by=signal)
+        spent = 0.0
+        for workload in parser.get_workloads() or []:
+            elapsed, _ = _timeit(parser.get_latest_snapshot, workload)
+            spent += elapsed
+        report[signal] = spent
+    return report
+
+def bench_resources(args, base_dir):
+    """
+    Measures get_vms_from_snapshots against synthetic resources_db files of
+    growing size, up to 100k entries.
+    """
+    report = {}
+    # outside base_dir, a workload without workload_db would show up in the vault
+    scratch = tempfile.mkdtemp(prefix='trilio_resources_')
+    workload_path = os.path.join(scratch, 'workload_resources')
+    os.makedirs(workload_path)
+    try:
+        for entries in (1000, 10000, 100000):
+            snap_path = make_snapshot(workload_path, args.vms, max(entries // args.vms, 4))
+            result = {}
+            for label, parser in (('seconds', Parser(scratch)),
+                                  ('stream_seconds', Parser(scratch, stream=True))):
+                elapsed, vms = _timeit(parser.get_vms_from_snapshots, {'path':snap_path})
+                result.update({label:elapsed, 'vms':len(vms)})
+            report['resources_{}'.format(entries)] = result
+            shutil.rmtree(snap_path)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return report
+
+def bench_loader(args, base_dir):
+    """
+    Compares listing with an empty and a warm vault db file cache.
+    """
+    report = {}
+    json_loader.LOADER.invalidate()
+    for label in ('cold_cache', 'warm_cache'):
+        parser = Parser(base_dir)
+        spent = 0.0
+        for workload in parser.get_workloads() or []:
+            elapsed, _ = _timeit(parser.get_snapshots_from_workload, workload)
+            spent += elapsed
+        report[label] = spent
+    report['stats'] = json_loader.LOADER.stats()
+    return report
+
+def bench_upload(args, base_dir):
+    """
+    Compares end to end MB/s of convert then upload with the streamed upload,
+    against the S3 (or S3 compatible --endpoint-url) bucket given by --bucket.
+    """
+    s3_client = AwsClients(None, {'s3': args.endpoint_url}).client('s3')
+    scheduler = ConversionScheduler()
+    report = {}
+    for disk in args.disk:
+        virtual_size = int(scheduler.info(disk)['virtual-size'])
+        raw_disk = scheduler.run([disk])[0]
+        copied = MultipartUploader(s3_client, args.bucket, threads=args.workers)\
+            .upload_file(raw_disk)
+        elapsed = copied['seconds'] + scheduler.reports[disk]['convert_seconds']
+        os.remove(raw_disk)
+        uploader = StreamingUploader(scheduler, s3_client, args.bucket,
+                                     part_size=64 * MB, workers=args.workers)
+        streamed = uploader.upload_disk(disk, os.path.basename(raw_disk))
+        report[disk] = {'two_pass_mb_per_s':virtual_size / float(MB) / elapsed,
+                        'stream_mb_per_s':streamed['mb_per_s']}
+    return report
+
+def bench_qcow2(args, base_dir):
+    """
+    Compares MB/s of the qcow2 reader and qemu-img convert on the disks
+    given by --disk. Correctness of the reader is covered by tests/test_qcow2.py
+    """
+    scratch = tempfile.mkdtemp(prefix='trilio_qcow2_')
+    have_qemu_img = ConversionScheduler(engine='auto').native is False
+    report = {'disks': {}}
+    try:
+        for disk in args.disk:
+            with qcow2.open_image(disk) as image:
+                virtual_size = image.size
+            native = os.path.join(scratch, 'native.raw')
+            seconds = _read_native(disk, native)
+            result = {'native_mb_per_s': virtual_size / float(MB) / seconds}
+            if have_qemu_img:
+                seconds = _read_qemu_img(disk, native + '.qemu')
+                result['qemu_img_mb_per_s'] = virtual_size / float(MB) / seconds
+                result['identical'] = _same_file(native, native + '.qemu')
+                os.remove(native + '.qemu')
+            os.remove(native)
+            report['disks'][disk] = result
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return report
+
+BENCHMARKS = {
+    'catalog': bench_catalog,
+    'latest': bench_latest,
+    'loader': bench_loader,
+    'qcow2': bench_qcow2,
+    'resources': bench_resources,
+    'upload': bench_upload,
+    'snapshots': bench_snapshots,
+}
+
+def main():
+    """
+    Execution starts from here
+    """
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    arg_parser.add_argument('--base-dir', help='trilio vault to run against')
+    arg_parser.add_argument('--workloads', type=int, default=5)
+    arg_parser.add_argument('--snapshots', type=int, default=200)
+    arg_parser.add_argument('--workers', type=int, default=8)
+    arg_parser.add_argument('--vms', type=int, default=200)
+    arg_parser.add_argument('--disk', action='append', default=[],
+                            help='qcow2 disk to upload or read, repeatable')
+    arg_parser.add_argument('--bucket', help='bucket used by the upload benchmark')
+    arg_parser.add_argument('--endpoint-url', help='S3 compatible endpoint')
+    args = arg_parser.parse_args()
+    base_dir = args.base_dir
+    if not base_dir:
+        base_dir = tempfile.mkdtemp(prefix='trilio_vault_')
+        make_vault(base_dir, args.workloads, args.snapshots)
+    try:
+        print(json.dumps(BENCHMARKS[args.benchmark](args, base_dir), indent=4, sort_keys=True))
+    finally:
+        if not args.base_dir:
+            shutil.rmtree(base_dir)
+
+if __name__ == "__main__":
+    main()
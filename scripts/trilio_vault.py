@@ -3,9 +3,10 @@ command line
 """
 import sys
 import os
-from os.path import join
+import json
+import time
 import logging
-import pickle
+import argparse
 from tabulate import tabulate
 
 #base_dir = os.path.dirname(os.path.dirname(__file__))
@@ -33,84 +34,92 @@ class Trilio(object):
         container_json_path = cfg.get('container_json_path')
         key_pair = cfg.get('key_pair')
         self.app = App(bucket, region, container_json_path,\
-                       self.trilio_base_dir, key_pair)
+                       self.trilio_base_dir, key_pair,\
+                       catalog_path=cfg.get('catalog_path'),\
+                       snapshot_workers=cfg.get('snapshot_workers', 1),\
+                       latest_snapshot_by=cfg.get('latest_snapshot_by', 'updated_at'),\
+                       json_cache_mb=cfg.get('json_cache_mb', 64),\
+                       stream_resources=cfg.get('stream_resources', False),\
+                       convert_options=cfg.get('convert_options'),\
+                       stream_upload=cfg.get('stream_upload', False),\
+                       stream_options=cfg.get('stream_options'),\
+                       s3_endpoint_url=cfg.get('s3_endpoint_url'),\
+                       cache_options=cfg.get('conversion_cache'),\
+                       upload_options=cfg.get('upload_options'),\
+                       import_options=cfg.get('import_options'),\
+                       aws_options=cfg.get('aws_options'),\
+                       restore_manifest_dir=cfg.get('restore_manifest_dir'),\
+                       restore_options=cfg.get('restore_options'),\
+                       restore_journal=cfg.get('restore_journal'),\
+                       metrics_options=cfg.get('metrics'))
+        self.page_size = cfg.get('page_size', 20)
         setup_logging(name=cfg.get('app_name'), level=cfg.get('log_level'))
         self.logger = logging.getLogger(__name__)
 
-    def _update_network_info(self, vm_dict):
+    def _restore_vms(self, vms):
         """
-        Updates network info
+        Create vms in Amazon EC2, several at once through the restore pipeline.
         """
-        network_data = get_data(vm_dict['nic_db_path'])
-        for network in network_data:
-            for meta in network.get('metadata'):
-                if meta.get('key') == 'ip_address':
-                    vm_dict.update({'ip':meta.get('value')})
-                elif meta.get('key') == 'router_name':
-                    vm_dict.update({'router_name':meta.get('value')})
-        return vm_dict
-    def _update_subnet_info(self, vm_dict):
+        jobs = self.app.restore_vms(vms)
+        self.app.export_metrics()
+        data_list = [['Name', 'Id', 'Status', 'Instance Id', 'Seconds']]
+        for job in jobs:
+            status = "failed in {}".format(job.stage) if job.failed else "restored"
+            data_list.append([job.name, job.vm_dict.get('id'), status,
+                              job.state.get('instance_id'), round(sum(job.timings.values()), 1)])
+        print tabulate(data_list, tablefmt="grid", headers="firstrow")
+        for job in jobs:
+            if not job.failed:
+                if job.state.get('instance_id'):
+                    print "Instance launched sucessfully with ID ***{}***".format(
+                        job.state['instance_id'])
+            elif job.stage == 'launch':
+                print "Error found in Boto interface.. {}: {}".format(job.name, job.error)
+            else:
+                print "Error found in Image converter..{}: {}".format(job.name, job.error)
+
+    def _workload_row(self, workload):
         """
-        updates subnet info
+        Table row of workload
         """
-        network_data = get_data(vm_dict['subnet_path'])
-        for network in network_data:
-            pickl = pickle.loads(network.get('pickle'))
-            cidr = pickl.get('cidr')
-            vm_dict.update({'cidr':cidr, 'subnet_name':pickl.get('name')})
-        return vm_dict
-    def _create_vm(self, vm_dict):
+        workload_data = self.app.get_workload_data(workload)
+        return [workload_data.get('display_name'), workload_data.get('id'), \
+                workload_data.get('host'), get_time(workload_data.get('created_at'))]
+
+    def _select_paged(self, fetch, headers, to_row, item_name):
         """
-        Create vm in Amazon EC2.
+        Prints items a page at a time and returns the one selected by the user
         """
-        vm_dict = self._update_network_info(vm_dict)
-        try:
-            vm_dict = self._update_subnet_info(vm_dict)
-            raw_disks = self.app.convert_image_to_raw(vm_dict.get('disks', []))
-            self.app.copy_disks_to_s3(raw_disks)
-            #snap_ids = ['snap-0319d9e0da0d632d1','snap-043204df28f1bbeb3']
-            snap_ids = []
-            for disk in raw_disks:
-                snap_id = self.app.create_snapshot(disk)
-                snap_ids.append(snap_id)
-        except Exception as err:
-            raise ImageConverterException(err)
-        try:
-            snap_id = 0
-            for snap in snap_ids:
-                if snap.endswith("!@root_disk"):
-                    snap_id = snap.split("!@")[0]
-            if snap_id:
-                ami_id = self.app.register_ami(snap_id)
-                instance = self.app.lanuch_instance(ami_id, snap_ids, vm_dict)
-                print "Instance launched sucessfully with ID ***{}***".format(instance[0].id)
-                self.logger.info("Instance launched sucessfully with ID ***%s***", instance[0].id)
-        except Exception as err:
-            raise BotoException(err)
+        offset = 0
+        while True:
+            page = fetch(offset, self.page_size + 1) or []
+            more = len(page) > self.page_size
+            page = page[:self.page_size]
+            data_list = [headers]
+            for sno, item in enumerate(page, offset + 1):
+                data_list.append([sno] + to_row(item))
+            print tabulate(data_list, tablefmt="grid", headers="firstrow")
+            user_input = raw_input("select one of the {} listed above{}: ".format(\
+                item_name, " (n for next page)" if more else "")).lower()
+            if more and user_input == 'n':
+                offset += self.page_size
+                continue
+            index = int(user_input) - 1 - offset
+            if 0 <= index < len(page):
+                return page[index]
+            print "invalid selection {}".format(user_input)
 
     def run(self):
         """
         Simple comand line interface
         """
         try:
-            workloads = self.app.get_workloads()
             self.logger.info("available workloads.....")
-            self.logger.info(workloads)
             headers = ['SNo', 'Name', 'Id', 'Host Name', 'Created Time']
-            data_list = [headers]
-            for sno, workload in enumerate(workloads, 1):
-                work_load_path = join(self.trilio_base_dir, workload)
-                work_load_db_path = join(work_load_path, 'workload_db')
-                workload_data = get_data(work_load_db_path)
-                workload_list = [sno, \
-                                 workload_data.get('display_name'), workload_data.get('id'), \
-                                 workload_data.get('host'), get_time(workload_data.get('created_at'))]
-                data_list.append(workload_list)
-    
-            print tabulate(data_list, tablefmt="grid", headers="firstrow")
-            user_input_wl = int(raw_input("select one of the worklods listed above: "))-1
-            workload = workloads[user_input_wl]
-            self.logger.info("Selected workload is..%s", data_list[user_input_wl+1][1])
+            workload = self._select_paged(
+                lambda offset, limit: self.app.get_workloads(offset=offset, limit=limit),
+                headers, self._workload_row, "worklods")
+            self.logger.info("Selected workload is..%s", workload)
             while True:
                 #try:
                 user_input2 = raw_input(\
@@ -120,23 +129,20 @@ class Trilio(object):
                 if user_input2 == 'yes' or user_input2 == 'y':
                     snapshot = self.app.get_latest_snapshot(workload)
                     vms = self.app.get_vms_from_snapshots(snapshot)
-                    for vm_dict in vms:
-                        self._create_vm(vm_dict)
+                    self._restore_vms(vms)
                     break
                 elif user_input2 == 'no' or user_input2 == 'n':
                     self.logger.info("listing available snapshots under given workload %s",\
                                      workload)
                     print "listing available snapshots under given workload {}".format(workload)
-                    snapshots = self.app.get_snapshots_from_workload(workload)
                     headers = ['SNo', 'Name', 'Id', 'Time', 'Size(MB)']
-                    data_list = [headers]
-                    for sno, snapshot in enumerate(snapshots, 1):
-                        data = [sno, snapshot.get('display_name'), snapshot.get('id'), \
-                                snapshot.get('time'), snapshot.get('size_in_mb')]
-                        data_list.append(data)
-                    print tabulate(data_list, tablefmt="grid", headers="firstrow")
-                    user_input_snap = int(raw_input("select one of the snapshots listed above: "))-1
-                    snapshot = snapshots[user_input_snap]
+                    snapshot = self._select_paged(
+                        lambda offset, limit: self.app.get_snapshots_from_workload(
+                            workload, offset=offset, limit=limit),
+                        headers, lambda snapshot: [
+                            snapshot.get('display_name'), snapshot.get('id'), \
+                            snapshot.get('time'), snapshot.get('size_in_mb')],
+                        "snapshots")
                     while True:
                         user_input2 = raw_input(\
                             "Do you want to restore all the vms under given snapshot {} y/n : "\
@@ -144,9 +150,7 @@ class Trilio(object):
 
                         if user_input2 == 'yes' or user_input2 == 'y':
                             vms = self.app.get_vms_from_snapshots(snapshot)
-                            for vm_dict in vms:
-                                self._create_vm(vm_dict)
-
+                            self._restore_vms(vms)
                             break
                         elif user_input2 == 'no' or user_input2 == 'n':
 
@@ -167,7 +171,7 @@ class Trilio(object):
                             vm_dict = vms[user_input_vm-1]
                             print "selected vm", vm_dict['name']
                             self.logger.info("selected vm %s", vm_dict['name'])
-                            self._create_vm(vm_dict)
+                            self._restore_vms([vm_dict])
                             break
                     break
 
@@ -183,12 +187,160 @@ class Trilio(object):
                 print err
         finally:
             sys.exit()
+    def rebuild_catalog(self):
+        """
+        Re-indexes the vault into the catalog
+        """
+        try:
+            count = self.app.rebuild_catalog()
+            if count is None:
+                print "catalog_path is not configured"
+            else:
+                print "catalog rebuilt with {} snapshots".format(count)
+        except WorkloadException as workload_err:
+            print "Error found in workload parser.. {}".format(workload_err)
+
+    def _emit(self, event, **fields):
+        """
+        Writes one JSON line of batch restore progress
+        """
+        fields['event'] = event
+        fields['time'] = time.time()
+        self.json_out.write(json.dumps(fields, sort_keys=True, default=str) + "\n")
+        self.json_out.flush()
+
+    def _plan(self, manifest):
+        """
+        Resolves restores of a batch manifest into vm dictionaries, returns
+        (vms, context per vm path, number of entries that matched nothing)
+        """
+        vms = []
+        context = {}
+        unmatched = 0
+        for index, entry in enumerate(manifest.get('restores', [])):
+            workload = entry.get('workload', '')
+            if workload == '*':
+                workloads = self.app.get_workloads() or []
+            elif workload.startswith('workload_'):
+                workloads = [workload]
+            else:
+                workloads = ['workload_' + workload]
+            selector = entry.get('snapshot', 'latest')
+            for name in workloads:
+                try:
+                    snapshot = self.app.select_snapshot(name, selector)
+                    selected = self.app.select_vms(snapshot, entry.get('vms')) \
+                        if snapshot else []
+                except WorkloadException as err:
+                    self._emit('error', entry=index, workload=name, error=str(err))
+                    unmatched += 1
+                    continue
+                if not selected:
+                    self._emit('error', entry=index, workload=name, snapshot=selector,
+                               error="no snapshot or vm matches")
+                    unmatched += 1
+                    continue
+                snapshot_id = snapshot.get('id')
+                self._emit('selected', entry=index, workload=name, snapshot=snapshot_id,
+                           vms=[vm_dict.get('name') for vm_dict in selected])
+                for vm_dict in selected:
+                    if vm_dict.get('path') in context:
+                        continue
+                    context[vm_dict.get('path')] = {'workload': name, 'snapshot': snapshot_id}
+                    vms.append(vm_dict)
+        return vms, context, unmatched
+
+    def batch_restore(self, manifest_path, limits=None, restart=False, dry_run=False):
+        """
+        Restores every vm selected by a manifest without prompts, writing
+        progress and results as JSON lines to stdout. Returns exit status,
+        0 when every vm was restored.
+        """
+        self.json_out = sys.stdout
+        # messages printed by the restore go to stderr, stdout stays JSON
+        sys.stdout = sys.stderr
+        try:
+            try:
+                manifest = get_data(manifest_path)
+            except (IOError, ValueError) as err:
+                self._emit('error', manifest=manifest_path, error=str(err))
+                return 2
+            limits = dict(manifest.get('parallelism', {}), **(limits or {}))
+            start = time.time()
+            vms, context, unmatched = self._plan(manifest)
+            if dry_run:
+                self._emit('summary', vms=len(vms), unmatched=unmatched, dry_run=True)
+                return 1 if unmatched else 0
+            if restart:
+                self.app.forget_restores(vms)
+
+            def progress(job, stage, event):
+                """
+                Emits stage events of a vm
+                """
+                fields = dict(context.get(job.vm_dict.get('path'), {}), vm=job.name,
+                              vm_id=job.vm_dict.get('id'), stage=stage, status=event)
+                if event != 'started':
+                    fields['seconds'] = job.timings.get(stage)
+                if event == 'failed':
+                    fields['error'] = str(job.error)
+                self._emit('stage', **fields)
+
+            jobs = self.app.restore_vms(vms, progress, limits)
+            for job in jobs:
+                self._emit('result', vm=job.name, vm_id=job.vm_dict.get('id'),
+                           status='failed' if job.failed else 'restored',
+                           failed_stage=job.stage if job.failed else None,
+                           error=str(job.error) if job.failed else None,
+                           instance_id=job.state.get('instance_id'),
+                           ami_id=job.state.get('ami_id'), snap_ids=job.state.get('snap_ids'),
+                           manifest=job.state.get('manifest'), timings=job.timings,
+                           **context.get(job.vm_dict.get('path'), {}))
+            failed = sum(1 for job in jobs if job.failed)
+            self._emit('summary', vms=len(jobs), restored=len(jobs) - failed, failed=failed,
+                       unmatched=unmatched, seconds=time.time() - start,
+                       aws_calls=self.app.get_aws_call_stats(),
+                       metrics_files=self.app.export_metrics())
+            return 1 if failed or unmatched else 0
+        finally:
+            sys.stdout = self.json_out
+
 def main():
     """
     Execution starts from here
     """
+    if not sys.argv[1:]:
+        Trilio().run()
+        return
+    arg_parser = argparse.ArgumentParser(description="Restores trilio vault vms in AWS")
+    commands = arg_parser.add_subparsers(dest='command')
+    commands.add_parser('interactive', help='select and restore vms with prompts')
+    commands.add_parser('rebuild-catalog', help='re-index the vault into the catalog')
+    restore = commands.add_parser('restore', help='restore the vms a manifest selects, '
+                                  'progress and results are JSON lines on stdout')
+    restore.add_argument('--manifest', required=True, help='JSON batch restore manifest')
+    restore.add_argument('--parallel', type=int, dest='vms', metavar='N',
+                         help='vms in the restore pipeline at once')
+    for stage in ('network', 'convert', 'upload', 'import', 'launch'):
+        restore.add_argument('--' + stage, type=int, dest=stage + '_limit', metavar='N',
+                             help='vms in the {} stage at once'.format(stage))
+    restore.add_argument('--restart', action='store_true',
+                         help='ignore journaled stages and restore from scratch')
+    restore.add_argument('--dry-run', action='store_true',
+                         help='only print the vms the manifest selects')
+    args = arg_parser.parse_args()
     obj = Trilio()
-    obj.run()
+    if args.command == 'rebuild-catalog':
+        obj.rebuild_catalog()
+    elif args.command == 'restore':
+        limits = dict((stage, getattr(args, stage + '_limit')) for stage in
+                      ('network', 'convert', 'upload', 'import', 'launch')
+                      if getattr(args, stage + '_limit'))
+        if args.vms:
+            limits['vms'] = args.vms
+        sys.exit(obj.batch_restore(args.manifest, limits, args.restart, args.dry_run))
+    else:
+        obj.run()
 
 if __name__ == "__main__":
     main()
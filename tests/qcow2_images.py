@@ -0,0 +1,95 @@
+"""
+qcow2 images for tests
+
+Writes qcow2 v2/v3 images with data, zlib compressed, zero and
+unallocated clusters and raw or qcow2 backing files, and returns the
+guest bytes they must read back as.
+"""
+import os
+import zlib
+import struct
+from modules import qcow2
+
+def make_qcow2(path, size, clusters, cluster_bits=16, version=3, backing=None,
+               backing_format=None):
+    """
+    Writes a qcow2 image with refcounts and returns its guest contents.
+    clusters maps guest cluster number to ('data', bytes), ('compressed',
+    bytes) or ('zero', None), other clusters are unallocated and read from
+    backing, a (path, guest bytes) tuple, when given.
+    """
+    cluster_size = 1 << cluster_bits
+    l2_entries = cluster_size // 8
+    l1_size = -(-size // (cluster_size * l2_entries))
+    l1_clusters = max(-(-l1_size * 8 // cluster_size), 1)
+    used = 2 + l1_clusters
+    l2_tables = {}
+    for number in sorted(clusters):
+        if number // l2_entries not in l2_tables:
+            l2_tables[number // l2_entries] = used
+            used += 1
+    image = {}
+    l2_entries_of = {}
+    for number, (kind, data) in sorted(clusters.items()):
+        if kind == 'zero':
+            entry = qcow2.OFLAG_ZERO
+        elif kind == 'compressed':
+            packer = zlib.compressobj(9, zlib.DEFLATED, -12)
+            packed = packer.compress(data) + packer.flush()
+            sectors = -(-len(packed) // 512)
+            entry = qcow2.OFLAG_COMPRESSED | ((sectors - 1) << (62 - (cluster_bits - 8))) | \
+                (used * cluster_size)
+            image[used] = packed
+            used += 1
+        else:
+            entry = used * cluster_size
+            image[used] = data
+            used += 1
+        l2_entries_of.setdefault(number // l2_entries, {})[number % l2_entries] = entry
+    for l1_index, cluster in l2_tables.items():
+        table = [0] * l2_entries
+        for l2_index, entry in l2_entries_of.get(l1_index, {}).items():
+            table[l2_index] = entry
+        image[cluster] = struct.pack('>{}Q'.format(l2_entries), *table)
+    l1_table = [0] * max(l1_size, 1)
+    for l1_index, cluster in l2_tables.items():
+        l1_table[l1_index] = (1 << 63) | cluster * cluster_size
+    l1_raw = struct.pack('>{}Q'.format(len(l1_table)), *l1_table)
+    for number in range(l1_clusters):
+        image[2 + number] = l1_raw[number * cluster_size:(number + 1) * cluster_size]
+    blocks = 0
+    while blocks * cluster_size // 2 < used + blocks:
+        blocks += 1
+    refcounts = struct.pack('>{}H'.format(used + blocks), *([1] * (used + blocks)))
+    for number in range(blocks):
+        image[used + number] = refcounts[number * cluster_size:(number + 1) * cluster_size]
+    image[1] = struct.pack('>{}Q'.format(blocks),
+                           *[(used + number) * cluster_size for number in range(blocks)])
+    used += blocks
+    header_length = qcow2.HEADER_V2.size + (qcow2.HEADER_V3.size if version == 3 else 0)
+    extensions = b''
+    if backing_format:
+        fmt = backing_format.encode('ascii')
+        extensions += qcow2.EXTENSION.pack(qcow2.EXT_BACKING_FORMAT, len(fmt)) + \
+            fmt + b'\0' * (-len(fmt) % 8)
+    extensions += qcow2.EXTENSION.pack(qcow2.EXT_END, 0)
+    backing_name = os.path.basename(backing[0]).encode('utf-8') if backing else b''
+    backing_offset = header_length + len(extensions) if backing else 0
+    header = qcow2.HEADER_V2.pack(qcow2.QCOW2_MAGIC, version, backing_offset,
+                                  len(backing_name), cluster_bits, size, 0, l1_size,
+                                  2 * cluster_size, cluster_size, 1, 0, 0)
+    if version == 3:
+        header += qcow2.HEADER_V3.pack(0, 0, 0, 4, header_length)
+    image[0] = header + extensions + backing_name
+    with open(path, 'wb') as image_file:
+        for cluster, data in image.items():
+            image_file.seek(cluster * cluster_size)
+            image_file.write(data)
+        image_file.truncate(used * cluster_size)
+    contents = bytearray(backing[1][:size]) if backing else bytearray()
+    contents += bytearray(size - len(contents))
+    for number, (kind, data) in clusters.items():
+        start = number * cluster_size
+        block = bytearray(cluster_size) if kind == 'zero' else bytearray(data)
+        contents[start:start + cluster_size] = block[:max(size - start, 0)]
+    return bytes(contents)
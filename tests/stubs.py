@@ -0,0 +1,169 @@
+"""
+Stand ins for qemu-img and the AWS clients
+
+Lets tests drive App.restore_vms end to end without qemu-img or an AWS
+account: a stub qemu-img treats every disk as raw and copies it, S3 keeps
+objects in memory and EC2 completes every import at once. Every stub
+records the calls it got.
+"""
+import os
+import stat
+import hashlib
+import itertools
+import threading
+from modules.app import App
+
+QEMU_IMG = """#!/bin/sh
+# qemu-img stand in: every disk is raw, disks with fail in their path fail
+cmd=$1; shift
+for last; do :; done
+echo "$cmd $last" >> "$(dirname "$0")/calls"
+case "$cmd" in
+info) echo "{\\"virtual-size\\": $(wc -c < "$last"), \\"format\\": \\"raw\\"}" ;;
+map) exit 1 ;;
+convert)
+    for arg; do src=$dst; dst=$arg; done
+    case "$src" in *fail*) echo "cannot read $src" >&2; exit 1 ;; esac
+    cp "$src" "$dst" ;;
+esac
+"""
+
+IDS = itertools.count()
+
+def write_qemu_img(directory):
+    """
+    Writes the stub qemu-img to directory and returns its path.
+    """
+    qemu_img = os.path.join(directory, 'qemu-img')
+    with open(qemu_img, 'w') as script:
+        script.write(QEMU_IMG)
+    os.chmod(qemu_img, os.stat(qemu_img).st_mode | stat.S_IEXEC)
+    return qemu_img
+
+def qemu_img_calls(qemu_img, cmd='convert'):
+    """
+    Returns the disks the stub qemu-img ran cmd on.
+    """
+    calls_path = os.path.join(os.path.dirname(qemu_img), 'calls')
+    if not os.path.exists(calls_path):
+        return []
+    with open(calls_path) as calls:
+        return [line.split(' ', 1)[1].strip() for line in calls
+                if line.startswith(cmd + ' ')]
+
+def make_vm(root, name, devices=('sda', 'vdb'), size=64 * 1024):
+    """
+    Creates disks of a vm under root, unless they exist, and returns its
+    vm dictionary.
+    """
+    disks = []
+    for device in devices:
+        disk_dir = os.path.join(root, name, device)
+        disk = os.path.join(disk_dir, '{}_{}.qcow2'.format(name, device))
+        if not os.path.exists(disk):
+            if not os.path.isdir(disk_dir):
+                os.makedirs(disk_dir)
+            with open(disk, 'wb') as disk_file:
+                disk_file.write(os.urandom(size))
+        disks.append(disk)
+    return {'id': 'id_' + name, 'name': name, 'path': os.path.join(root, name),
+            'flavor': 't2.micro', 'disks': disks}
+
+class FakeS3(object):
+    """
+    S3 client keeping objects in memory.
+    """
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        """
+        Stores Body under Key, returns its MD5 as ETag.
+        """
+        data = Body.read()
+        with self.lock:
+            self.objects[Key] = data
+        return {'ETag': '"{}"'.format(hashlib.md5(data).hexdigest())}
+
+class FakeEc2(object):
+    """
+    EC2 client whose import tasks complete when first described.
+    """
+    def __init__(self):
+        self.tasks = {}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def import_snapshot(self, Description, DiskContainer, **kwargs):
+        """
+        Starts an import task.
+        """
+        with self.lock:
+            task_id = 'import-snap-{}'.format(next(IDS))
+            self.tasks[task_id] = 'snap-' + task_id.split('-')[-1]
+            self.calls.append(('import_snapshot', Description))
+        return {'ImportTaskId': task_id}
+
+    def describe_import_snapshot_tasks(self, ImportTaskIds):
+        """
+        Returns every known task as completed.
+        """
+        with self.lock:
+            self.calls.append(('describe_import_snapshot_tasks', tuple(ImportTaskIds)))
+            return {'ImportSnapshotTasks': [
+                {'ImportTaskId': task_id,
+                 'SnapshotTaskDetail': {'Status': 'completed',
+                                        'SnapshotId': self.tasks[task_id]}}
+                for task_id in ImportTaskIds if task_id in self.tasks]}
+
+class FakeResource(object):
+    """
+    EC2 resource: collections are empty and every action returns a new
+    FakeResource, create_instances a list of one. Action names are recorded
+    in calls, with their keyword arguments in requests.
+    """
+    def __init__(self, calls=None, name='ec2', requests=None):
+        self.calls = [] if calls is None else calls
+        self.requests = [] if requests is None else requests
+        self.name = name
+        self.id = '{}-{}'.format(name, next(IDS))
+
+    def __getattr__(self, name):
+        """
+        Returns a FakeResource for any collection, sub resource or action.
+        """
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return FakeResource(self.calls, name, self.requests)
+
+    def __iter__(self):
+        """
+        Collections are empty.
+        """
+        return iter([])
+
+    def __call__(self, *args, **kwargs):
+        """
+        Records the action and returns its result.
+        """
+        self.calls.append(self.name)
+        self.requests.append((self.name, kwargs))
+        if self.name == 'create_instances':
+            return [FakeResource(self.calls, 'i', self.requests)]
+        return FakeResource(self.calls, self.name, self.requests)
+
+def make_app(root, qemu_img, **options):
+    """
+    Returns an App restoring into the stub AWS clients, reachable as
+    app.s3, app.ec2 and app.ec2_resource.
+    """
+    options.setdefault('convert_options', {'qemu_img': qemu_img})
+    options.setdefault('import_options', {'min_poll_seconds': 0.01,
+                                          'max_poll_seconds': 0.05})
+    app = App('bucket', 'us-east-1', os.path.join(root, 'containers.json'), root,
+              'key_pair', **options)
+    app.s3 = app.aws_clients.clients['s3'] = FakeS3()
+    app.ec2 = app.aws_clients.clients['ec2'] = FakeEc2()
+    app.ec2_resource = app.boto_obj.ec2 = FakeResource()
+    return app
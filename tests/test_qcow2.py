@@ -0,0 +1,143 @@
+"""
+Checks the in process qcow2 reader byte for byte against generated images,
+and against qemu-img when it is installed.
+"""
+import os
+import random
+import shutil
+import tempfile
+import subprocess
+import unittest
+from distutils.spawn import find_executable
+from modules import qcow2
+from tests.qcow2_images import make_qcow2
+
+class Qcow2ReaderTest(unittest.TestCase):
+    """
+    One generated image per qcow2 feature.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='trilio_test_')
+        self.rand = random.Random(1)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make(self, name, clusters_count, kinds, cluster_bits=12, version=3, **kwargs):
+        """
+        Writes an image with clusters_count clusters of kinds at random
+        places, returns (path, guest bytes).
+        """
+        cluster_size = 1 << cluster_bits
+        size = cluster_size * 2 * clusters_count + 1234
+        clusters = {}
+        for number in self.rand.sample(range(size // cluster_size + 1), clusters_count):
+            kind = self.rand.choice(kinds)
+            data = None
+            if kind == 'data':
+                data = os.urandom(cluster_size)
+            elif kind == 'compressed':
+                data = bytes(bytearray(self.rand.randrange(4) for _ in range(cluster_size)))
+            clusters[number] = (kind, data)
+        path = os.path.join(self.root, name + '.qcow2')
+        return path, make_qcow2(path, size, clusters, cluster_bits, version, **kwargs)
+
+    def mixed(self):
+        """
+        Image mixing every cluster kind.
+        """
+        return self.make('mixed', 200, ('data', 'compressed', 'zero'))
+
+    def assert_reads(self, path, expected):
+        """
+        Asserts the image at path reads back as expected.
+        """
+        with qcow2.open_image(path) as image:
+            self.assertEqual(image.size, len(expected))
+            self.assertEqual(image.read(), expected)
+
+    def test_data_clusters(self):
+        self.assert_reads(*self.make('data', 200, ('data',), cluster_bits=16))
+
+    def test_v2_header(self):
+        self.assert_reads(*self.make('v2', 200, ('data', 'compressed'), version=2))
+
+    def test_several_l2_tables(self):
+        # 512 byte clusters hold 64 L2 entries, the image needs a dozen tables
+        self.assert_reads(*self.make('l2', 350, ('data',), cluster_bits=9))
+
+    def test_compressed_clusters(self):
+        self.assert_reads(*self.make('compressed', 200, ('compressed',)))
+
+    def test_zero_clusters(self):
+        self.assert_reads(*self.make('zero', 200, ('zero', 'data')))
+
+    def test_unallocated_clusters_read_as_zeros(self):
+        path = os.path.join(self.root, 'empty.qcow2')
+        expected = make_qcow2(path, 1 << 20, {}, cluster_bits=12)
+        self.assertEqual(expected, b'\0' * (1 << 20))
+        self.assert_reads(path, expected)
+
+    def test_raw_backing_file(self):
+        base = os.path.join(self.root, 'base.raw')
+        with open(base, 'wb') as raw_file:
+            raw_file.write(os.urandom((1 << 20) + 17))
+        with open(base, 'rb') as raw_file:
+            backing = (base, raw_file.read())
+        path = os.path.join(self.root, 'overlay.qcow2')
+        expected = make_qcow2(path, 2 << 20, {3: ('data', os.urandom(65536)),
+                                              10: ('zero', None)},
+                              backing=backing, backing_format='raw')
+        self.assert_reads(path, expected)
+
+    def test_qcow2_backing_chain(self):
+        base = self.make('base', 100, ('data', 'compressed'))
+        path = os.path.join(self.root, 'overlay.qcow2')
+        expected = make_qcow2(path, len(base[1]) + 4096, {0: ('compressed', b'\1' * 4096),
+                                                           11: ('zero', None)},
+                              cluster_bits=12, backing=base)
+        self.assert_reads(path, expected)
+
+    def test_iter_chunks(self):
+        path, expected = self.mixed()
+        with qcow2.open_image(path) as image:
+            chunks = [chunk.tobytes() for chunk in image.iter_chunks(chunk_size=100003)]
+        self.assertEqual(b''.join(chunks), expected)
+
+    def test_seek_and_read(self):
+        path, expected = self.mixed()
+        with qcow2.open_image(path) as image:
+            for _ in range(200):
+                offset = self.rand.randrange(len(expected))
+                length = self.rand.randrange(1, 3 * 4096)
+                image.seek(offset)
+                self.assertEqual(image.read(length), expected[offset:offset + length])
+
+    def test_map(self):
+        path, expected = self.mixed()
+        with qcow2.open_image(path) as image:
+            extents = image.map()
+        self.assertEqual(sum(extent['length'] for extent in extents), len(expected))
+        for extent in extents:
+            if not extent['data']:
+                start, length = extent['start'], extent['length']
+                self.assertEqual(expected[start:start + length], b'\0' * length)
+
+    def test_write_raw(self):
+        path, expected = self.mixed()
+        output = path + '.raw'
+        with qcow2.open_image(path) as image:
+            qcow2.write_raw(image, output, chunk_size=65536)
+        with open(output, 'rb') as raw_file:
+            self.assertEqual(raw_file.read(), expected)
+
+    @unittest.skipUnless(find_executable('qemu-img'), "qemu-img is not installed")
+    def test_same_as_qemu_img(self):
+        path, expected = self.mixed()
+        output = path + '.qemu'
+        subprocess.check_call(['qemu-img', 'convert', '-O', 'raw', path, output])
+        with open(output, 'rb') as raw_file:
+            self.assertEqual(raw_file.read(), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+"""
+Resumes interrupted restores from the restore journal, with a stub
+qemu-img and stub AWS clients.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+from tests.stubs import write_qemu_img, qemu_img_calls, make_vm, make_app
+
+# restores vm0 of argv[1] and dies like a killed process at the point the
+# kill line sets up
+KILLED_RESTORE = """
+import os, sys
+sys.path.insert(0, os.getcwd())
+from tests.stubs import make_vm, make_app
+root, qemu_img = sys.argv[1:3]
+app = make_app(root, qemu_img, restore_journal=os.path.join(root, 'journal.db'))
+{kill}
+app.restore_vms([make_vm(root, 'vm0')])
+"""
+
+# on the first poll of the import tasks, right after they were journaled
+KILL_IN_IMPORT = "app.ec2.describe_import_snapshot_tasks = lambda **kwargs: os._exit(9)"
+
+# right after EC2 started the instance, before it was journaled
+KILL_AFTER_LAUNCH = """
+launch = app.lanuch_instance
+app.lanuch_instance = lambda *args: launch(*args) and os._exit(9)
+"""
+
+# once the instance was journaled, while the checkpoints are dropped
+KILL_IN_DISCARD = "app.journal.discard = lambda vm_dict: os._exit(9)"
+
+class RestoreJournalTest(unittest.TestCase):
+    """
+    Restores interrupted in different stages and resumed.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='trilio_test_')
+        self.qemu_img = write_qemu_img(self.root)
+        self.journal_path = os.path.join(self.root, 'journal.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_app(self):
+        """
+        Returns an App journaling to journal_path, like a new run would.
+        """
+        return make_app(self.root, self.qemu_img, restore_journal=self.journal_path)
+
+    def kill_restore(self, kill):
+        """
+        Runs a restore of vm0 in a child process killed as kill sets up.
+        """
+        killed = subprocess.Popen([sys.executable, '-c', KILLED_RESTORE.format(kill=kill),
+                                   self.root, self.qemu_img],
+                                  cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        killed.communicate()
+        self.assertEqual(killed.returncode, 9)
+
+    def launches(self, app):
+        """
+        Returns keyword arguments of every create_instances call of app.
+        """
+        return [kwargs for name, kwargs in app.ec2_resource.requests
+                if name == 'create_instances']
+
+    def restore(self, app, vm):
+        """
+        Restores vm and returns its job.
+        """
+        return app.restore_vms([dict(vm)])[0]
+
+    def test_failed_ami_resumes_with_ami_and_launch_only(self):
+        vm = make_vm(self.root, 'vm0')
+        app = self.make_app()
+
+        def failing_register_ami(snapshot_id):
+            """
+            Fails like a throttled register_image out of retries.
+            """
+            raise RuntimeError("register_image failed")
+
+        app.register_ami = failing_register_ami
+        job = self.restore(app, vm)
+        self.assertTrue(job.failed)
+        self.assertEqual(job.stage, 'launch')
+        checkpoints = app.journal.checkpoints(vm)
+        self.assertEqual(sorted(checkpoints), ['convert', 'import', 'import_tasks', 'upload'])
+        # without a conversion cache checksum raw disks are not read again
+        self.assertEqual(checkpoints['convert']['checksums'], [None, None])
+        converted = len(qemu_img_calls(self.qemu_img))
+
+        resumed = self.make_app()
+        job = self.restore(resumed, vm)
+        self.assertFalse(job.failed, job.error)
+        self.assertEqual(len(qemu_img_calls(self.qemu_img)), converted)
+        self.assertEqual(resumed.s3.objects, {})
+        self.assertEqual(resumed.ec2.calls, [])
+        self.assertEqual(resumed.ec2_resource.calls.count('register_image'), 1)
+        self.assertEqual(resumed.ec2_resource.calls.count('create_instances'), 1)
+        self.assertEqual(resumed.journal.checkpoints(vm), {})
+
+    def test_killed_restore_reattaches_to_its_import_tasks(self):
+        self.kill_restore(KILL_IN_IMPORT)
+        vm = make_vm(self.root, 'vm0')
+        app = self.make_app()
+        checkpoints = app.journal.checkpoints(vm)
+        self.assertEqual(sorted(checkpoints), ['convert', 'import_tasks', 'upload'])
+        task_ids = checkpoints['import_tasks']['task_ids']
+        converted = len(qemu_img_calls(self.qemu_img))
+        # EC2 kept running the tasks of the killed process
+        for task_id in task_ids:
+            app.ec2.tasks[task_id] = 'snap-' + task_id
+
+        job = self.restore(app, vm)
+        self.assertFalse(job.failed, job.error)
+        self.assertEqual([call for call in app.ec2.calls if call[0] == 'import_snapshot'], [])
+        self.assertEqual([call[1] for call in app.ec2.calls], [tuple(task_ids)])
+        self.assertEqual(job.state['snap_ids'], ['snap-' + task_ids[0] + '!@root_disk',
+                                                 'snap-' + task_ids[1]])
+        self.assertEqual(len(qemu_img_calls(self.qemu_img)), converted)
+        self.assertEqual(app.s3.objects, {})
+        self.assertEqual(app.ec2_resource.calls.count('create_instances'), 1)
+
+    def test_killed_launch_is_retried_with_its_client_token(self):
+        self.kill_restore(KILL_AFTER_LAUNCH)
+        vm = make_vm(self.root, 'vm0')
+        app = self.make_app()
+        checkpoints = app.journal.checkpoints(vm)
+        self.assertNotIn('launch', checkpoints)
+        client_token = checkpoints['ami']['client_token']
+
+        job = self.restore(app, vm)
+        self.assertFalse(job.failed, job.error)
+        self.assertEqual([kwargs.get('ClientToken') for kwargs in self.launches(app)],
+                         [client_token])
+        self.assertEqual(app.ec2_resource.calls.count('register_image'), 0)
+        self.assertEqual(app.journal.checkpoints(vm), {})
+
+    def test_launched_instance_is_not_launched_again(self):
+        self.kill_restore(KILL_IN_DISCARD)
+        vm = make_vm(self.root, 'vm0')
+        app = self.make_app()
+        instance_id = app.journal.checkpoints(vm)['launch']['instance_id']
+
+        job = self.restore(app, vm)
+        self.assertFalse(job.failed, job.error)
+        self.assertEqual(job.state['instance_id'], instance_id)
+        self.assertEqual(self.launches(app), [])
+        self.assertEqual(app.journal.checkpoints(vm), {})
+
+    def test_failed_import_task_is_submitted_again(self):
+        vm = make_vm(self.root, 'vm0')
+        app = self.make_app()
+        describe = app.ec2.describe_import_snapshot_tasks
+
+        def failing_describe(ImportTaskIds):
+            """
+            Reports the first task as deleted by EC2.
+            """
+            response = describe(ImportTaskIds)
+            response['ImportSnapshotTasks'][0]['SnapshotTaskDetail'] = {
+                'Status': 'deleted', 'StatusMessage': 'ClientError: Disk validation failed'}
+            return response
+
+        app.ec2.describe_import_snapshot_tasks = failing_describe
+        job = self.restore(app, vm)
+        self.assertTrue(job.failed)
+        self.assertEqual(job.stage, 'import')
+        self.assertEqual(sorted(app.journal.checkpoints(vm)), ['convert', 'upload'])
+
+        resumed = self.make_app()
+        job = self.restore(resumed, vm)
+        self.assertFalse(job.failed, job.error)
+        self.assertEqual(len([call for call in resumed.ec2.calls
+                              if call[0] == 'import_snapshot']), 2)
+        self.assertEqual(resumed.s3.objects, {})
+
+    def test_changed_raw_disk_is_converted_again(self):
+        vm = make_vm(self.root, 'vm0')
+        app = self.make_app()
+
+        def failing_put_object(**kwargs):
+            """
+            Fails every upload.
+            """
+            raise IOError("connection reset")
+
+        app.s3.put_object = failing_put_object
+        app.ic_obj.upload_options['max_attempts'] = 1
+        job = self.restore(app, vm)
+        self.assertEqual(job.stage, 'upload')
+        raw_disk = job.state['raw_disks'][0]
+        with open(raw_disk, 'r+b') as raw_file:
+            raw_file.write(b'changed')
+        converted = len(qemu_img_calls(self.qemu_img))
+
+        job = self.restore(self.make_app(), vm)
+        self.assertFalse(job.failed, job.error)
+        self.assertEqual(len(qemu_img_calls(self.qemu_img)), converted + 2)
+
+    def test_restored_vm_is_restored_again(self):
+        vm = make_vm(self.root, 'vm0')
+        first = self.restore(self.make_app(), vm)
+        app = self.make_app()
+        second = self.restore(app, vm)
+        self.assertFalse(second.failed, second.error)
+        self.assertNotEqual(first.state['instance_id'], second.state['instance_id'])
+        self.assertEqual(len(self.launches(app)), 1)
+        self.assertTrue(self.launches(app)[0]['ClientToken'])
+        self.assertEqual(app.journal.checkpoints(vm), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+Restores vms end to end through App.restore_vms with a stub qemu-img and
+stub AWS clients.
+"""
+import shutil
+import tempfile
+import threading
+import unittest
+from tests.stubs import write_qemu_img, qemu_img_calls, make_vm, make_app
+
+STAGES = ['network', 'convert', 'upload', 'import', 'launch']
+
+class RestoreSchedulerTest(unittest.TestCase):
+    """
+    Pipelined restore of several vms.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='trilio_test_')
+        self.qemu_img = write_qemu_img(self.root)
+        self.limits = {'convert': 2, 'upload': 2, 'import': 2, 'launch': 1}
+        self.app = make_app(self.root, self.qemu_img, restore_options=self.limits)
+        self.events = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def progress(self, job, stage, event):
+        """
+        Records stage events.
+        """
+        with self.lock:
+            self.events.append((job.name, stage, event))
+
+    def peaks(self):
+        """
+        Returns the most vms any stage ran at once.
+        """
+        active, peaks = {}, {}
+        for _, stage, event in self.events:
+            active[stage] = active.get(stage, 0) + (1 if event == 'started' else -1)
+            peaks[stage] = max(peaks.get(stage, 0), active[stage])
+        return peaks
+
+    def test_restores_every_vm_through_every_stage(self):
+        vms = [make_vm(self.root, 'vm{}'.format(index)) for index in range(4)]
+        jobs = self.app.restore_vms(vms, self.progress)
+        self.assertEqual([job.name for job in jobs], ['vm0', 'vm1', 'vm2', 'vm3'])
+        for job in jobs:
+            self.assertFalse(job.failed, job.error)
+            self.assertEqual(sorted(job.timings), sorted(STAGES))
+            self.assertEqual(len(job.state['snap_ids']), 2)
+            self.assertTrue(job.state['snap_ids'][0].endswith('!@root_disk'))
+            self.assertTrue(job.state['instance_id'].startswith('i-'))
+            self.assertEqual([(stage, event) for name, stage, event in self.events
+                              if name == job.name],
+                             [(stage, event) for stage in STAGES
+                              for event in ('started', 'done')])
+        disks = [disk for vm in vms for disk in vm['disks']]
+        self.assertEqual(sorted(qemu_img_calls(self.qemu_img)),
+                         sorted(disk + '.raw.partial' for disk in disks))
+        self.assertEqual(sorted(self.app.s3.objects),
+                         sorted(disk.split('/')[-1] + '.raw' for disk in disks))
+        self.assertEqual(len([call for call in self.app.ec2.calls
+                              if call[0] == 'import_snapshot']), len(disks))
+        self.assertEqual(self.app.ec2_resource.calls.count('register_image'), 4)
+        self.assertEqual(self.app.ec2_resource.calls.count('create_instances'), 4)
+        for stage, peak in self.peaks().items():
+            self.assertLessEqual(peak, self.limits.get(stage, 1), stage)
+
+    def test_failing_vm_does_not_stop_the_others(self):
+        vms = [make_vm(self.root, name) for name in ('vm0', 'fail1', 'vm2')]
+        jobs = self.app.restore_vms(vms, self.progress)
+        self.assertEqual([job.failed for job in jobs], [False, True, False])
+        self.assertEqual(jobs[1].stage, 'convert')
+        self.assertIn(('fail1', 'convert', 'failed'), self.events)
+        self.assertNotIn('upload', jobs[1].timings)
+        self.assertEqual(self.app.ec2_resource.calls.count('create_instances'), 2)
+
+    def test_failing_progress_callback_does_not_hang_the_restore(self):
+        def progress(job, stage, event):
+            """
+            Fails like a write to a closed pipe.
+            """
+            self.progress(job, stage, event)
+            if event == 'done':
+                raise IOError(32, 'Broken pipe')
+
+        vms = [make_vm(self.root, 'vm{}'.format(index)) for index in range(3)]
+        jobs = []
+        restore = threading.Thread(
+            target=lambda: jobs.extend(self.app.restore_vms(vms, progress)))
+        restore.daemon = True
+        restore.start()
+        restore.join(60)
+        self.assertFalse(restore.is_alive(), "restore hangs after a callback failed")
+        self.assertEqual([job.failed for job in jobs], [False, False, False])
+        self.assertEqual(len([event for event in self.events if event[2] == 'done']),
+                         len(vms) * len(STAGES))
+
+if __name__ == '__main__':
+    unittest.main()
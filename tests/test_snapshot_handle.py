@@ -0,0 +1,68 @@
+"""
+Picks the latest snapshots of a workload without the catalog.
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from modules import snapshot_handle
+from modules.snapshot_handle import select_latest, SHORTLIST_EXTRA
+
+class SelectLatestTest(unittest.TestCase):
+    """
+    select_latest over a workload of snapshot directories.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='trilio_test_')
+        self.reads = []
+        get_data = snapshot_handle.get_data
+
+        def counting_get_data(filepath):
+            """
+            Records every snapshot_db read.
+            """
+            self.reads.append(filepath)
+            return get_data(filepath)
+
+        snapshot_handle.get_data = counting_get_data
+        self.addCleanup(setattr, snapshot_handle, 'get_data', get_data)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def add(self, number, mtime, updated_at):
+        """
+        Creates snapshot directory number with given snapshot_db mtime and
+        updated_at.
+        """
+        snap_path = os.path.join(self.root, 'snapshot_{:03d}'.format(number))
+        os.makedirs(snap_path)
+        snapshot_db = os.path.join(snap_path, 'snapshot_db')
+        with open(snapshot_db, 'w') as db_file:
+            json.dump({'id': number, 'updated_at': updated_at}, db_file)
+        os.utime(snapshot_db, (mtime, mtime))
+        return snap_path
+
+    def test_updated_at_reads_only_recently_modified_snapshots(self):
+        # updated_at runs opposite to mtime among the ten most recent snapshots
+        minutes = [number if number < 90 else 190 - number for number in range(100)]
+        paths = [self.add(number, 1000000 + number,
+                          '2020-01-01T{:02d}:{:02d}:00.000000'.format(*divmod(minute, 60)))
+                 for number, minute in enumerate(minutes)]
+        latest = select_latest(paths, count=2)
+        self.assertEqual(len(self.reads), 2 + SHORTLIST_EXTRA)
+        self.assertEqual(sorted(self.reads), sorted(
+            os.path.join(path, 'snapshot_db') for path in paths[-2 - SHORTLIST_EXTRA:]))
+        self.assertEqual([snapshot['id'] for snapshot in latest], [90, 91])
+        self.assertEqual(len(self.reads), 2 + SHORTLIST_EXTRA)
+
+    def test_mtime_reads_nothing_until_used(self):
+        paths = [self.add(number, 1000000 + number, '2020-01-01T00:00:00.000000')
+                 for number in range(30)]
+        latest = select_latest(paths, count=3, signal='mtime')
+        self.assertEqual([snapshot.path for snapshot in latest], paths[:-4:-1])
+        self.assertEqual(self.reads, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+"""
+Snapshot lookups by id and id prefix while the vault changes.
+"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from modules.snapshot_index import SnapshotIndex
+from modules.utils import WorkloadException
+
+class SnapshotIndexTest(unittest.TestCase):
+    """
+    SnapshotIndex against a vault of empty snapshot directories.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='trilio_test_')
+        self.index = SnapshotIndex(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def add(self, workload, snap_id):
+        """
+        Creates a snapshot directory and moves the mtime of its workload,
+        whatever the file system's timestamp resolution.
+        """
+        workload_path = os.path.join(self.root, workload)
+        if not os.path.isdir(workload_path):
+            os.makedirs(workload_path)
+            self.touch(self.root)
+        snap_path = os.path.join(workload_path, 'snapshot_' + snap_id)
+        os.makedirs(snap_path)
+        self.touch(workload_path)
+        return snap_path
+
+    def touch(self, directory):
+        """
+        Sets mtime of directory past any earlier one.
+        """
+        mtime = os.stat(directory).st_mtime + 10
+        os.utime(directory, (time.time(), mtime))
+
+    def test_prefix_becomes_ambiguous_when_a_sibling_is_added(self):
+        snap_path = self.add('workload_a', 'abc123')
+        self.assertEqual(self.index.lookup('abc'), ('workload_a', snap_path))
+        self.assertEqual(self.index.lookup('abc', 'workload_a'), ('workload_a', snap_path))
+        self.add('workload_a', 'abc456')
+        self.assertRaises(WorkloadException, self.index.lookup, 'abc')
+        self.assertRaises(WorkloadException, self.index.lookup, 'abc', 'workload_a')
+
+    def test_prefix_becomes_ambiguous_when_a_workload_is_added(self):
+        snap_path = self.add('workload_a', 'abc123')
+        self.assertEqual(self.index.lookup('abc'), ('workload_a', snap_path))
+        self.add('workload_b', 'abc456')
+        self.assertRaises(WorkloadException, self.index.lookup, 'abc')
+        self.assertEqual(self.index.lookup('abc', 'workload_a'), ('workload_a', snap_path))
+
+    def test_exact_id_follows_a_moved_snapshot(self):
+        self.add('workload_a', 'abc123')
+        self.index.lookup('abc123')
+        shutil.rmtree(os.path.join(self.root, 'workload_a', 'snapshot_abc123'))
+        self.touch(os.path.join(self.root, 'workload_a'))
+        snap_path = self.add('workload_b', 'abc123')
+        self.assertEqual(self.index.lookup('snapshot_abc123'), ('workload_b', snap_path))
+        self.assertEqual(self.index.lookup('abc123', 'workload_a'), None)
+
+if __name__ == '__main__':
+    unittest.main()